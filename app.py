@@ -1,21 +1,36 @@
 import os
 from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 from dotenv import load_dotenv
 from session_manager import SessionManager
 from chat_processor_final import ChatProcessor
+from history_store import HistoryStore
+from rate_limiter import RateLimitExceeded
+from circuit_breaker import CircuitOpen
+from webhook_queue import QueuedWebhookHandler, WorkerPool
+from line_delivery import LineDelivery
+from deadline import Deadline
 
 load_dotenv()
 
 app = Flask(__name__)
 
-line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
-handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
+line_delivery = LineDelivery()
+
+# reply token 約 1 分鐘後失效，保留一點緩衝
+REPLY_TOKEN_TTL = float(os.getenv('REPLY_TOKEN_TTL', '50'))
+BUSY_TEXT = "目前使用人數較多，請稍後再試一次 🙏"
 
 session_manager = SessionManager()
+handler = QueuedWebhookHandler(
+    os.getenv('LINE_CHANNEL_SECRET'),
+    WorkerPool(),
+    prefetch=session_manager.prefetch,
+    deadline_ttl=REPLY_TOKEN_TTL
+)
 chat_processor = ChatProcessor(session_manager)
+history_store = HistoryStore(chat_processor.summarize_history)
 
 @app.route("/")
 def index():
@@ -59,84 +74,100 @@ def index():
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
-    body = request.get_data(as_text=True)
+    # 簽章以原始 bytes 驗證，不先解碼成文字
+    body = request.get_data()
     
     try:
+        # 只驗證簽章並排入背景工作池，LLM 生成與對話摘要不佔用 request
         handler.handle(body, signature)
     except InvalidSignatureError:
         abort(400)
     
     return 'OK'
 
+@handler.rejected()
+def handle_rejected(event):
+    """工作池滿載或排隊逾時時告知用戶稍後再試（在 handler.rejected_pool 中執行，不佔用 /callback）"""
+    if not hasattr(event, 'reply_token'):
+        return
+    line_delivery.send(event, TextSendMessage(text=BUSY_TEXT), Deadline.for_event(event, REPLY_TOKEN_TTL), bulk=True)
+
 @handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
+def handle_message(event, deadline):
     user_id = event.source.user_id
     user_message = event.message.text
     
+    # 整個事件只讀一次 session，結束時一次寫回
+    try:
+        with session_manager.session(user_id) as session:
+            reply_text = _handle_text(session, user_message)
+    except (RateLimitExceeded, CircuitOpen):
+        # session 變更已放棄，用戶可以直接再送一次
+        reply_text = BUSY_TEXT
+    
+    # 超過回覆期限或 reply token 失效時改用 push
+    line_delivery.send(event, TextSendMessage(text=reply_text), deadline or Deadline.for_event(event, REPLY_TOKEN_TTL))
+
+def _handle_text(session, user_message):
+    user_id = session.user_id
+    
     # 記錄狀態以便除錯
-    current_state = session_manager.get_state(user_id)
+    current_state = session.state
     print(f"[用戶: {user_id[:8]}...] 狀態: {current_state}, 訊息: {user_message}")
     
     if user_message == '/new':
-        session_manager.clear_session(user_id)
+        session.clear()
         reply_text = "開始新的對話！請告訴我：\n1. 你是誰？（例如：我是一個大學生）"
-        session_manager.set_state(user_id, 'awaiting_user_identity')
+        session.set_state('awaiting_user_identity')
     
     elif user_message == '/more':
-        last_prompt = session_manager.get_last_prompt(user_id)
+        last_prompt = session.get_last_prompt()
         if last_prompt:
             reply_text = chat_processor.generate_more(last_prompt)
         else:
             reply_text = "沒有找到之前的對話內容。請先開始一個新的對話（輸入 /new）"
     
     else:
-        current_state = session_manager.get_state(user_id)
-        
         if current_state is None:
             reply_text = "歡迎使用聊天優化機器人！\n\n請輸入 /new 開始新對話\n或輸入 /more 生成更多內容"
         
         elif current_state == 'awaiting_user_identity':
-            session_manager.set_user_identity(user_id, user_message)
-            session_manager.set_state(user_id, 'awaiting_target_identity')
+            session.update(user_identity=user_message, state='awaiting_target_identity')
             reply_text = f"了解，你是：{user_message}\n\n2. 請告訴我對話對象是誰？（例如：我的教授）"
         
         elif current_state == 'awaiting_target_identity':
-            session_manager.set_target_identity(user_id, user_message)
-            session_manager.set_state(user_id, 'awaiting_context')
+            session.update(target_identity=user_message, state='awaiting_context')
             reply_text = f"了解，對象是：{user_message}\n\n3. 請描述對話情境（例如：請教課業問題）"
         
         elif current_state == 'awaiting_context':
-            session_manager.set_context(user_id, user_message)
-            session_manager.set_state(user_id, 'awaiting_past_conversation')
+            session.update(context=user_message, state='awaiting_past_conversation')
             reply_text = f"了解，情境是：{user_message}\n\n4. 請提供過去的對話紀錄（如果沒有，請輸入「無」）"
         
         elif current_state == 'awaiting_past_conversation':
-            # 限制過去對話的長度，避免超過 LINE 訊息限制
-            if len(user_message) > 500:
-                user_message = user_message[:500] + "...(已截斷)"
-            session_manager.set_past_conversation(user_id, user_message)
-            session_manager.set_state(user_id, 'awaiting_mode_selection')
+            # 較舊的對話壓成摘要，prompt 只帶摘要與最近幾輪
+            history_store.append(session, user_message)
+            session.set_state('awaiting_mode_selection')
             reply_text = "資料收集完成！\n\n請選擇模式：\n1. 輸入「生成」- 我會直接為你生成對話內容\n2. 輸入「潤飾」- 請提供你的對話草稿，我會幫你優化"
         
         elif current_state == 'awaiting_mode_selection':
             if user_message.strip() == '生成':
                 try:
-                    session_data = session_manager.get_session_data(user_id)
-                    reply_text = chat_processor.generate_conversation(session_data, user_id)
-                    session_manager.set_state(user_id, 'conversation_complete')
+                    reply_text = chat_processor.generate_conversation(session.data, user_id, store=session)
+                    session.set_state('conversation_complete')
+                except (RateLimitExceeded, CircuitOpen):
+                    raise
                 except Exception as e:
                     print(f"Error generating conversation: {e}")
                     reply_text = f"抱歉，生成對話時發生錯誤。請確認已設定 OpenAI API 金鑰。\n\n錯誤訊息：{str(e)[:100]}...\n\n請輸入 /new 重新開始"
             elif user_message.strip() == '潤飾':
-                session_manager.set_state(user_id, 'awaiting_draft')
+                session.set_state('awaiting_draft')
                 reply_text = "請提供你的對話草稿："
             else:
                 reply_text = f"請輸入「生成」或「潤飾」來選擇模式\n(你輸入的是：'{user_message}')"
         
         elif current_state == 'awaiting_draft':
-            session_data = session_manager.get_session_data(user_id)
-            reply_text = chat_processor.polish_conversation(session_data, user_message, user_id)
-            session_manager.set_state(user_id, 'conversation_complete')
+            reply_text = chat_processor.polish_conversation(session.data, user_message, user_id, store=session)
+            session.set_state('conversation_complete')
         
         elif current_state == 'conversation_complete':
             reply_text = "對話已完成！\n\n你可以：\n- 輸入 /more 生成更多內容\n- 輸入 /new 開始新對話"
@@ -144,10 +175,7 @@ def handle_message(event):
         else:
             reply_text = "系統錯誤，請輸入 /new 重新開始"
     
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=reply_text)
-    )
+    return reply_text
 
 if __name__ == "__main__":
     app.run(debug=False, port=5000)
\ No newline at end of file
@@ -1,259 +1,143 @@
 import os
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+import json
+import atexit
+from flask import Flask, request, abort, Response, stream_with_context
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import (
-    MessageEvent, TextMessage, TextSendMessage, 
-    PostbackEvent, QuickReply, QuickReplyButton, 
-    MessageAction, PostbackAction
+    MessageEvent, TextMessage, TextSendMessage, PostbackEvent
 )
 from dotenv import load_dotenv
 from session_manager import SessionManager
 from reply_generator import ReplyGenerator
-from flex_message_builder import FlexMessageBuilder
-import urllib.parse
+from flex_templates import FlexTemplateBuilder
+from webhook_queue import QueuedWebhookHandler, WorkerPool
+from context_extractor import ContextExtractor
+from tone_speculator import ToneSpeculator
+from reply_bot import ReplyBot, SyncBotContext, BUSY_TEXT, collect_metrics, run_sync
+from deadline import Deadline
+from line_delivery import LineDelivery
+from option_store import OptionStore
 
 load_dotenv()
 
 app = Flask(__name__)
 
-line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
-handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
+line_delivery = LineDelivery()
+
+# reply token 約 1 分鐘後失效，保留一點緩衝
+REPLY_TOKEN_TTL = float(os.getenv('REPLY_TOKEN_TTL', '50'))
+
+# 內部 API（例如串流端點）使用的 token，未設定時停用
+INTERNAL_API_TOKEN = os.getenv('INTERNAL_API_TOKEN')
 
 session_manager = SessionManager()
+handler = QueuedWebhookHandler(
+    os.getenv('LINE_CHANNEL_SECRET'),
+    WorkerPool(),
+    prefetch=session_manager.prefetch,
+    deadline_ttl=REPLY_TOKEN_TTL
+)
 reply_generator = ReplyGenerator()
-flex_builder = FlexMessageBuilder()
+if reply_generator.semantic_cache is not None:
+    # 有設定 SEMANTIC_CACHE_PATH 時，結束前把語意快取存檔
+    atexit.register(reply_generator.semantic_cache.save)
+flex_builder = FlexTemplateBuilder()
+context_extractor = ContextExtractor()
+tone_speculator = ToneSpeculator(reply_generator)
+option_store = OptionStore(session_manager.redis_client)
+bot = ReplyBot(flex_builder, context_extractor)
 
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
-    body = request.get_data(as_text=True)
+    # 簽章以原始 bytes 驗證，不先解碼成文字
+    body = request.get_data()
     
     try:
+        # 只驗證簽章並排入背景工作池，LLM 生成不佔用 request
         handler.handle(body, signature)
     except InvalidSignatureError:
         abort(400)
     
     return 'OK'
 
-@handler.add(MessageEvent, message=TextMessage)
-def handle_message(event):
-    user_id = event.source.user_id
-    user_message = event.message.text
+@app.route("/api/reply-options/stream", methods=['POST'])
+def stream_reply_options():
+    """以 Server-Sent Events 逐一送出回覆選項，給內部網頁使用
     
-    if user_message == '/start' or user_message == '開始':
-        # 顯示快速情境選單
-        flex_message = flex_builder.create_quick_scenarios_menu()
-        line_bot_api.reply_message(event.reply_token, flex_message)
-        return
+    Body（JSON）：{"message": "幫我回覆老闆明天請假"}
+    或直接帶情境欄位：{"context": ..., "target_identity": ..., "medium": ...}
+    """
+    _require_internal_token()
     
-    elif user_message == '/help' or user_message == '說明':
-        reply_text = """💡 ChatThinker 使用說明
-
-我能幫你快速生成合適的回覆文字！
-
-【使用方式】
-1️⃣ 輸入 /start 選擇情境
-2️⃣ 直接描述你的情況
-3️⃣ 獲得3個回覆選項
-
-【範例】
-「幫我回覆老闆，明天要請假」
-「怎麼拒絕同事的飯局邀請」
-「催客戶交文件要怎麼說」
-
-【特色】
-✅ 直接給答案，不囉嗦
-✅ 提供3種語氣選擇
-✅ 一鍵複製使用
-✅ 可調整語氣"""
-        
-        quick_reply = QuickReply(items=[
-            QuickReplyButton(action=MessageAction(label="開始使用", text="/start")),
-            QuickReplyButton(action=MessageAction(label="看範例", text="看範例"))
-        ])
-        
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=reply_text, quick_reply=quick_reply)
-        )
-        return
+    payload = request.get_json(silent=True) or {}
+    if payload.get('message'):
+        context_data = _extract_context_from_message(payload['message'])
+    elif payload.get('context'):
+        context_data = payload
+    else:
+        abort(400)
     
-    elif user_message == '看範例':
-        reply_text = """📝 使用範例：
-
-【範例1】
-你：幫我回覆老闆明天請假
-我：[立即顯示3個選項卡片]
-
-【範例2】  
-你：怎麼拒絕加班
-我：[立即顯示3個選項卡片]
-
-【範例3】
-你：催進度要怎麼說比較好
-我：[立即顯示3個選項卡片]
-
-每個卡片都可以：
-- 直接複製使用 📋
-- 調整語氣 ✏️"""
-        
-        quick_reply = QuickReply(items=[
-            QuickReplyButton(action=MessageAction(label="馬上試試", text="/start"))
-        ])
-        
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=reply_text, quick_reply=quick_reply)
-        )
-        return
+    def events():
+        try:
+            for option in reply_generator.stream_reply_options(context_data):
+                yield f"event: option\ndata: {json.dumps(option, ensure_ascii=False)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            print(f"Error streaming reply options: {e}")
+            yield "event: error\ndata: {}\n\n"
     
-    elif user_message == '我要自訂情境':
-        session_manager.set_state(user_id, 'custom_scenario')
-        
-        quick_reply = QuickReply(items=[
-            QuickReplyButton(action=MessageAction(label="請假", text="幫我寫請假訊息")),
-            QuickReplyButton(action=MessageAction(label="道歉", text="幫我寫道歉訊息")),
-            QuickReplyButton(action=MessageAction(label="拒絕", text="幫我婉拒邀請")),
-            QuickReplyButton(action=MessageAction(label="催促", text="幫我催進度"))
-        ])
-        
-        reply_text = "請描述你的情況，例如：\n\n「幫我回覆老闆，明天要請假看醫生」\n「怎麼婉拒同事的聚餐邀請」\n「提醒客戶該付款了」"
-        
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=reply_text, quick_reply=quick_reply)
-        )
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route("/metrics")
+def metrics():
+    """斷路器狀態（state_code：0 closed、1 half_open、2 open）與各元件統計"""
+    _require_internal_token()
+    data = collect_metrics(reply_generator, tone_speculator)
+    data['worker_pool'] = handler.worker_pool.stats
+    data['rejected_pool'] = handler.rejected_pool.stats
+    data['webhook'] = handler.fast_parser.stats
+    data['option_store'] = option_store.stats
+    data['line'] = line_delivery.metrics()
+    return app.response_class(json.dumps(data, ensure_ascii=False), mimetype='application/json')
+
+def _require_internal_token():
+    if not INTERNAL_API_TOKEN or request.headers.get('Authorization') != f'Bearer {INTERNAL_API_TOKEN}':
+        abort(403)
+
+def _reply(event, messages, deadline=None):
+    """用 reply token 回覆，已超過回覆期限或 token 失效時改用 push"""
+    line_delivery.send(event, messages, deadline or Deadline.for_event(event, REPLY_TOKEN_TTL))
+
+@handler.rejected()
+def handle_rejected(event):
+    """工作池滿載或排隊逾時時告知用戶稍後再試（在 handler.rejected_pool 中執行，不佔用 /callback）"""
+    if not hasattr(event, 'reply_token'):
         return
-    
-    else:
-        # 處理自然語言輸入
-        context_data = _extract_context_from_message(user_message)
-        
-        # 生成回覆選項
-        options = reply_generator.generate_reply_options(context_data)
-        
-        # 建立 Flex Message
-        flex_message = flex_builder.create_reply_options_carousel(options)
-        
-        # 發送回覆
-        line_bot_api.reply_message(event.reply_token, flex_message)
+    # reply token 已失效的忙碌提示不急，合併後以 multicast 送出
+    line_delivery.send(event, TextSendMessage(text=BUSY_TEXT), Deadline.for_event(event, REPLY_TOKEN_TTL), bulk=True)
+
+@handler.add(MessageEvent, message=TextMessage)
+def handle_message(event, deadline):
+    # 整個事件共用一個 session 工作單元，結束時一次寫回
+    with session_manager.session(event.source.user_id) as session:
+        run_sync(bot.handle_message(event, _context(event, session, deadline)))
 
 @handler.add(PostbackEvent)
-def handle_postback(event):
-    user_id = event.source.user_id
-    data = event.postback.data
-    
-    # 解析 postback data
-    params = dict(param.split('=') for param in data.split('&'))
-    
-    if params.get('action') == 'scenario':
-        # 快速情境
-        scenario = params.get('scenario')
-        
-        # 使用預設範例快速回應
-        examples = reply_generator.generate_quick_scenario_reply(scenario)
-        
-        # 建立選項
-        options = []
-        styles = ['formal', 'balanced', 'casual']
-        emojis = ['👔', '🤝', '😊']
-        titles = ['正式版', '平衡版', '輕鬆版']
-        
-        for i, example in enumerate(examples[:3]):
-            options.append({
-                'style': styles[i],
-                'emoji': emojis[i],
-                'title': f'選項{i+1}：{titles[i]}',
-                'text': example
-            })
-        
-        # 建立 Flex Message
-        flex_message = flex_builder.create_reply_options_carousel(options)
-        line_bot_api.reply_message(event.reply_token, flex_message)
-    
-    elif params.get('action') == 'adjust_tone':
-        # 調整語氣
-        original_text = session_manager.get_last_text(user_id)
-        if not original_text:
-            # 從 data 中取得部分文字
-            original_text = params.get('text', '')
-        
-        # 顯示語氣調整選單
-        flex_message = flex_builder.create_tone_adjustment_menu(original_text)
-        line_bot_api.reply_message(event.reply_token, flex_message)
-    
-    elif params.get('tone'):
-        # 執行語氣調整
-        tone = params.get('tone')
-        text = params.get('text', '')
-        
-        # 取得完整文字（如果被截斷）
-        full_text = session_manager.get_last_text(user_id) or text
-        
-        # 調整語氣
-        adjusted_text = reply_generator.adjust_tone(full_text, tone)
-        
-        # 建立簡單卡片
-        tone_labels = {
-            'formal': '正式版',
-            'casual': '輕鬆版',
-            'polite': '委婉版',
-            'direct': '直接版'
-        }
-        
-        flex_message = flex_builder.create_simple_reply_card(
-            adjusted_text, 
-            f"調整後 - {tone_labels.get(tone, '調整版')}"
-        )
-        
-        line_bot_api.reply_message(event.reply_token, flex_message)
+def handle_postback(event, deadline):
+    with session_manager.session(event.source.user_id) as session:
+        run_sync(bot.handle_postback(event, _context(event, session, deadline)))
+
+def _context(event, session, deadline):
+    return SyncBotContext(event, session, _reply, reply_generator, tone_speculator, option_store, deadline)
 
 def _extract_context_from_message(message):
     """從自然語言中提取情境資訊"""
-    context_data = {
-        'medium': 'LINE',  # 預設
-        'culture': '一般'
-    }
-    
-    # 判斷對象
-    if any(word in message for word in ['老闆', '主管', '經理', 'boss']):
-        context_data['target_identity'] = '主管'
-        context_data['user_identity'] = '員工'
-    elif any(word in message for word in ['同事', '同仁', '小王', '小李']):
-        context_data['target_identity'] = '同事'
-        context_data['user_identity'] = '同事'
-    elif any(word in message for word in ['客戶', '客人', '廠商']):
-        context_data['target_identity'] = '客戶'
-        context_data['user_identity'] = '業務/客服'
-    else:
-        context_data['target_identity'] = '對方'
-        context_data['user_identity'] = '我'
-    
-    # 判斷情境
-    if any(word in message for word in ['請假', '休假', '請病假', '請事假']):
-        context_data['context'] = '請假'
-    elif any(word in message for word in ['拒絕', '婉拒', '不想', '不要']):
-        context_data['context'] = '婉拒邀請或要求'
-    elif any(word in message for word in ['催', '提醒', '進度', '期限']):
-        context_data['context'] = '催促進度'
-    elif any(word in message for word in ['道歉', '抱歉', '對不起', '失誤']):
-        context_data['context'] = '道歉'
-    elif any(word in message for word in ['感謝', '謝謝', '感恩']):
-        context_data['context'] = '表達感謝'
-    else:
-        # 使用原始訊息作為情境
-        context_data['context'] = message
-    
-    # 判斷媒介
-    if any(word in message for word in ['email', 'mail', '郵件', '信件']):
-        context_data['medium'] = 'Email'
-    elif any(word in message for word in ['電話', '打給', 'call']):
-        context_data['medium'] = '電話'
-    elif any(word in message for word in ['面對面', '當面', '見面']):
-        context_data['medium'] = '面對面'
-    
-    return context_data
+    return context_extractor.extract(message)
 
 if __name__ == "__main__":
     app.run(debug=False, port=5000)
\ No newline at end of file
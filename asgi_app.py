@@ -0,0 +1,223 @@
+import os
+import json
+import asyncio
+from collections import deque
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import TextSendMessage
+from dotenv import load_dotenv
+from session_manager import SessionManager
+from reply_generator import ReplyGenerator
+from flex_templates import FlexTemplateBuilder
+from context_extractor import ContextExtractor
+from tone_speculator import ToneSpeculator
+from reply_bot import ReplyBot, AsyncBotContext, BUSY_TEXT, collect_metrics
+from deadline import Deadline
+from line_delivery import AsyncLineDelivery
+from webhook_fastpath import FastWebhookParser, handler_names
+from option_store import OptionStore
+
+load_dotenv()
+
+# 回覆優化版（app_reply_optimized）的 ASGI 入口：
+# LLM、Redis、LINE API 都在 event loop 上等待，單一行程即可同時處理數百個生成
+
+# reply token 約 1 分鐘後失效，保留一點緩衝
+REPLY_TOKEN_TTL = float(os.getenv('REPLY_TOKEN_TTL', '50'))
+# 同時處理中的事件上限，超過時回覆稍後再試
+MAX_INFLIGHT = int(os.getenv('ASGI_MAX_INFLIGHT', '200'))
+JOB_TIMEOUT = float(os.getenv('WORKER_JOB_TIMEOUT', '50'))
+# 內部 API（/metrics）使用的 token，未設定時停用
+INTERNAL_API_TOKEN = os.getenv('INTERNAL_API_TOKEN')
+
+session_manager = SessionManager()
+reply_generator = ReplyGenerator()
+flex_builder = FlexTemplateBuilder()
+context_extractor = ContextExtractor()
+tone_speculator = ToneSpeculator(reply_generator)
+option_store = OptionStore(session_manager.redis_client)
+bot = ReplyBot(flex_builder, context_extractor)
+# 與 WebhookHandler.add 相同的名稱：事件名稱_訊息名稱 或 事件名稱
+handlers = {
+    'MessageEvent_TextMessage': bot.handle_message,
+    'PostbackEvent': bot.handle_postback
+}
+parser = FastWebhookParser(
+    os.getenv('LINE_CHANNEL_SECRET'),
+    lambda event_name, message_name: _lookup(event_name, message_name) is not None
+)
+# aiohttp session 在第一次送出時於 event loop 中建立
+line_delivery = AsyncLineDelivery()
+
+# user_id（沒有時為事件本身）-> 尚未處理的事件，同一用戶依序處理
+_lanes = {}
+_inflight = 0
+# 保留背景 task 的參照，避免執行中被回收
+_tasks = set()
+
+stats = {
+    'queued': 0,
+    'rejected': 0,
+    'timeout': 0,
+    'failed': 0
+}
+
+async def _reply(event, messages, deadline=None):
+    """用 reply token 回覆，已超過回覆期限或 token 失效時改用 push"""
+    await line_delivery.send(event, messages, deadline or Deadline.for_event(event, REPLY_TOKEN_TTL))
+
+def _lookup(event_name, message_name):
+    if message_name:
+        handle = handlers.get(event_name + '_' + message_name)
+        if handle is not None:
+            return handle
+    return handlers.get(event_name)
+
+def _find_handler(event):
+    return _lookup(*handler_names(event))
+
+def _lane_key(event):
+    user_id = getattr(event.source, 'user_id', None)
+    # 沒有 user_id 的事件（例如部分群組事件）各自獨立處理，與同步模式相同
+    return user_id or ('event', id(event))
+
+def dispatch(events):
+    """排入事件並立即返回，回傳成功排入的事件數"""
+    global _inflight
+    queued = 0
+    idle = []
+    for event in events:
+        handle = _find_handler(event)
+        if handle is None:
+            continue
+
+        if _inflight >= MAX_INFLIGHT:
+            stats['rejected'] += 1
+            _spawn(_reject(event))
+            continue
+
+        _inflight += 1
+        stats['queued'] += 1
+        queued += 1
+        # 回覆期限從收到 webhook 時開始計算
+        job = (handle, event, Deadline.for_event(event, REPLY_TOKEN_TTL))
+        key = _lane_key(event)
+        lane = _lanes.get(key)
+        if lane is not None:
+            # 該用戶已有事件在處理或等待預讀，接在後面依序處理
+            lane.append(job)
+        else:
+            _lanes[key] = deque([job])
+            idle.append(key)
+
+    if idle:
+        _spawn(_start(idle))
+    return queued
+
+def _spawn(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+async def _start(keys):
+    """與同步模式的 prefetch 相同：先用一個 pipeline 預讀這批閒置用戶的 session，再開始處理"""
+    try:
+        await session_manager.aprefetch([key for key in keys if isinstance(key, str)])
+    except Exception as e:
+        print(f"[asgi] 預讀失敗: {e}")
+    for key in keys:
+        _spawn(_drain(key))
+
+async def _drain(key):
+    global _inflight
+    lane = _lanes[key]
+    while lane:
+        handle, event, deadline = lane.popleft()
+        try:
+            await asyncio.wait_for(_run(handle, event, deadline), JOB_TIMEOUT)
+        except asyncio.TimeoutError:
+            stats['timeout'] += 1
+            print(f"[asgi] 工作超過期限 {JOB_TIMEOUT}s: {str(getattr(event.source, 'user_id', None))[:8]}...")
+        except Exception as e:
+            stats['failed'] += 1
+            print(f"[asgi] handler 執行失敗: {e}")
+        finally:
+            _inflight -= 1
+    del _lanes[key]
+
+async def _run(handle, event, deadline):
+    # 整個事件共用一個 session 工作單元，結束時一次寫回
+    async with session_manager.async_session(event.source.user_id) as session:
+        await handle(event, AsyncBotContext(event, session, _reply, reply_generator, tone_speculator, option_store, deadline))
+
+async def _reject(event):
+    try:
+        # reply token 已失效的忙碌提示不急，合併後以 multicast 送出
+        await line_delivery.send(event, TextSendMessage(text=BUSY_TEXT), Deadline.for_event(event, REPLY_TOKEN_TTL), bulk=True)
+    except Exception as e:
+        print(f"[asgi] 回覆忙碌訊息失敗: {e}")
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def _respond(send, status, text, content_type=b'text/plain; charset=utf-8'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type)]
+    })
+    await send({'type': 'http.response.body', 'body': text.encode('utf-8')})
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _tasks:
+                await asyncio.wait(list(_tasks), timeout=JOB_TIMEOUT)
+            await line_delivery.close()
+            if reply_generator.semantic_cache is not None:
+                reply_generator.semantic_cache.save()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    if scope['path'] == '/callback' and scope['method'] == 'POST':
+        headers = dict(scope['headers'])
+        signature = headers.get(b'x-line-signature', b'').decode('utf-8')
+        # 簽章以原始 bytes 驗證，不先解碼成文字
+        body = await _read_body(receive)
+
+        try:
+            events = parser.parse(body, signature)
+        except InvalidSignatureError:
+            await _respond(send, 400, 'Bad Request')
+            return
+
+        # 只驗證簽章並排入事件，LLM 生成不佔用 request
+        dispatch(events)
+        await _respond(send, 200, 'OK')
+    elif scope['path'] == '/metrics':
+        authorization = dict(scope['headers']).get(b'authorization', b'').decode('utf-8')
+        if not INTERNAL_API_TOKEN or authorization != f'Bearer {INTERNAL_API_TOKEN}':
+            await _respond(send, 403, 'Forbidden')
+            return
+        data = collect_metrics(reply_generator, tone_speculator)
+        data['asgi'] = dict(stats, inflight=_inflight)
+        data['line'] = line_delivery.metrics()
+        data['webhook'] = parser.stats
+        data['option_store'] = option_store.stats
+        await _respond(send, 200, json.dumps(data, ensure_ascii=False), b'application/json')
+    elif scope['path'] == '/':
+        await _respond(send, 200, 'ChatThinker is running')
+    else:
+        await _respond(send, 404, 'Not Found')
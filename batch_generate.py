@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+離線批次生成回覆選項（例如建立 reply_corpus.json 用的素材）
+
+輸入為 JSONL，每行一個情境 dict（context、target_identity、medium、culture、user_identity）。
+輸出也是 JSONL，每行一筆：{"key":..., "input":{...}, "options":[[style, text], ...]}，
+寫入後立即 flush，輸出檔本身就是 checkpoint：中斷後以相同參數再執行，已完成的 key 會跳過。
+相同的輸入（正規化後）只生成一次。
+
+用法：
+    python batch_generate.py contexts.jsonl replies.jsonl --concurrency 8 --rps 5
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+# 批次結果要的是每個輸入各自的生成，不沿用意思相近的舊結果
+os.environ['SEMANTIC_CACHE'] = 'false'
+
+from circuit_breaker import CircuitOpen
+from prompt_registry import PROMPTS
+from rate_limiter import RateLimiter, RateLimitExceeded, PRIORITY_NORMAL
+from reply_corpus import ReplyCorpus
+from reply_generator import ReplyGenerator
+from response_cache import ResponseCache
+
+# gpt-3.5-turbo 每 1K token 的美元價格，可用參數覆寫
+PROMPT_PRICE = 0.0005
+COMPLETION_PRICE = 0.0015
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='批次生成回覆選項（可中斷後續跑）')
+    parser.add_argument('input', help='情境 JSONL')
+    parser.add_argument('output', help='結果 JSONL（同時作為 checkpoint）')
+    parser.add_argument('--concurrency', type=int, default=8, help='同時進行的生成數')
+    parser.add_argument('--rps', type=float, default=None, help='每秒請求上限（預設 OPENAI_RPS）')
+    parser.add_argument('--tpm', type=float, default=None, help='每分鐘 token 上限（預設 OPENAI_TPM）')
+    parser.add_argument('--retries', type=int, default=2, help='單筆失敗後的重試次數')
+    parser.add_argument('--open-wait', type=float, default=5, help='LLM 暫停使用（斷路器開啟）時每次等待的秒數')
+    parser.add_argument('--open-waits', type=int, default=12, help='單筆因 LLM 暫停使用最多等待幾次，超過即視為失敗')
+    parser.add_argument('--no-cache', action='store_true', help='不使用 LLM 回應快取')
+    parser.add_argument('--report-every', type=float, default=5, help='進度回報間隔（秒）')
+    parser.add_argument('--prompt-price', type=float, default=PROMPT_PRICE, help='輸入每 1K token 價格（USD）')
+    parser.add_argument('--completion-price', type=float, default=COMPLETION_PRICE, help='輸出每 1K token 價格（USD）')
+    return parser.parse_args(argv)
+
+def load_done(path):
+    """讀取已完成的 key；中斷時寫到一半的最後一行會被忽略並截掉"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    valid_size = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                done.add(json.loads(line)['key'])
+            except (ValueError, KeyError):
+                break
+            valid_size += len(line)
+    with open(path, 'rb+') as f:
+        f.truncate(valid_size)
+    return done
+
+def load_jobs(path, generator, done):
+    """回傳 (待生成的 [(key, context_data)], 輸入行數, 重複筆數)"""
+    version = PROMPTS.get('reply_options').version
+    jobs = []
+    seen = set(done)
+    total = 0
+    duplicates = 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            total += 1
+            context_data = json.loads(line)
+            params = generator._reply_option_params(context_data)
+            key = generator.cache.make_key('reply_options', version, params).rsplit(':', 1)[-1][:16]
+            if key in seen:
+                duplicates += key not in done
+                continue
+            seen.add(key)
+            jobs.append((key, context_data))
+    return jobs, total, duplicates
+
+def compact(key, context_data, options):
+    record = {
+        'key': key,
+        'input': context_data,
+        'options': [[option['style'], option['text']] for option in options]
+    }
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+class Progress:
+    """吞吐量與 token 成本（用量取自 ReplyGenerator.usage，只計實際送出的 LLM 呼叫）"""
+
+    def __init__(self, generator, pending, skipped, prompt_price, completion_price):
+        self.generator = generator
+        self.pending = pending
+        self.skipped = skipped
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.start = time.monotonic()
+
+    def cost(self):
+        usage = self.generator.usage
+        return (usage['prompt_tokens'] * self.prompt_price + usage['completion_tokens'] * self.completion_price) / 1000
+
+    def line(self):
+        elapsed = time.monotonic() - self.start
+        rate = self.completed / elapsed if elapsed else 0
+        remaining = self.pending - self.completed - self.failed
+        eta = remaining / rate if rate else 0
+        usage = self.generator.usage
+        return (
+            f"[batch] {self.completed}/{self.pending} 完成（略過 {self.skipped}，失敗 {self.failed}，重試 {self.retried}）"
+            f" {rate:.2f} 筆/秒，剩餘約 {eta:.0f}s | LLM {usage['calls']} 次，"
+            f"token {usage['prompt_tokens']}+{usage['completion_tokens']}，約 ${self.cost():.4f}"
+        )
+
+async def generate(generator, context_data, args, progress):
+    """生成一筆；流量限制時等待後重試，斷路器開啟時最多等待 --open-waits 次（都不計入重試次數）
+
+    斷路器可能是 ReplyGenerator 或 router 中某個 backend 的，開啟時間不一定，固定每次等待 --open-wait 秒。
+    """
+    attempts = 0
+    open_waits = 0
+    while True:
+        try:
+            return await generator.agenerate_reply_options(
+                context_data, use_cache=not args.no_cache, priority=PRIORITY_NORMAL, fallback=False
+            )
+        except RateLimitExceeded:
+            await asyncio.sleep(1)
+        except CircuitOpen as e:
+            open_waits += 1
+            if open_waits > args.open_waits:
+                print(f"[batch] 失敗（LLM 持續暫停使用）：{context_data} {e}", file=sys.stderr)
+                return None
+            await asyncio.sleep(args.open_wait)
+        except Exception as e:
+            attempts += 1
+            if attempts > args.retries:
+                print(f"[batch] 失敗：{context_data} {e}", file=sys.stderr)
+                return None
+            progress.retried += 1
+            await asyncio.sleep(2 ** attempts)
+
+async def run(args):
+    cache = ResponseCache()
+    limiter = RateLimiter(cache.redis_client, rps=args.rps, tpm=args.tpm, max_wait=30)
+    # 回覆庫本身就是要建立的對象，批次時一律呼叫 LLM
+    generator = ReplyGenerator(cache=cache, limiter=limiter, corpus=ReplyCorpus())
+
+    done = load_done(args.output)
+    jobs, total, duplicates = load_jobs(args.input, generator, done)
+    progress = Progress(generator, len(jobs), total - len(jobs), args.prompt_price, args.completion_price)
+    print(f"[batch] 輸入 {total} 筆，已完成 {len(done)}，重複 {duplicates}，待生成 {len(jobs)}")
+
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+
+    with open(args.output, 'a', encoding='utf-8') as out:
+        async def worker():
+            while True:
+                try:
+                    key, context_data = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                options = await generate(generator, context_data, args, progress)
+                if options is None:
+                    progress.failed += 1
+                    continue
+                out.write(compact(key, context_data, options))
+                out.flush()
+                progress.completed += 1
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(args.report_every)
+                print(progress.line())
+
+        report_task = asyncio.create_task(reporter())
+        try:
+            await asyncio.gather(*(worker() for _ in range(max(1, args.concurrency))))
+        finally:
+            report_task.cancel()
+            os.fsync(out.fileno())
+
+    print(progress.line())
+    return 1 if progress.failed else 0
+
+def main(argv=None):
+    return asyncio.run(run(parse_args(argv)))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+比較 ContextExtractor（Aho-Corasick）與原本逐一關鍵字掃描的效能
+"""
+import random
+import time
+from context_extractor import ContextExtractor, DEFAULT_TABLES
+
+SAMPLE_MESSAGES = [
+    "幫我回覆老闆明天請假",
+    "怎麼拒絕同事的飯局邀請",
+    "催客戶交文件要怎麼說，用email",
+    "跟主管道歉，上次報告有失誤，想當面說",
+    "謝謝廠商幫忙趕貨，打給他之前想先準備一下",
+    "我是滑板教練，要跟學生說明學費調漲",
+]
+
+def legacy_extract(message):
+    """從自然語言中提取情境資訊"""
+    context_data = {
+        'medium': 'LINE',  # 預設
+        'culture': '一般'
+    }
+    
+    # 判斷對象
+    if any(word in message for word in ['老闆', '主管', '經理', 'boss']):
+        context_data['target_identity'] = '主管'
+        context_data['user_identity'] = '員工'
+    elif any(word in message for word in ['同事', '同仁', '小王', '小李']):
+        context_data['target_identity'] = '同事'
+        context_data['user_identity'] = '同事'
+    elif any(word in message for word in ['客戶', '客人', '廠商']):
+        context_data['target_identity'] = '客戶'
+        context_data['user_identity'] = '業務/客服'
+    else:
+        context_data['target_identity'] = '對方'
+        context_data['user_identity'] = '我'
+    
+    # 判斷情境
+    if any(word in message for word in ['請假', '休假', '請病假', '請事假']):
+        context_data['context'] = '請假'
+    elif any(word in message for word in ['拒絕', '婉拒', '不想', '不要']):
+        context_data['context'] = '婉拒邀請或要求'
+    elif any(word in message for word in ['催', '提醒', '進度', '期限']):
+        context_data['context'] = '催促進度'
+    elif any(word in message for word in ['道歉', '抱歉', '對不起', '失誤']):
+        context_data['context'] = '道歉'
+    elif any(word in message for word in ['感謝', '謝謝', '感恩']):
+        context_data['context'] = '表達感謝'
+    else:
+        # 使用原始訊息作為情境
+        context_data['context'] = message
+    
+    # 判斷媒介
+    if any(word in message for word in ['email', 'mail', '郵件', '信件']):
+        context_data['medium'] = 'Email'
+    elif any(word in message for word in ['電話', '打給', 'call']):
+        context_data['medium'] = '電話'
+    elif any(word in message for word in ['面對面', '當面', '見面']):
+        context_data['medium'] = '面對面'
+    
+    return context_data
+
+def grow_tables(size):
+    """產生含大量虛構關鍵字的表，模擬關鍵字表成長"""
+    tables = {slot: [dict(entry) for entry in entries] for slot, entries in DEFAULT_TABLES.items()}
+    rng = random.Random(42)
+    charset = '甲乙丙丁戊己庚辛壬癸子丑寅卯辰巳午未申酉戌亥'
+    for slot, entries in tables.items():
+        for i in range(size // len(tables)):
+            keyword = ''.join(rng.choice(charset) for _ in range(rng.randint(2, 5)))
+            entries.append({'value': f'{slot}-{i}', 'keywords': [keyword], 'fields': {}})
+    return tables
+
+def legacy_scan(tables, message):
+    """與 legacy_extract 相同的做法：每個關鍵字各做一次子字串搜尋"""
+    found = {}
+    for slot, entries in tables.items():
+        for entry in entries:
+            if any(word in message for word in entry['keywords']):
+                found[slot] = entry['value']
+                break
+    return found
+
+def bench(name, func, messages, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            func(message)
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / (rounds * len(messages)) * 1e6
+    print(f"  {name:<20} {per_call:8.2f} µs/訊息")
+
+def main():
+    extractor = ContextExtractor()
+
+    mismatches = [m for m in SAMPLE_MESSAGES if extractor.extract(m) != legacy_extract(m)]
+    print(f"與原實作結果不一致：{len(mismatches)} 筆")
+
+    print("\n預設關鍵字表：")
+    bench('legacy', legacy_extract, SAMPLE_MESSAGES, 20000)
+    bench('aho-corasick', extractor.extract, SAMPLE_MESSAGES, 20000)
+
+    for size in (1000, 5000):
+        tables = grow_tables(size)
+        big = ContextExtractor(tables)
+        print(f"\n關鍵字表擴充 {size} 筆：")
+        bench('legacy', lambda m: legacy_scan(tables, m), SAMPLE_MESSAGES, 500)
+        bench('aho-corasick', big.find_slots, SAMPLE_MESSAGES, 500)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+比較 FlexTemplateBuilder（預先序列化的骨架）與 FlexMessageBuilder（SDK 物件樹）的效能
+
+計時包含建立訊息與 SDK 送出前的序列化（as_json_dict + json.dumps）。
+"""
+import json
+import time
+from flex_message_builder import FlexMessageBuilder
+from flex_templates import FlexTemplateBuilder
+
+OPTIONS = [
+    {'style': 'formal', 'emoji': '👔', 'title': '選項1：正式版', 'text': '老闆您好，明天因家中有事需要請假一天，工作已交接給同事，謝謝您。'},
+    {'style': 'balanced', 'emoji': '😊', 'title': '選項2：平衡版', 'text': '不好意思，明天想請個假，有些私事需要處理'},
+    {'style': 'casual', 'emoji': '😄', 'title': '選項3：輕鬆版', 'text': '老闆～明天請假一天喔，"急事" 處理完就回來 \\o/'},
+]
+
+TEXTS = [
+    '明天請假一天',
+    '不好意思，這週的報告可能要延到下週一才能交，' * 5,
+    'Hi <team>, "quoted" & \\escaped\\ text\n第二行',
+]
+
+def cases(builder):
+    yield builder.create_quick_scenarios_menu()
+    yield builder.create_reply_options_carousel(OPTIONS, 'Ab3-x_9Z')
+    yield builder.create_reply_options_carousel(OPTIONS[:1], 'Ab3-x_9Z')
+    yield builder.create_reply_options_carousel([], 'Ab3-x_9Z')
+    for text in TEXTS:
+        yield builder.create_tone_adjustment_menu(text, 'Ab3-x_9Z:2')
+        yield builder.create_simple_reply_card(text)
+        yield builder.create_simple_reply_card(text, "調整後 - 正式版")
+
+def serialize(message):
+    # 與 LineBotApi.reply_message 相同的序列化方式
+    return json.dumps({'replyToken': 'x', 'messages': [message.as_json_dict()]})
+
+def bench(name, func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        serialize(func())
+    elapsed = time.perf_counter() - start
+    print(f"  {name:<10} {elapsed / rounds * 1e6:8.1f} µs/訊息")
+
+def main():
+    legacy = FlexMessageBuilder()
+    templates = FlexTemplateBuilder(legacy)
+
+    mismatches = [
+        i for i, (old, new) in enumerate(zip(cases(legacy), cases(templates)))
+        if serialize(old) != serialize(new) or old.as_json_string() != new.as_json_string()
+    ]
+    print(f"與原實作輸出不一致：{len(mismatches)} 筆")
+
+    scenarios = [
+        ('快速情境選單', lambda b: b.create_quick_scenarios_menu),
+        ('回覆選項輪播', lambda b: lambda: b.create_reply_options_carousel(OPTIONS, 'Ab3-x_9Z')),
+        ('語氣調整選單', lambda b: lambda: b.create_tone_adjustment_menu(TEXTS[1], 'Ab3-x_9Z:1')),
+        ('單一回覆卡片', lambda b: lambda: b.create_simple_reply_card(TEXTS[0], "調整後 - 正式版")),
+    ]
+    for title, make in scenarios:
+        print(f"\n{title}：")
+        bench('sdk', make(legacy), 5000)
+        bench('template', make(templates), 5000)
+
+if __name__ == "__main__":
+    main()
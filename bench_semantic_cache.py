@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+語意快取（SemanticCache）的門檻與效能
+
+1. 以換句話說 / 不同情境 / 只差一個細節的請求對，列出各門檻的命中與誤判
+   （命中需要 guard_tokens 相同且相似度達到門檻）
+2. 10 萬筆資料時的查詢、加入（含淘汰）與存檔、讀檔時間
+"""
+import os
+import time
+import random
+import tempfile
+import numpy as np
+from semantic_cache import SemanticCache, featurize, guard_tokens
+
+# 意思相同、說法不同，應該命中
+PARAPHRASES = [
+    ("明天想請假跟老闆說", "幫我跟主管請假明天"),
+    ("明天要請假", "明天想請假一天"),
+    ("婉拒今晚加班", "今天晚上不想加班要怎麼拒絕"),
+    ("催同事交報告", "提醒同事報告還沒交"),
+    ("跟客戶道歉出貨延遲", "出貨延遲要跟客戶道歉"),
+    ("下週一想請特休", "想請下週一的特休"),
+    ("拒絕同事週末換班", "同事想跟我週末換班我想拒絕"),
+]
+
+# 用字相近但情境不同，不應該命中
+DIFFERENT = [
+    ("明天想請假跟老闆說", "婉拒今晚加班"),
+    ("明天要請假", "明天要開會"),
+    ("催同事交報告", "跟客戶道歉出貨延遲"),
+    ("跟老闆請假", "跟老闆要求加薪"),
+    ("請假一天", "請客吃飯"),
+    ("下週一想請特休", "下週一要交報告"),
+    ("拒絕同事週末換班", "答應同事週末換班"),
+]
+
+# 只差一個改變意思的細節（數字、否定、方向、星期、日期、時態），相似度很高但不應該命中
+NEAR_MISSES = [
+    ("提醒客戶這週五前付款5萬元", "提醒客戶這週五前付款50萬元"),
+    ("跟房東說下個月要搬走", "跟房東說下個月不搬走"),
+    ("通知客戶價格調漲", "通知客戶價格調降"),
+    ("跟主管說週六可以加班", "跟主管說週日可以加班"),
+    ("跟客戶說交期晚一週", "跟客戶說交期早一週"),
+    ("跟同事說會議改到上午", "跟同事說會議改到下午"),
+    ("提醒主管報告已經交了", "提醒主管報告還沒交"),
+    ("答應同事週末換班", "婉拒同事週末換班"),
+    ("跟主管說明天要請假一天", "跟主管說今天要請假一天"),
+    ("跟客戶說文件會寄出", "跟客戶說文件已經寄出"),
+    ("跟同事說昨天的報告有問題", "跟同事說後天的報告有問題"),
+]
+
+WORDS = ['請假', '加班', '報告', '客戶', '道歉', '會議', '延遲', '出貨', '特休', '換班', '加薪', '專案',
+         '明天', '下週', '今天', '主管', '同事', '提醒', '婉拒', '確認', '時間', '資料', '合約', '訂單']
+
+def similarity(a, b, dim):
+    return float(featurize(a, dim) @ featurize(b, dim))
+
+def scores(pairs, dim):
+    """(相似度, guard_tokens 是否相同)"""
+    return [(similarity(a, b, dim), guard_tokens(a) == guard_tokens(b)) for a, b in pairs]
+
+def show(label, pairs):
+    print(f"{label}：{' '.join(f'{s:.2f}' + ('' if same else '*') for s, same in pairs)}")
+
+def tune(dim):
+    same = scores(PARAPHRASES, dim)
+    different = scores(DIFFERENT, dim)
+    near = scores(NEAR_MISSES, dim)
+    show("換句話說", same)
+    show("不同情境", different)
+    show("只差細節", near)
+    print("  （* 表示 guard_tokens 不同，不論相似度都不命中）")
+    for threshold in (0.5, 0.6, 0.7, 0.8, 0.85, 0.9):
+        hits = sum(s >= threshold and ok for s, ok in same)
+        wrong = sum(s >= threshold and ok for s, ok in different + near)
+        unguarded = sum(s >= threshold for s, _ in near)
+        print(
+            f"  門檻 {threshold:.2f}：命中 {hits}/{len(same)}，誤判 {wrong}/{len(different) + len(near)}"
+            f"（不檢查細節時只差細節的誤判 {unguarded}/{len(near)}）"
+        )
+
+def random_request(rng):
+    return ''.join(rng.choice(WORDS) for _ in range(rng.randint(3, 6)))
+
+def bench_scale(size, dim):
+    rng = random.Random(0)
+    cache = SemanticCache(dim=dim, capacity=size, threshold=0.8, path='')
+    groups = [SemanticCache.group_of('reply_options', 'v1', {'medium': m}) for m in ('LINE', 'Email')]
+    option = [{'style': 'formal', 'emoji': '👔', 'title': '選項1：正式版', 'text': '老闆您好，明天需要請假一天'}]
+
+    texts = [random_request(rng) for _ in range(size)]
+    start = time.perf_counter()
+    for i, text in enumerate(texts):
+        cache.add(groups[i % 2], text, option)
+    fill = time.perf_counter() - start
+    print(f"\n{size:,} 筆（{cache.index.vectors.nbytes / 2 ** 20:.0f} MB 向量）：")
+    print(f"  加入          {fill / size * 1e6:8.1f} µs/筆")
+
+    queries = [random_request(rng) for _ in range(200)]
+    start = time.perf_counter()
+    for text in queries:
+        cache.lookup(groups[0], text)
+    print(f"  查詢          {(time.perf_counter() - start) / len(queries) * 1000:8.2f} ms/次")
+
+    vectors = np.stack([featurize(text, dim) for text in queries])
+    start = time.perf_counter()
+    for vector in vectors:
+        cache.index.search(vector, groups[0], k=5)
+    print(f"  top-5（不含特徵）{(time.perf_counter() - start) / len(queries) * 1000:5.2f} ms/次")
+
+    start = time.perf_counter()
+    for text in queries:
+        cache.add(groups[1], text, option)
+    print(f"  加入（已滿，含淘汰）{(time.perf_counter() - start) / len(queries) * 1000:5.2f} ms/筆")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'semantic.npz')
+        start = time.perf_counter()
+        cache.save(path)
+        saved = time.perf_counter() - start
+        restored = SemanticCache(dim=dim, capacity=size, threshold=0.8, path='')
+        start = time.perf_counter()
+        restored.load(path)
+        loaded = time.perf_counter() - start
+        print(f"  存檔 {saved:.2f}s / 讀檔 {loaded:.2f}s（{os.path.getsize(path) / 2 ** 20:.0f} MB）")
+    print(f"  {cache.metrics()}")
+
+def main():
+    dim = int(os.getenv('SEMANTIC_CACHE_DIM', '256'))
+    tune(dim)
+    bench_scale(100000, dim)
+
+if __name__ == "__main__":
+    main()
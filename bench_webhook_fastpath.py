@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+比較 FastWebhookParser 與 SDK 的 WebhookParser 解析大量事件的 webhook
+
+SDK 的做法：body 解碼成文字、驗證簽章、每個事件都建立 SDK 物件，之後才依 handler 篩選。
+"""
+import json
+import hmac
+import time
+import base64
+import random
+import hashlib
+from linebot import WebhookParser
+from linebot.models import MessageEvent, TextMessage, PostbackEvent
+from webhook_fastpath import FastWebhookParser
+
+SECRET = 'bench-secret'
+
+def accepts(event_name, message_name):
+    return (event_name, message_name) in (('MessageEvent', 'TextMessage'), ('PostbackEvent', None))
+
+def sample_event(rng, i):
+    base = {
+        'mode': 'active',
+        'timestamp': 1700000000000 + i,
+        'source': {'type': 'user', 'userId': f'U{rng.randrange(10 ** 12):032x}'},
+        'webhookEventId': f'01H{i:023d}',
+        'deliveryContext': {'isRedelivery': False},
+        'replyToken': f'{rng.randrange(10 ** 12):032x}'
+    }
+    kind = rng.random()
+    if kind < 0.4:
+        base.update(type='message', message={'id': str(i), 'type': 'text', 'quoteToken': 'q', 'text': '幫我回覆老闆明天請假'})
+    elif kind < 0.6:
+        base.update(type='postback', postback={'data': 'action=adjust_tone&index=1&style=balanced'})
+    elif kind < 0.75:
+        base.update(type='message', message={'id': str(i), 'type': 'sticker', 'packageId': '1', 'stickerId': '2',
+                                             'stickerResourceType': 'STATIC', 'keywords': ['happy', 'smile']})
+    elif kind < 0.85:
+        base.update(type='message', message={'id': str(i), 'type': 'image',
+                                             'contentProvider': {'type': 'line'}})
+    elif kind < 0.95:
+        base.update(type='follow')
+    else:
+        base.pop('replyToken')
+        base.update(type='unfollow')
+    return base
+
+def make_body(size, seed=0):
+    rng = random.Random(seed)
+    body = json.dumps({'destination': 'Ubot', 'events': [sample_event(rng, i) for i in range(size)]},
+                      ensure_ascii=False).encode('utf-8')
+    signature = base64.b64encode(hmac.new(SECRET.encode(), body, hashlib.sha256).digest()).decode()
+    return body, signature
+
+def sdk_parse(parser, body, signature):
+    events = parser.parse(body.decode('utf-8'), signature)
+    return [
+        event for event in events
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage)
+        or isinstance(event, PostbackEvent)
+    ]
+
+def fields(event):
+    message = getattr(event, 'message', None)
+    postback = getattr(event, 'postback', None)
+    return (
+        event.type, event.timestamp, event.reply_token, event.source.user_id,
+        message.text if message else None, postback.data if postback else None
+    )
+
+def bench(name, func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"  {name:<6} {elapsed / rounds * 1000:8.2f} ms/webhook")
+
+def main():
+    sdk = WebhookParser(SECRET)
+    fast = FastWebhookParser(SECRET, accepts)
+
+    body, signature = make_body(500)
+    same = [fields(e) for e in sdk_parse(sdk, body, signature)] == [fields(e) for e in fast.parse(body, signature)]
+    print(f"交給 handler 的事件與 SDK 相同：{same}")
+
+    for size in (10, 100, 1000):
+        body, signature = make_body(size)
+        rounds = max(20, 20000 // size)
+        print(f"\n{size} 個事件（{len(body) // 1024} KB）：")
+        bench('sdk', lambda: sdk_parse(sdk, body, signature), rounds)
+        bench('fast', lambda: fast.parse(body, signature), rounds)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from dotenv import load_dotenv
+from deadline import DeadlineExceeded
+
+load_dotenv()
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# 給監控用的數值
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitOpen(Exception):
+    """斷路器開啟中，呼叫沒有送出"""
+
+# 呼叫端自己的期限或取消（排隊太久、用戶離開），與 LLM 是否正常無關，不計入成功或失敗
+NOT_COUNTED = (DeadlineExceeded, asyncio.CancelledError, GeneratorExit)
+
+class CircuitBreaker:
+    """依最近一段時間的錯誤率與 p95 延遲決定是否暫停呼叫 LLM
+
+    closed：正常呼叫並記錄結果，錯誤率或 p95 超過門檻時轉為 open
+    open：直接拋出 CircuitOpen，由呼叫端改用靜態範例；open_seconds 後轉為 half_open
+    half_open：只放一個探測請求，成功就回到 closed，失敗再回到 open
+    """
+
+    def __init__(self, name, window=None, min_calls=None, error_rate=None, p95_latency=None, open_seconds=None):
+        self.name = name
+        self.window = window or float(os.getenv('BREAKER_WINDOW', '60'))
+        self.min_calls = min_calls or int(os.getenv('BREAKER_MIN_CALLS', '10'))
+        self.error_rate = error_rate or float(os.getenv('BREAKER_ERROR_RATE', '0.5'))
+        self.p95_latency = p95_latency or float(os.getenv('BREAKER_P95_LATENCY', '15'))
+        self.open_seconds = open_seconds or float(os.getenv('BREAKER_OPEN_SECONDS', '30'))
+
+        self._lock = threading.Lock()
+        self._samples = deque()   # (時間, 延遲, 是否成功)
+        self._state = CLOSED
+        self._opened_at = 0
+        self._probing = False
+        self.stats = {
+            'calls': 0,
+            'failures': 0,
+            'rejected': 0,
+            'opened': 0
+        }
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def _trim(self, now):
+        while self._samples and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+
+    def _rolling(self):
+        """回傳 (錯誤率, p95 延遲)"""
+        if not self._samples:
+            return 0, 0
+        failures = sum(1 for _, _, ok in self._samples if not ok)
+        latencies = sorted(latency for _, latency, _ in self._samples)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return failures / len(self._samples), p95
+
+    def before_call(self):
+        """呼叫前檢查，不允許時拋出 CircuitOpen"""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.stats['rejected'] += 1
+        raise CircuitOpen(self.name)
+
+    def after_call(self, latency, ok):
+        now = time.monotonic()
+        with self._lock:
+            self.stats['calls'] += 1
+            if not ok:
+                self.stats['failures'] += 1
+
+            state = self._current_state(now)
+            if state == HALF_OPEN:
+                self._probing = False
+                if ok and latency <= self.p95_latency:
+                    self._samples.clear()
+                    self._transition(CLOSED, now)
+                else:
+                    self._transition(OPEN, now)
+                return
+
+            self._samples.append((now, latency, ok))
+            self._trim(now)
+            if state == CLOSED and len(self._samples) >= self.min_calls:
+                error_rate, p95 = self._rolling()
+                if error_rate >= self.error_rate or p95 > self.p95_latency:
+                    self._transition(OPEN, now)
+
+    def release(self):
+        """before_call 之後呼叫沒有結果（見 NOT_COUNTED）時使用，half_open 的探測名額釋出"""
+        with self._lock:
+            self._probing = False
+
+    def _transition(self, state, now):
+        self._state = state
+        if state == OPEN:
+            self._opened_at = now
+            self.stats['opened'] += 1
+        print(f"[breaker] {self.name} -> {state}")
+
+    def call(self, func, *args):
+        self.before_call()
+        start = time.monotonic()
+        try:
+            result = func(*args)
+        except NOT_COUNTED:
+            self.release()
+            raise
+        except BaseException:
+            self.after_call(time.monotonic() - start, False)
+            raise
+        self.after_call(time.monotonic() - start, True)
+        return result
+
+    async def acall(self, func, *args):
+        """call 的非同步版本，func 為 async 函式"""
+        self.before_call()
+        start = time.monotonic()
+        try:
+            result = await func(*args)
+        except NOT_COUNTED:
+            self.release()
+            raise
+        except BaseException:
+            self.after_call(time.monotonic() - start, False)
+            raise
+        self.after_call(time.monotonic() - start, True)
+        return result
+
+    def metrics(self):
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            self._trim(now)
+            error_rate, p95 = self._rolling()
+            return dict(
+                self.stats,
+                state=state,
+                state_code=STATE_CODES[state],
+                error_rate=round(error_rate, 3),
+                p95_latency=round(p95, 3),
+                window_calls=len(self._samples)
+            )
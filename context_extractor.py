@@ -0,0 +1,168 @@
+import json
+from collections import deque
+
+# 各欄位的關鍵字表，順序即優先權（同一訊息命中多個值時取排在前面的）
+DEFAULT_TABLES = {
+    'target': [
+        {
+            'value': '主管',
+            'keywords': ['老闆', '主管', '經理', 'boss'],
+            'fields': {'target_identity': '主管', 'user_identity': '員工'}
+        },
+        {
+            'value': '同事',
+            'keywords': ['同事', '同仁', '小王', '小李'],
+            'fields': {'target_identity': '同事', 'user_identity': '同事'}
+        },
+        {
+            'value': '客戶',
+            'keywords': ['客戶', '客人', '廠商'],
+            'fields': {'target_identity': '客戶', 'user_identity': '業務/客服'}
+        }
+    ],
+    'scenario': [
+        {'value': '請假', 'keywords': ['請假', '休假', '請病假', '請事假'], 'fields': {'context': '請假'}},
+        {'value': '婉拒', 'keywords': ['拒絕', '婉拒', '不想', '不要'], 'fields': {'context': '婉拒邀請或要求'}},
+        {'value': '催促', 'keywords': ['催', '提醒', '進度', '期限'], 'fields': {'context': '催促進度'}},
+        {'value': '道歉', 'keywords': ['道歉', '抱歉', '對不起', '失誤'], 'fields': {'context': '道歉'}},
+        {'value': '感謝', 'keywords': ['感謝', '謝謝', '感恩'], 'fields': {'context': '表達感謝'}}
+    ],
+    'medium': [
+        {'value': 'Email', 'keywords': ['email', 'mail', '郵件', '信件'], 'fields': {'medium': 'Email'}},
+        {'value': '電話', 'keywords': ['電話', '打給', 'call'], 'fields': {'medium': '電話'}},
+        {'value': '面對面', 'keywords': ['面對面', '當面', '見面'], 'fields': {'medium': '面對面'}}
+    ]
+}
+
+class KeywordAutomaton:
+    """Aho-Corasick 自動機，一次掃描找出所有關鍵字出現的位置"""
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self._built = False
+
+    def add(self, keyword, payload):
+        if not keyword:
+            return
+        state = 0
+        for ch in keyword:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][ch] = next_state
+            state = next_state
+        self._output[state].append((len(keyword), keyword, payload))
+        self._built = False
+
+    def build(self):
+        """以 BFS 建立 failure link，並把 failure 路徑上的輸出合併進來"""
+        queue = deque()
+        for next_state in self._goto[0].values():
+            self._fail[next_state] = 0
+            queue.append(next_state)
+
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+        self._built = True
+
+    def find_all(self, text):
+        """回傳 (start, end, keyword, payload)，依出現位置排序"""
+        if not self._built:
+            self.build()
+
+        goto, fail, output = self._goto, self._fail, self._output
+        matches = []
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for length, keyword, payload in output[state]:
+                matches.append((i + 1 - length, i + 1, keyword, payload))
+
+        matches.sort(key=lambda m: (m[0], -(m[1] - m[0])))
+        return matches
+
+class SlotMatch:
+    """一個命中的欄位值與它在訊息中的位置"""
+    __slots__ = ('slot', 'value', 'keyword', 'start', 'end', 'rank', 'fields')
+
+    def __init__(self, slot, value, keyword, start, end, rank, fields):
+        self.slot = slot
+        self.value = value
+        self.keyword = keyword
+        self.start = start
+        self.end = end
+        self.rank = rank
+        self.fields = fields
+
+    def __repr__(self):
+        return f"SlotMatch({self.slot}={self.value!r}, {self.keyword!r}@{self.start})"
+
+class ContextExtractor:
+    """把對象、情境、媒介的關鍵字表編成一個自動機，單次掃描完成萃取"""
+
+    DEFAULTS = {
+        'medium': 'LINE',
+        'culture': '一般',
+        'target_identity': '對方',
+        'user_identity': '我'
+    }
+
+    def __init__(self, tables=None):
+        self.tables = tables or DEFAULT_TABLES
+        self.automaton = KeywordAutomaton()
+        for slot, entries in self.tables.items():
+            for rank, entry in enumerate(entries):
+                for keyword in entry['keywords']:
+                    self.automaton.add(keyword, (slot, rank))
+        self.automaton.build()
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def find_slots(self, message):
+        """列出所有命中的欄位值與位置"""
+        matches = []
+        for start, end, keyword, (slot, rank) in self.automaton.find_all(message):
+            entry = self.tables[slot][rank]
+            matches.append(SlotMatch(slot, entry['value'], keyword, start, end, rank, entry['fields']))
+        return matches
+
+    def resolve(self, matches):
+        """每個欄位取優先權最高的值；同一值則取最早出現、最長的關鍵字"""
+        best = {}
+        for match in matches:
+            current = best.get(match.slot)
+            if current is None or (match.rank, match.start, -match.end) < (current.rank, current.start, -current.end):
+                best[match.slot] = match
+        return best
+
+    def extract(self, message):
+        """從自然語言中提取情境資訊"""
+        context_data = dict(self.DEFAULTS)
+        best = self.resolve(self.find_slots(message))
+
+        for match in best.values():
+            context_data.update(match.fields)
+
+        if 'scenario' not in best:
+            # 使用原始訊息作為情境
+            context_data['context'] = message
+
+        return context_data
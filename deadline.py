@@ -0,0 +1,76 @@
+import os
+import time
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 各階段錯過期限的次數
+_misses = {}
+_misses_lock = threading.Lock()
+
+def deadline_misses():
+    with _misses_lock:
+        return dict(_misses)
+
+def _record_miss(stage):
+    with _misses_lock:
+        _misses[stage] = _misses.get(stage, 0) + 1
+
+class DeadlineExceeded(Exception):
+    """剩下的時間不夠完成這個階段"""
+
+    def __init__(self, stage):
+        super().__init__(f"deadline exceeded at {stage}")
+        self.stage = stage
+
+class Deadline:
+    """一個事件從收到 webhook 到送出回覆的時間預算
+
+    以 LINE 事件的 timestamp 起算，到 reply token 失效為止。
+    各階段用 check() 記錄是否已錯過期限；LLM 以 timeout() 取得剩餘時間作為逾時，
+    並保留 reserve 秒給 Flex 建立與送出回覆。
+    """
+
+    def __init__(self, expires_at, reserve=None):
+        self.expires_at = expires_at
+        self.reserve = reserve if reserve is not None else float(os.getenv('DEADLINE_RESERVE', '1.5'))
+        self._missed = set()
+
+    @classmethod
+    def for_event(cls, event, ttl):
+        timestamp = getattr(event, 'timestamp', None)
+        start = timestamp / 1000 if timestamp else time.time()
+        return cls(start + ttl)
+
+    def remaining(self):
+        return self.expires_at - time.time()
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def _miss(self, stage):
+        # 同一個事件的同一階段只記一次
+        if stage not in self._missed:
+            self._missed.add(stage)
+            _record_miss(stage)
+
+    def check(self, stage):
+        """回傳是否仍在期限內，已錯過時記錄該階段"""
+        if self.expired:
+            self._miss(stage)
+            return False
+        return True
+
+    def timeout(self, stage):
+        """扣掉保留時間後的剩餘秒數，不夠時記錄並拋出 DeadlineExceeded"""
+        remaining = self.remaining() - self.reserve
+        if remaining <= 0:
+            self._miss(stage)
+            raise DeadlineExceeded(stage)
+        return remaining
+
+    def missed(self, stage):
+        """呼叫端自行判斷逾時（例如 LLM 請求逾時）時記錄"""
+        self._miss(stage)
@@ -9,8 +9,11 @@ class FlexMessageBuilder:
     """建立 LINE Flex Message 卡片"""
     
     @staticmethod
-    def create_reply_options_carousel(options):
-        """建立回覆選項的輪播卡片"""
+    def create_reply_options_carousel(options, option_id):
+        """建立回覆選項的輪播卡片
+
+        option_id 為 OptionStore 中這組選項的 ID，postback 只帶 opt=<id>:<index>
+        """
         bubbles = []
         
         for idx, option in enumerate(options):
@@ -68,7 +71,7 @@ class FlexMessageBuilder:
                         ButtonComponent(
                             action=PostbackAction(
                                 label='✏️ 調整語氣',
-                                data=f'action=adjust_tone&index={idx}&style={option["style"]}'
+                                data=f'action=adjust_tone&opt={option_id}:{idx}'
                             ),
                             style='secondary',
                             height='sm',
@@ -211,8 +214,8 @@ class FlexMessageBuilder:
         return FlexSendMessage(alt_text='快速情境選單', contents=bubble)
     
     @staticmethod
-    def create_tone_adjustment_menu(original_text):
-        """建立語氣調整選單"""
+    def create_tone_adjustment_menu(original_text, option_ref):
+        """建立語氣調整選單，option_ref 為原文在 OptionStore 中的 <id>:<index>"""
         bubble = BubbleContainer(
             header=BoxComponent(
                 layout='vertical',
@@ -255,7 +258,7 @@ class FlexMessageBuilder:
                             ButtonComponent(
                                 action=PostbackAction(
                                     label='👔 更正式',
-                                    data=f'tone=formal&text={original_text[:100]}'
+                                    data=f'opt={option_ref}&tone=formal'
                                 ),
                                 style='secondary',
                                 height='sm'
@@ -263,7 +266,7 @@ class FlexMessageBuilder:
                             ButtonComponent(
                                 action=PostbackAction(
                                     label='😊 更輕鬆',
-                                    data=f'tone=casual&text={original_text[:100]}'
+                                    data=f'opt={option_ref}&tone=casual'
                                 ),
                                 style='secondary',
                                 height='sm',
@@ -272,7 +275,7 @@ class FlexMessageBuilder:
                             ButtonComponent(
                                 action=PostbackAction(
                                     label='🤝 更委婉',
-                                    data=f'tone=polite&text={original_text[:100]}'
+                                    data=f'opt={option_ref}&tone=polite'
                                 ),
                                 style='secondary',
                                 height='sm',
@@ -281,7 +284,7 @@ class FlexMessageBuilder:
                             ButtonComponent(
                                 action=PostbackAction(
                                     label='💪 更直接',
-                                    data=f'tone=direct&text={original_text[:100]}'
+                                    data=f'opt={option_ref}&tone=direct'
                                 ),
                                 style='secondary',
                                 height='sm',
@@ -0,0 +1,164 @@
+import json
+from flex_message_builder import FlexMessageBuilder
+
+# 插槽在骨架中的標記，不會出現在一般文字中
+_SLOT = '\x00slot:{}\x00'
+
+def _slot(name):
+    return _SLOT.format(name)
+
+def _split(text):
+    """把含插槽標記的字串拆成 [文字, 插槽名稱, 文字, ...]"""
+    parts = text.split('\x00')
+    pieces = []
+    for i, part in enumerate(parts):
+        if i % 2:
+            pieces.append(part[len('slot:'):])
+        else:
+            pieces.append(part)
+    return pieces
+
+class FlexPayload:
+    """已序列化的 Flex Message
+
+    as_json_dict 與 SDK 的 FlexSendMessage 結果相同，
+    LineBotApi / AsyncLineBotApi 的 reply_message、push_message 可以直接傳入。
+    """
+
+    __slots__ = ('_data',)
+
+    type = 'flex'
+
+    def __init__(self, data):
+        self._data = data
+
+    @property
+    def alt_text(self):
+        return self._data['altText']
+
+    def as_json_dict(self):
+        return self._data
+
+    def as_json_string(self):
+        return json.dumps(self._data, sort_keys=True)
+
+    def __eq__(self, other):
+        return hasattr(other, 'as_json_dict') and self._data == other.as_json_dict()
+
+    def __repr__(self):
+        return f"<FlexPayload {self.as_json_string()}>"
+
+class FlexTemplate:
+    """由 FlexMessageBuilder 的輸出編譯成的 dict 骨架
+
+    骨架中以插槽標記代表動態內容，render 時只複製含插槽的節點，
+    其餘節點在每次輸出之間共用（SDK 序列化時只讀取、不修改）。
+    """
+
+    def __init__(self, skeleton):
+        self.skeleton = skeleton
+        self._render = self._compile(skeleton) or (lambda values: skeleton)
+
+    def render(self, values):
+        return self._render(values)
+
+    def _compile(self, node):
+        """回傳 values -> 節點 的函式；不含插槽的節點回傳 None"""
+        if isinstance(node, str):
+            if '\x00' not in node:
+                return None
+            pieces = _split(node)
+            if len(pieces) == 3 and not pieces[0] and not pieces[2]:
+                name = pieces[1]
+                return lambda values: values[name]
+            literals = pieces[0::2]
+            names = pieces[1::2]
+
+            def fill(values):
+                out = [literals[0]]
+                for name, literal in zip(names, literals[1:]):
+                    out.append(str(values[name]))
+                    out.append(literal)
+                return ''.join(out)
+            return fill
+
+        if isinstance(node, dict):
+            fields = [(key, value, self._compile(value)) for key, value in node.items()]
+            if all(render is None for _, _, render in fields):
+                return None
+            return lambda values: {
+                key: value if render is None else render(values)
+                for key, value, render in fields
+            }
+
+        if isinstance(node, list):
+            items = [(value, self._compile(value)) for value in node]
+            if all(render is None for _, render in items):
+                return None
+            return lambda values: [
+                value if render is None else render(values)
+                for value, render in items
+            ]
+
+        return None
+
+def _replace(node, old, new):
+    """把骨架中等於 old 的字串換成 new"""
+    if isinstance(node, dict):
+        return {key: _replace(value, old, new) for key, value in node.items()}
+    if isinstance(node, list):
+        return [_replace(value, old, new) for value in node]
+    return new if node == old else node
+
+class FlexTemplateBuilder:
+    """與 FlexMessageBuilder 介面相同、輸出相同，但不在每次回覆時建立 SDK 物件樹
+
+    啟動時用 FlexMessageBuilder 產生一次：
+    - 固定內容的訊息（快速情境選單）直接保存序列化結果
+    - 動態卡片（回覆選項、語氣調整、單一回覆）以插槽標記產生骨架，之後只填入文字與 postback
+    """
+
+    def __init__(self, builder=None):
+        builder = builder or FlexMessageBuilder()
+
+        self._quick_scenarios_menu = builder.create_quick_scenarios_menu().as_json_dict()
+
+        option = {
+            'emoji': _slot('emoji'),
+            'title': _slot('title'),
+            'text': _slot('text'),
+            'style': _slot('style')
+        }
+        carousel = builder.create_reply_options_carousel([option], _slot('option_id')).as_json_dict()
+        # 卡片編號由 enumerate 產生，把第一張的編號 0 換成插槽
+        data = f"action=adjust_tone&opt={_slot('option_id')}:0"
+        bubble = _replace(carousel['contents']['contents'][0], data, f"action=adjust_tone&opt={_slot('option_id')}:{_slot('index')}")
+        self._option_bubble = FlexTemplate(bubble)
+        carousel['contents']['contents'] = _slot('bubbles')
+        self._carousel = FlexTemplate(carousel)
+
+        # 原文預覽超過 50 字會截斷，由 create_tone_adjustment_menu 計算後填入；
+        # 標記本身不超過 50 字，不會被截斷
+        tone_menu = builder.create_tone_adjustment_menu(_slot('text'), _slot('ref')).as_json_dict()
+        self._tone_menu = FlexTemplate(_replace(tone_menu, _slot('text'), _slot('preview')))
+
+        self._simple_reply_card = FlexTemplate(
+            builder.create_simple_reply_card(_slot('text'), _slot('title')).as_json_dict()
+        )
+
+    def create_reply_options_carousel(self, options, option_id):
+        bubbles = [
+            self._option_bubble.render(dict(option, index=idx, option_id=option_id))
+            for idx, option in enumerate(options)
+        ]
+        return FlexPayload(self._carousel.render({'bubbles': bubbles}))
+
+    def create_quick_scenarios_menu(self):
+        return FlexPayload(self._quick_scenarios_menu)
+
+    def create_tone_adjustment_menu(self, original_text, option_ref):
+        preview = original_text[:50] + '...' if len(original_text) > 50 else original_text
+        return FlexPayload(self._tone_menu.render({'preview': preview, 'ref': option_ref}))
+
+    def create_simple_reply_card(self, text, title="建議回覆"):
+        return FlexPayload(self._simple_reply_card.render({'text': text, 'title': title}))
@@ -0,0 +1,169 @@
+import os
+import re
+from dotenv import load_dotenv
+from token_counter import count_tokens
+
+load_dotenv()
+
+NO_HISTORY = '無'
+SUMMARY_LABEL = '（較早的對話摘要）'
+
+# 常用的身份稱呼，只出現一次也視為說話者
+KNOWN_SPEAKERS = {'我', '你', '對方', '他', '她', 'me', 'Me', 'ME'}
+
+# LINE 匯出檔：10:23\t王小明\t內容、上午10:23\t王小明\t內容
+_LINE_EXPORT = re.compile(r'^(?:上午|下午)?\s*\d{1,2}:\d{2}(?:\s*[AaPp][Mm])?\t([^\t]{1,30})\t(.*)$')
+# 一般複製貼上：王小明：內容、[10:23] 王小明: 內容
+_SPEAKER_LINE = re.compile(r'^(?:\[?\d{1,2}:\d{2}(?::\d{2})?\]?\s*)?([^\s:：\[\]]{1,20})\s*[:：](?!//)\s*(.*)$')
+# 日期分隔、匯出檔標頭
+_SKIP_LINE = re.compile(
+    r'^(?:\d{4}[/.\-]\d{1,2}[/.\-]\d{1,2}.{0,8}|\[LINE\].*|儲存日期[:：].*|Saved on[:：]?.*)$'
+)
+
+def parse_chat_log(text):
+    """把貼上的對話紀錄切成 [{'speaker': 名稱或 None, 'text': 內容}, ...]
+
+    辨識 LINE 匯出格式與「名稱：內容」格式；「注意：」這類只出現一次的前綴不當作說話者，
+    沒有說話者的行接在前一輪後面。
+    """
+    lines = [line.strip() for line in (text or '').splitlines()]
+    candidates = []
+    counts = {}
+    for line in lines:
+        if not line or _SKIP_LINE.match(line):
+            candidates.append(None)
+            continue
+        match = _LINE_EXPORT.match(line) or _SPEAKER_LINE.match(line)
+        if match:
+            name = match.group(1).strip()
+            counts[name] = counts.get(name, 0) + 1
+            candidates.append((name, match.group(2).strip(), line))
+        else:
+            candidates.append(('', line, line))
+
+    turns = []
+    for candidate in candidates:
+        if candidate is None:
+            continue
+        name, content, line = candidate
+        if name and (counts[name] >= 2 or name in KNOWN_SPEAKERS):
+            turns.append({'speaker': name, 'text': content})
+        elif turns:
+            turns[-1]['text'] = f"{turns[-1]['text']}\n{line}".strip()
+        else:
+            turns.append({'speaker': None, 'text': line})
+    return [turn for turn in turns if turn['text']]
+
+def format_turn(turn):
+    if turn.get('speaker'):
+        return f"{turn['speaker']}：{turn['text']}"
+    return turn['text']
+
+def format_turns(turns):
+    return '\n'.join(format_turn(turn) for turn in turns)
+
+class HistoryStore:
+    """每位用戶的對話紀錄：較舊的部分壓成摘要，只保留最近幾輪原文
+
+    紀錄放在 session 的 history 欄位（{'summary': ..., 'turns': [...]}），跟著事件一起寫回或放棄。
+    turns 是有上限的 ring buffer：超過 HISTORY_MAX_TURNS 輪時，最舊的幾輪併入摘要，
+    只留最近 HISTORY_RECENT_TURNS 輪。摘要每次只處理新移出的部分（舊摘要 + 新內容），
+    summarize 由 ChatProcessor 提供並以內容 hash 快取，同樣的內容只會摘要一次。
+    給 prompt 的 past_conversation = 摘要 + 保留的原文，長度不隨貼上的紀錄增加。
+    """
+
+    def __init__(self, summarize=None, max_turns=None, recent_turns=None, chunk_tokens=None):
+        # summarize(先前摘要, 對話文字) -> 新摘要；None 或失敗時改用擷取式摘要
+        self.summarize = summarize
+        self.max_turns = max_turns or int(os.getenv('HISTORY_MAX_TURNS', '12'))
+        self.recent_turns = min(recent_turns or int(os.getenv('HISTORY_RECENT_TURNS', '6')), self.max_turns)
+        # 單次摘要送出的對話長度，貼上很長的紀錄時分段摘要
+        self.chunk_tokens = chunk_tokens or int(os.getenv('HISTORY_SUMMARY_CHUNK_TOKENS', '1500'))
+        self.max_summary_calls = int(os.getenv('HISTORY_SUMMARY_MAX_CALLS', '3'))
+        self.turn_chars = int(os.getenv('HISTORY_TURN_CHARS', '300'))
+        self.summary_chars = int(os.getenv('HISTORY_SUMMARY_CHARS', '400'))
+        self.stats = {
+            'appended_turns': 0,
+            'summarized_turns': 0,
+            'summary_calls': 0,
+            'summary_fallbacks': 0
+        }
+
+    @staticmethod
+    def load(session):
+        history = session.get('history')
+        if history:
+            return {'summary': history.get('summary', ''), 'turns': list(history.get('turns', []))}
+        return {'summary': '', 'turns': []}
+
+    def append(self, session, text):
+        """把貼上的對話紀錄加入 history，並更新 session 的 past_conversation"""
+        history = self.load(session)
+        if text.strip() != NO_HISTORY:
+            turns = parse_chat_log(text)
+            for turn in turns:
+                if len(turn['text']) > self.turn_chars:
+                    turn['text'] = turn['text'][:self.turn_chars] + '…'
+            history['turns'].extend(turns)
+            self.stats['appended_turns'] += len(turns)
+            self._compact(history)
+
+        session.update(history=history, past_conversation=self.render(history))
+        return history
+
+    def _compact(self, history):
+        turns = history['turns']
+        if len(turns) <= self.max_turns:
+            return
+        evicted = turns[:-self.recent_turns]
+        history['turns'] = turns[-self.recent_turns:]
+        summarize = self.summarize
+        chunks = list(self._chunks(evicted))
+        # 一次貼上很長的紀錄時，只有最後幾段呼叫 LLM，更早的部分用擷取式摘要
+        first_call = len(chunks) - self.max_summary_calls
+        for i, chunk in enumerate(chunks):
+            if summarize is not None and i >= first_call:
+                try:
+                    self.stats['summary_calls'] += 1
+                    result = summarize(history['summary'], format_turns(chunk))
+                    if result:
+                        history['summary'] = result[:self.summary_chars]
+                        continue
+                except Exception as e:
+                    # 額度不足、斷路器開啟或 API 錯誤時不影響收集資料的流程，其餘分段也不再呼叫
+                    print(f"[history] 摘要失敗，改用擷取式摘要: {e}")
+                    summarize = None
+            self.stats['summary_fallbacks'] += 1
+            history['summary'] = self._fallback_summary(history['summary'], chunk)
+        self.stats['summarized_turns'] += len(evicted)
+
+    def _chunks(self, turns):
+        chunk = []
+        size = 0
+        for turn in turns:
+            tokens = count_tokens(format_turn(turn))
+            if chunk and size + tokens > self.chunk_tokens:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(turn)
+            size += tokens
+        if chunk:
+            yield chunk
+
+    def _fallback_summary(self, summary, turns):
+        """每輪只留開頭，保留最新的部分"""
+        lines = [line for line in summary.split('\n') if line] if summary else []
+        lines.extend(format_turn(turn)[:40] for turn in turns)
+        text = '\n'.join(lines)
+        return text[-self.summary_chars:]
+
+    @staticmethod
+    def render(history):
+        """給 prompt 的 past_conversation：摘要 + 最近幾輪原文"""
+        parts = []
+        if history.get('summary'):
+            parts.append(f"{SUMMARY_LABEL}{history['summary']}")
+        if history.get('turns'):
+            parts.append(format_turns(history['turns']))
+        return '\n\n'.join(parts) or NO_HISTORY
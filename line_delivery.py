@@ -0,0 +1,405 @@
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import threading
+import requests
+import aiohttp
+from requests.adapters import HTTPAdapter
+from linebot.exceptions import LineBotApiError
+from linebot.models.error import Error
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LINE_API_ENDPOINT = 'https://api.line.me'
+
+# LINE 一次 reply / push 最多 5 則訊息，multicast 一次最多 500 位用戶
+MAX_MESSAGES = 5
+MAX_RECIPIENTS = 500
+
+# reply 確定沒有送達的錯誤（連不上 LINE）；讀取逾時時可能已送達，不改用 push
+SYNC_NOT_SENT = (requests.ConnectionError, LineBotApiError)
+ASYNC_NOT_SENT = (aiohttp.ClientConnectorError, LineBotApiError) + (
+    (aiohttp.ConnectionTimeoutError,) if hasattr(aiohttp, 'ConnectionTimeoutError') else ()
+)
+
+# 延遲分布的區間上限（毫秒）
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def _chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def _as_list(messages):
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    return list(messages)
+
+class LatencyHistogram:
+    """單一 API 的延遲分布，呼叫端需自行加鎖"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        for i, bound in enumerate(self.buckets):
+            if ms <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+
+    def snapshot(self):
+        labels = [f'le_{bound}ms' for bound in self.buckets] + ['inf']
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count, 1) if self.count else 0,
+            'buckets': dict(zip(labels, self.counts))
+        }
+
+class _LineDeliveryBase:
+    """LINE Messaging API 送出訊息的共用邏輯
+
+    直接以 JSON 呼叫 reply / push / multicast，請求內容與 SDK 的 LineBotApi 相同：
+    - 連線池與 keep-alive，每個行程共用
+    - 5xx 與連線錯誤以 full jitter 指數退避重試；push / multicast 帶 X-Line-Retry-Key 避免重複送出，
+      reply 不重試（reply token 只能用一次，也不接受 retry key），確定沒送達時才改用 push
+    - 超過 5 則的訊息會拆成多次呼叫，reply token 只能用一次，其餘改用 push
+    - defer() 的訊息定期合併送出，相同內容的多位用戶以 multicast 一次送出
+    - 每個 API 各自記錄延遲分布
+    """
+
+    def __init__(self, channel_access_token=None, pool_size=None, timeout=None, connect_timeout=None,
+                 retries=None, backoff=None, defer_interval=None, endpoint=LINE_API_ENDPOINT):
+        token = channel_access_token or os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
+        self.endpoint = endpoint
+        self.headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+        self.pool_size = pool_size or int(os.getenv('LINE_POOL_SIZE', '20'))
+        self.timeout = timeout or float(os.getenv('LINE_API_TIMEOUT', '10'))
+        self.connect_timeout = connect_timeout or float(os.getenv('LINE_CONNECT_TIMEOUT', '3'))
+        self.retries = retries if retries is not None else int(os.getenv('LINE_API_RETRIES', '2'))
+        self.backoff = backoff if backoff is not None else float(os.getenv('LINE_RETRY_BACKOFF', '0.2'))
+        self.defer_interval = defer_interval or float(os.getenv('LINE_DEFER_INTERVAL', '1'))
+
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._deferred = {}   # 訊息內容 -> (訊息, [user_id])
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'failed': 0,
+            'replied': 0,
+            'pushed': 0,
+            'multicast': 0,
+            'reply_fallbacks': 0,
+            'reply_unknown': 0,
+            'deferred': 0
+        }
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def _observe(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def metrics(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                pending_deferred=sum(len(users) for _, users in self._deferred.values()),
+                latency={name: h.snapshot() for name, h in self._histograms.items()}
+            )
+
+    def _delay(self, attempt):
+        # full jitter：避免多個 worker 在同一時間重試
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    @staticmethod
+    def _retryable(status):
+        return status >= 500
+
+    @staticmethod
+    def _error(status, headers, body):
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            payload = {'message': body}
+        return LineBotApiError(
+            status_code=status,
+            headers=dict(headers),
+            request_id=headers.get('X-Line-Request-Id'),
+            accepted_request_id=headers.get('X-Line-Accepted-Request-Id'),
+            error=Error.new_from_json_dict(payload)
+        )
+
+    @staticmethod
+    def _body(key, target, messages):
+        return json.dumps({
+            key: target,
+            'messages': [message.as_json_dict() for message in messages],
+            'notificationDisabled': False
+        })
+
+    def _request_headers(self, retry_key):
+        if retry_key is None:
+            return self.headers
+        return dict(self.headers, **{'X-Line-Retry-Key': retry_key})
+
+    def _plan(self, event, messages, deadline):
+        """回傳 (reply 的訊息, push 的訊息批次)"""
+        messages = _as_list(messages)
+        if deadline is not None and not deadline.check('reply'):
+            return None, _chunks(messages, MAX_MESSAGES)
+        return messages[:MAX_MESSAGES], _chunks(messages[MAX_MESSAGES:], MAX_MESSAGES)
+
+    def defer(self, user_id, messages):
+        """稍後合併送出，適合不急的通知（例如忙碌提示）；同一用戶不同內容的順序不保證"""
+        messages = _as_list(messages)
+        key = json.dumps([message.as_json_dict() for message in messages], sort_keys=True)
+        with self._lock:
+            entry = self._deferred.get(key)
+            if entry is None:
+                entry = self._deferred[key] = (messages, [])
+            if user_id not in entry[1]:
+                entry[1].append(user_id)
+            self.stats['deferred'] += 1
+        self._schedule_flush()
+
+    def _take_deferred(self):
+        with self._lock:
+            pending = list(self._deferred.values())
+            self._deferred.clear()
+        return pending
+
+class LineDelivery(_LineDeliveryBase):
+    """同步模式（Flask + 工作池）使用的 LINE 送出元件"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        # 重試由這裡處理（需要退避與 retry key），adapter 不重試
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._flush_timer = None
+
+    def _post(self, name, path, body, retry_key=None, retries=None):
+        retries = self.retries if retries is None else retries
+        headers = self._request_headers(retry_key)
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            self._count('requests')
+            try:
+                response = self.session.post(
+                    self.endpoint + path, data=body, headers=headers,
+                    timeout=(self.connect_timeout, self.timeout)
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._observe(name, time.monotonic() - start)
+                # 讀取逾時時請求可能已被接受，只有帶 retry key 的請求可以安全重試
+                maybe_sent = not isinstance(e, requests.ConnectionError)
+                if maybe_sent and not retry_key or attempt >= retries:
+                    self._count('failed')
+                    raise
+            else:
+                self._observe(name, time.monotonic() - start)
+                status = response.status_code
+                if 200 <= status < 300 or status == 409 and retry_key:
+                    # 409：相同 retry key 的請求先前已被接受
+                    return
+                if not self._retryable(status) or attempt >= retries:
+                    self._count('failed')
+                    raise self._error(status, response.headers, response.text)
+            self._count('retries')
+            time.sleep(self._delay(attempt))
+            attempt += 1
+
+    def reply(self, reply_token, messages):
+        # 第一次其實已送達時，重試只會因 token 已使用而失敗，再改用 push 就會重複
+        self._post('reply', '/v2/bot/message/reply', self._body('replyToken', reply_token, _as_list(messages)), retries=0)
+        self._count('replied')
+
+    def push(self, user_id, messages):
+        for chunk in _chunks(_as_list(messages), MAX_MESSAGES):
+            self._post('push', '/v2/bot/message/push', self._body('to', user_id, chunk), str(uuid.uuid4()))
+            self._count('pushed')
+
+    def multicast(self, user_ids, messages):
+        """同樣的訊息送給多位用戶"""
+        for users in _chunks(list(user_ids), MAX_RECIPIENTS):
+            for chunk in _chunks(_as_list(messages), MAX_MESSAGES):
+                self._post('multicast', '/v2/bot/message/multicast', self._body('to', users, chunk), str(uuid.uuid4()))
+                self._count('multicast')
+
+    def send(self, event, messages, deadline=None, bulk=False):
+        """回覆事件：期限內用 reply token，超過 5 則或 token 失效時改用 push
+
+        bulk=True 時需要 push 的部分改用 defer 合併送出。
+        """
+        first, rest = self._plan(event, messages, deadline)
+        if first:
+            try:
+                self.reply(event.reply_token, first)
+            except SYNC_NOT_SENT as e:
+                print(f"Reply failed, fallback to push: {e}")
+                self._count('reply_fallbacks')
+                rest = _chunks(first, MAX_MESSAGES) + rest
+            except requests.RequestException as e:
+                # 可能已經送達，改用 push 會重複
+                print(f"Reply result unknown, not pushing again: {e}")
+                self._count('reply_unknown')
+
+        for chunk in rest:
+            if bulk:
+                self.defer(event.source.user_id, chunk)
+            else:
+                self.push(event.source.user_id, chunk)
+
+    def _schedule_flush(self):
+        with self._lock:
+            if self._flush_timer is not None:
+                return
+            self._flush_timer = threading.Timer(self.defer_interval, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        """送出 defer 累積的訊息"""
+        with self._lock:
+            self._flush_timer = None
+        for messages, user_ids in self._take_deferred():
+            try:
+                if len(user_ids) == 1:
+                    self.push(user_ids[0], messages)
+                else:
+                    self.multicast(user_ids, messages)
+            except Exception as e:
+                print(f"[line] 合併送出失敗: {e}")
+
+    def close(self):
+        self.flush()
+        self.session.close()
+
+class AsyncLineDelivery(_LineDeliveryBase):
+    """ASGI 模式使用的 LINE 送出元件，aiohttp session 在第一次送出時於 event loop 中建立"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = None
+        self._flush_task = None
+
+    def _session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=30),
+                timeout=aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout)
+            )
+        return self.session
+
+    async def _post(self, name, path, body, retry_key=None, retries=None):
+        retries = self.retries if retries is None else retries
+        session = self._session()
+        headers = self._request_headers(retry_key)
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            self._count('requests')
+            try:
+                async with session.post(self.endpoint + path, data=body, headers=headers) as response:
+                    status = response.status
+                    text = await response.text()
+                    response_headers = response.headers
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self._observe(name, time.monotonic() - start)
+                if attempt >= retries:
+                    self._count('failed')
+                    raise
+            else:
+                self._observe(name, time.monotonic() - start)
+                if 200 <= status < 300 or status == 409 and retry_key:
+                    return
+                if not self._retryable(status) or attempt >= retries:
+                    self._count('failed')
+                    raise self._error(status, response_headers, text)
+            self._count('retries')
+            await asyncio.sleep(self._delay(attempt))
+            attempt += 1
+
+    async def reply(self, reply_token, messages):
+        await self._post('reply', '/v2/bot/message/reply', self._body('replyToken', reply_token, _as_list(messages)), retries=0)
+        self._count('replied')
+
+    async def push(self, user_id, messages):
+        for chunk in _chunks(_as_list(messages), MAX_MESSAGES):
+            await self._post('push', '/v2/bot/message/push', self._body('to', user_id, chunk), str(uuid.uuid4()))
+            self._count('pushed')
+
+    async def multicast(self, user_ids, messages):
+        for users in _chunks(list(user_ids), MAX_RECIPIENTS):
+            for chunk in _chunks(_as_list(messages), MAX_MESSAGES):
+                await self._post('multicast', '/v2/bot/message/multicast', self._body('to', users, chunk), str(uuid.uuid4()))
+                self._count('multicast')
+
+    async def send(self, event, messages, deadline=None, bulk=False):
+        """LineDelivery.send 的非同步版本"""
+        first, rest = self._plan(event, messages, deadline)
+        if first:
+            try:
+                await self.reply(event.reply_token, first)
+            except ASYNC_NOT_SENT as e:
+                print(f"Reply failed, fallback to push: {e}")
+                self._count('reply_fallbacks')
+                rest = _chunks(first, MAX_MESSAGES) + rest
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Reply result unknown, not pushing again: {e}")
+                self._count('reply_unknown')
+
+        for chunk in rest:
+            if bulk:
+                self.defer(event.source.user_id, chunk)
+            else:
+                await self.push(event.source.user_id, chunk)
+
+    def _schedule_flush(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.defer_interval)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        for messages, user_ids in self._take_deferred():
+            try:
+                if len(user_ids) == 1:
+                    await self.push(user_ids[0], messages)
+                else:
+                    await self.multicast(user_ids, messages)
+            except Exception as e:
+                print(f"[line] 合併送出失敗: {e}")
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        if self.session is not None:
+            await self.session.close()
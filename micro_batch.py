@@ -0,0 +1,192 @@
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def batching_enabled():
+    return os.getenv('LLM_BATCHING', 'false').lower() in ('1', 'true', 'yes')
+
+class _Request:
+    __slots__ = ('params', 'event', 'result', 'error')
+
+    def __init__(self, params):
+        self.params = params
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher:
+    """把多位用戶對同一條 chain 的呼叫收集起來，以 chain.batch / abatch 一次送出
+
+    視窗會隨負載調整：沒有批次在執行時立即送出（閒置時不增加延遲），
+    已有批次在執行時才等待 window 秒或湊滿 max_batch 筆，負載越高批次越大。
+    同時執行的批次數以 max_concurrency 限制。
+    其餘方法（stream 等）直接轉給原本的 chain。
+    """
+
+    def __init__(self, chain, window=None, max_batch=None, max_concurrency=None):
+        self.chain = chain
+        self.window = window if window is not None else int(os.getenv('LLM_BATCH_WINDOW_MS', '20')) / 1000
+        self.max_batch = max_batch or int(os.getenv('LLM_BATCH_MAX_SIZE', '16'))
+        self.max_concurrency = max_concurrency or int(os.getenv('LLM_BATCH_CONCURRENCY', '4'))
+
+        # 同步模式
+        self._cond = threading.Condition()
+        self._pending = []
+        self._inflight = 0
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._executor = None
+        self._thread = None
+
+        # ASGI 模式，綁定第一次呼叫時的 event loop
+        self._loop = None
+        self._apending = []
+        self._ainflight = 0
+        self._awake = None
+        self._asemaphore = None
+        self._tasks = set()
+
+        self.stats = {
+            'requests': 0,
+            'batches': 0,
+            'immediate': 0,
+            'largest_batch': 0
+        }
+
+    def __getattr__(self, name):
+        if name == 'chain':
+            raise AttributeError(name)
+        return getattr(self.chain, name)
+
+    def _record(self, size, waited):
+        self.stats['batches'] += 1
+        if not waited:
+            self.stats['immediate'] += 1
+        self.stats['largest_batch'] = max(self.stats['largest_batch'], size)
+
+    # ---- 同步模式 ----
+
+    def invoke(self, params, config=None):
+        request = _Request(params)
+        with self._cond:
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrency,
+                    thread_name_prefix='llm-batch'
+                )
+                self._thread = threading.Thread(target=self._collect, name='llm-batcher', daemon=True)
+                self._thread.start()
+            self._pending.append(request)
+            self.stats['requests'] += 1
+            self._cond.notify_all()
+
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self):
+        while True:
+            # 批次已達上限時在這裡等，期間進來的請求會累積成更大的批次
+            self._slots.acquire()
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+
+                waited = self._inflight > 0 and len(self._pending) < self.max_batch
+                if waited:
+                    deadline = time.monotonic() + self.window
+                    while len(self._pending) < self.max_batch:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                self._inflight += 1
+                self._record(len(batch), waited)
+
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        try:
+            try:
+                results = self.chain.batch([r.params for r in batch], return_exceptions=True)
+            except Exception as e:
+                results = [e] * len(batch)
+
+            for request, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    request.error = result
+                else:
+                    request.result = result
+                request.event.set()
+        finally:
+            with self._cond:
+                self._inflight -= 1
+            self._slots.release()
+
+    # ---- ASGI 模式 ----
+
+    async def ainvoke(self, params, config=None):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._apending = []
+            self._ainflight = 0
+            self._awake = asyncio.Event()
+            self._asemaphore = asyncio.Semaphore(self.max_concurrency)
+            self._spawn(self._acollect())
+
+        future = loop.create_future()
+        self._apending.append((params, future))
+        self.stats['requests'] += 1
+        self._awake.set()
+        return await future
+
+    def _spawn(self, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _acollect(self):
+        while True:
+            await self._awake.wait()
+            self._awake.clear()
+
+            while self._apending:
+                await self._asemaphore.acquire()
+
+                waited = self._ainflight > 0 and len(self._apending) < self.max_batch
+                if waited:
+                    await asyncio.sleep(self.window)
+
+                batch = self._apending[:self.max_batch]
+                del self._apending[:self.max_batch]
+                self._ainflight += 1
+                self._record(len(batch), waited)
+                self._spawn(self._adispatch(batch))
+
+    async def _adispatch(self, batch):
+        try:
+            try:
+                results = await self.chain.abatch([params for params, _ in batch], return_exceptions=True)
+            except Exception as e:
+                results = [e] * len(batch)
+
+            for (_, future), result in zip(batch, results):
+                # 呼叫端可能已逾時取消
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            self._ainflight -= 1
+            self._asemaphore.release()
@@ -0,0 +1,305 @@
+import os
+import time
+import random
+import threading
+from langchain_openai import ChatOpenAI
+from langchain_core.language_models.chat_models import SimpleChatModel
+from dotenv import load_dotenv
+from circuit_breaker import CircuitBreaker, CircuitOpen, OPEN, NOT_COUNTED
+from micro_batch import MicroBatcher, batching_enabled
+
+load_dotenv()
+
+# 每個 tier 依序列出候選 backend，第一個為首選；預設都只用原本的模型，多個 backend 需以 LLM_TIER_* 開啟
+DEFAULT_TIERS = {
+    'fast': 'gpt-3.5-turbo',
+    'standard': 'gpt-3.5-turbo'
+}
+DEFAULT_TIER = 'standard'
+
+STUB_REPLY = """【選項1-正式委婉】
+您好，這是本機測試用的正式回覆。
+【選項2-平衡適中】
+這是本機測試用的平衡回覆。
+【選項3-輕鬆直接】
+測試用的輕鬆回覆😊"""
+
+class StubChatModel(SimpleChatModel):
+    """本機測試用的 backend：不連網路，等待 delay 秒後回傳固定格式的回覆，可依 error_rate 隨機失敗"""
+
+    delay: float = 0.0
+    error_rate: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return 'stub'
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error_rate and random.random() < self.error_rate:
+            raise RuntimeError('stub backend error')
+        return STUB_REPLY
+
+def build_llm(spec):
+    """依設定字串建立 LLM
+
+    gpt-3.5-turbo                       OpenAI 模型
+    qwen2.5:7b@http://localhost:11434/v1 OpenAI 相容的本機服務（Ollama、vLLM 等）
+    stub、stub:0.5、stub:0.5:0.2          測試用，延遲秒數與錯誤率
+    """
+    if spec == 'stub' or spec.startswith('stub:'):
+        parts = spec.split(':')[1:]
+        return StubChatModel(
+            delay=float(parts[0]) if parts else 0.0,
+            error_rate=float(parts[1]) if len(parts) > 1 else 0.0
+        )
+    model, _, base_url = spec.partition('@')
+    if base_url:
+        return ChatOpenAI(
+            temperature=0.7,
+            model=model,
+            base_url=base_url,
+            timeout=float(os.getenv('LLM_REQUEST_TIMEOUT', '30')),
+            openai_api_key=os.getenv('LLM_LOCAL_API_KEY', 'local')
+        )
+    return ChatOpenAI(
+        temperature=0.7,
+        model=model,
+        # 每次請求（含 client 自動重試的每一次）的上限，逾時被放棄的呼叫也不會佔住執行緒太久
+        timeout=float(os.getenv('LLM_REQUEST_TIMEOUT', '30')),
+        openai_api_key=os.getenv('OPENAI_API_KEY')
+    )
+
+def load_tiers():
+    """LLM_TIER_<名稱>=backend,backend,... 覆寫或新增 tier"""
+    tiers = dict(DEFAULT_TIERS)
+    for key, value in os.environ.items():
+        if key.startswith('LLM_TIER_') and value.strip():
+            tiers[key[len('LLM_TIER_'):].lower()] = value
+    return {
+        tier: [spec.strip() for spec in specs.split(',') if spec.strip()]
+        for tier, specs in tiers.items()
+    }
+
+class Backend:
+    """一個 LLM backend 與它自己的斷路器，各 tier 共用"""
+
+    def __init__(self, spec, llm=None):
+        self.name = spec
+        self.llm = llm or build_llm(spec)
+        self.breaker = CircuitBreaker(f"llm:{spec}")
+
+class Route:
+    """某個 prompt 在某個 backend 上的統計：延遲與錯誤率的 EWMA
+
+    失敗的呼叫以 failure_latency 計入延遲，快速失敗的 backend 不會看起來比較快。
+    """
+
+    def __init__(self, backend, position, alpha, failure_latency):
+        self.backend = backend
+        self.position = position
+        self.alpha = alpha
+        self.failure_latency = failure_latency
+        self.latency = None
+        self.error_rate = 0.0
+        self.chain = None
+        self.stats = {
+            'calls': 0,
+            'errors': 0
+        }
+
+    def record(self, latency, ok):
+        self.stats['calls'] += 1
+        if not ok:
+            self.stats['errors'] += 1
+            latency = max(latency, self.failure_latency)
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+
+    def score(self, error_penalty, primary_bias):
+        """越小越優先；還沒有樣本的 backend 先試"""
+        if self.latency is None:
+            return 0.0
+        return self.latency * (1 + error_penalty * self.error_rate) * (1 + primary_bias * self.position)
+
+class RoutedChain:
+    """prompt | (依延遲挑選的 backend)，介面與一般 chain 相同（invoke、ainvoke、stream）
+
+    每次呼叫依 Route.score 排序候選 backend，跳過斷路器開啟中的，
+    並以 explore 的機率改走其他 backend，變慢後恢復的 backend 才有機會重新取得樣本。
+    只在送出前換 backend（CircuitOpen）；已送出的請求失敗時照常拋出，由呼叫端決定是否重試。
+    """
+
+    def __init__(self, router, entry, routes):
+        self.router = router
+        self.entry = entry
+        self.routes = routes
+
+    def _chain(self, route):
+        if route.chain is None:
+            chain = self.entry.prompt | self.entry.model(route.backend.llm)
+            if batching_enabled():
+                chain = MicroBatcher(chain)
+            route.chain = chain
+        return route.chain
+
+    def _ordered(self):
+        router = self.router
+        with router._lock:
+            routes = sorted(self.routes, key=lambda r: r.score(router.error_penalty, router.primary_bias))
+            if len(routes) > 1 and router.rng.random() < router.explore:
+                routes.insert(0, routes.pop(router.rng.randrange(1, len(routes))))
+        available = [route for route in routes if route.backend.breaker.state != OPEN]
+        return available or routes
+
+    def _select(self):
+        """回傳第一個斷路器允許呼叫的 route，全部開啟時拋出 CircuitOpen"""
+        for route in self._ordered():
+            try:
+                route.backend.breaker.before_call()
+            except CircuitOpen:
+                continue
+            return route
+        self.router.stats['unavailable'] += 1
+        raise CircuitOpen(f"llm:{self.entry.name}")
+
+    def _record(self, route, start, ok):
+        latency = time.monotonic() - start
+        route.backend.breaker.after_call(latency, ok)
+        with self.router._lock:
+            route.record(latency, ok)
+
+    @staticmethod
+    def _release(route):
+        """被取消、超過期限或串流被中斷：不算成功也不算失敗，只放開試探名額"""
+        route.backend.breaker.release()
+
+    def invoke(self, params, config=None):
+        route = self._select()
+        start = time.monotonic()
+        try:
+            result = self._chain(route).invoke(params, config)
+        except NOT_COUNTED:
+            self._release(route)
+            raise
+        except BaseException:
+            self._record(route, start, False)
+            raise
+        self._record(route, start, True)
+        return result
+
+    async def ainvoke(self, params, config=None):
+        route = self._select()
+        start = time.monotonic()
+        try:
+            result = await self._chain(route).ainvoke(params, config)
+        except NOT_COUNTED:
+            self._release(route)
+            raise
+        except BaseException:
+            self._record(route, start, False)
+            raise
+        self._record(route, start, True)
+        return result
+
+    def stream(self, params, config=None):
+        route = self._select()
+        start = time.monotonic()
+        try:
+            for chunk in self._chain(route).stream(params, config):
+                yield chunk
+        except NOT_COUNTED:
+            self._release(route)
+            raise
+        except BaseException:
+            self._record(route, start, False)
+            raise
+        self._record(route, start, True)
+
+class ModelRouter:
+    """依 prompt 的 tier 在多個 LLM backend 之間分配請求
+
+    tier 以 LLM_TIER_FAST、LLM_TIER_STANDARD 設定（逗號分隔的 backend，第一個為首選），
+    每個 prompt 在各 backend 上分別統計延遲與錯誤率（EWMA），變慢或出錯的 backend 流量自動移到其他 backend；
+    每個 backend 另有自己的斷路器，開啟期間不會被選到。
+    單一 backend 的 tier 行為與直接使用該模型相同。
+    """
+
+    def __init__(self, tiers=None, alpha=None, explore=None, error_penalty=None, primary_bias=None, backends=None, rng=None):
+        self.tiers = tiers or load_tiers()
+        self.alpha = alpha or float(os.getenv('LLM_ROUTER_ALPHA', '0.2'))
+        self.explore = explore if explore is not None else float(os.getenv('LLM_ROUTER_EXPLORE', '0.05'))
+        self.error_penalty = error_penalty if error_penalty is not None else float(os.getenv('LLM_ROUTER_ERROR_PENALTY', '4'))
+        # 延遲相近時偏好排在前面的 backend（每往後一位分數多 primary_bias 倍）
+        self.primary_bias = primary_bias if primary_bias is not None else float(os.getenv('LLM_ROUTER_PRIMARY_BIAS', '0.1'))
+        # 失敗的呼叫視為這麼慢（預設與斷路器的 p95 門檻相同）
+        self.failure_latency = float(os.getenv('LLM_ROUTER_FAILURE_LATENCY') or os.getenv('BREAKER_P95_LATENCY', '15'))
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+        # backends：{spec: 已建立的 llm}，測試時可直接傳入
+        backends = backends or {}
+        self.backends = {}
+        for specs in self.tiers.values():
+            for spec in specs:
+                if spec not in self.backends:
+                    self.backends[spec] = Backend(spec, backends.get(spec))
+        self._routes = {}
+        self.stats = {
+            'unavailable': 0
+        }
+
+    def tier_of(self, entry):
+        tier = getattr(entry, 'tier', None) or DEFAULT_TIER
+        return tier if tier in self.tiers else DEFAULT_TIER
+
+    def _routes_for(self, entry):
+        routes = self._routes.get(entry.name)
+        if routes is None:
+            with self._lock:
+                routes = self._routes.get(entry.name)
+                if routes is None:
+                    specs = self.tiers[self.tier_of(entry)]
+                    routes = [Route(self.backends[spec], i, self.alpha, self.failure_latency) for i, spec in enumerate(specs)]
+                    self._routes[entry.name] = routes
+        return routes
+
+    def chain(self, entry):
+        """entry 的 RoutedChain（由 PROMPTS.chain 快取，每個行程只建立一次）"""
+        return RoutedChain(self, entry, self._routes_for(entry))
+
+    def metrics(self):
+        with self._lock:
+            routes = {}
+            for name, entry_routes in self._routes.items():
+                total = sum(route.stats['calls'] for route in entry_routes) or 1
+                routes[name] = {
+                    route.backend.name: dict(
+                        route.stats,
+                        latency=round(route.latency, 3) if route.latency is not None else None,
+                        error_rate=round(route.error_rate, 3),
+                        share=round(route.stats['calls'] / total, 3)
+                    )
+                    for route in entry_routes
+                }
+        return dict(
+            self.stats,
+            tiers=self.tiers,
+            backends={name: backend.breaker.metrics() for name, backend in self.backends.items()},
+            routes=routes
+        )
+
+_default_router = None
+_default_lock = threading.Lock()
+
+def default_router():
+    """行程內共用的 router，各處理器的統計合在一起"""
+    global _default_router
+    if _default_router is None:
+        with _default_lock:
+            if _default_router is None:
+                _default_router = ModelRouter()
+    return _default_router
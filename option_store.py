@@ -0,0 +1,114 @@
+import os
+import re
+import secrets
+import redis
+import redis.asyncio
+from dotenv import load_dotenv
+
+load_dotenv()
+
+_REF_PATTERN = re.compile(r'^([A-Za-z0-9_-]{1,32}):(\d{1,2})$')
+
+def option_ref(option_id, index):
+    """postback 中代表某個選項的短字串：<id>:<index>"""
+    return f"{option_id}:{index}"
+
+def parse_option_ref(ref):
+    """回傳 (option_id, index)，格式不符時回傳 None"""
+    match = _REF_PATTERN.match(ref or '')
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+class OptionStore:
+    """每組回覆選項以短 ID 存在 Redis（list，有 TTL）
+
+    卡片的 postback 只帶 opt=<id>:<index>，處理 postback 時以 LINDEX 讀回完整文字，
+    不必把原文塞進 postback data，也不會被截斷。
+    """
+
+    def __init__(self, redis_client=None, ttl=None):
+        self.redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+        if redis_client is None:
+            redis_client = redis.from_url(self.redis_url, decode_responses=True)
+        self.redis_client = redis_client
+        # 卡片留在聊天室中還可以點，保留時間與 session 相同
+        self.ttl = ttl or int(os.getenv('OPTION_STORE_TTL', str(3600 * 24)))
+        self._async_client = None
+        self.stats = {
+            'saved': 0,
+            'hits': 0,
+            'misses': 0,
+            'redis_errors': 0
+        }
+
+    @property
+    def async_redis_client(self):
+        if self._async_client is None:
+            self._async_client = redis.asyncio.from_url(self.redis_url, decode_responses=True)
+        return self._async_client
+
+    @staticmethod
+    def _key(option_id):
+        return f"opts:{option_id}"
+
+    @staticmethod
+    def new_id():
+        # 6 bytes -> 8 個 URL-safe 字元
+        return secrets.token_urlsafe(6)
+
+    def _save_pipeline(self, client, option_id, texts):
+        pipe = client.pipeline(transaction=False)
+        pipe.rpush(self._key(option_id), *texts)
+        pipe.expire(self._key(option_id), self.ttl)
+        return pipe
+
+    def save(self, texts):
+        """儲存一組選項文字並回傳 ID；Redis 無法使用時仍回傳 ID（之後讀取會找不到）"""
+        option_id = self.new_id()
+        if texts:
+            try:
+                self._save_pipeline(self.redis_client, option_id, texts).execute()
+                self.stats['saved'] += 1
+            except redis.RedisError as e:
+                self.stats['redis_errors'] += 1
+                print(f"[option store] 儲存失敗: {e}")
+        return option_id
+
+    async def asave(self, texts):
+        option_id = self.new_id()
+        if texts:
+            try:
+                await self._save_pipeline(self.async_redis_client, option_id, texts).execute()
+                self.stats['saved'] += 1
+            except redis.RedisError as e:
+                self.stats['redis_errors'] += 1
+                print(f"[option store] 儲存失敗: {e}")
+        return option_id
+
+    def _result(self, text):
+        self.stats['hits' if text is not None else 'misses'] += 1
+        return text
+
+    def get(self, ref):
+        """以 opt=<id>:<index> 取得完整文字，找不到或已過期時回傳 None"""
+        parsed = parse_option_ref(ref)
+        if parsed is None:
+            return self._result(None)
+        option_id, index = parsed
+        try:
+            return self._result(self.redis_client.lindex(self._key(option_id), index))
+        except redis.RedisError:
+            self.stats['redis_errors'] += 1
+            return None
+
+    async def aget(self, ref):
+        parsed = parse_option_ref(ref)
+        if parsed is None:
+            return self._result(None)
+        option_id, index = parsed
+        try:
+            return self._result(await self.async_redis_client.lindex(self._key(option_id), index))
+        except redis.RedisError:
+            self.stats['redis_errors'] += 1
+            return None
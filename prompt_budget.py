@@ -0,0 +1,105 @@
+import os
+import threading
+from dotenv import load_dotenv
+from token_counter import count_tokens, truncate_tokens, count_stats
+from prompt_registry import PROMPTS
+
+load_dotenv()
+
+class PromptBudget:
+    """送出前計算 prompt 的 token 數，超過輸入預算時依 prompt 登記的順序縮短欄位
+
+    每個欄位最多縮到 PROMPT_FIELD_MIN_TOKENS，全部縮完仍超過時照常送出並記錄 over_budget。
+    token 數以 token_counter 的快取計算，同樣的欄位值只會算一次。
+    """
+
+    def __init__(self, registry=None, input_budget=None, field_min_tokens=None):
+        self.registry = registry or PROMPTS
+        self.input_budget = input_budget or int(os.getenv('PROMPT_INPUT_BUDGET', '2000'))
+        self.field_min_tokens = field_min_tokens or int(os.getenv('PROMPT_FIELD_MIN_TOKENS', '32'))
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def _budget(self, entry):
+        return entry.input_budget or self.input_budget
+
+    @staticmethod
+    def measure(entry, params):
+        """prompt 模板 + 參數的 token 數"""
+        return entry.token_count + sum(count_tokens(str(v)) for v in params.values())
+
+    def fit(self, name, params):
+        """回傳預算內的參數（未超過時回傳原本的 dict）"""
+        entry = self.registry.get(name)
+        budget = self._budget(entry)
+        tokens = self.measure(entry, params)
+        trimmed = 0
+
+        if tokens > budget:
+            fitted = dict(params)
+            for field, keep in entry.trim:
+                value = fitted.get(field)
+                if not isinstance(value, str):
+                    continue
+                size = count_tokens(value)
+                limit = max(self.field_min_tokens, size - (tokens - budget))
+                if limit >= size:
+                    continue
+                fitted[field] = self._truncate(value, limit, keep)
+                saved = size - count_tokens(fitted[field])
+                tokens -= saved
+                trimmed += saved
+                if tokens <= budget:
+                    break
+            if trimmed:
+                params = fitted
+
+        self._record(entry, tokens, trimmed, tokens > budget)
+        return params
+
+    @staticmethod
+    def _truncate(value, limit, keep):
+        """縮到 limit 以內；'middle' 保留第一段（空行之前，例如對話摘要）與結尾，刪去中間的原文"""
+        if keep == 'middle':
+            head, sep, rest = value.partition('\n\n')
+            if not sep:
+                return PromptBudget._truncate(value, limit, 'tail')
+            room = limit - count_tokens(head + sep)
+            if room <= 0:
+                return truncate_tokens(head, limit, 'head')
+            rest = PromptBudget._truncate(rest, room, 'tail')
+            return head + sep + rest if rest else head
+        value = truncate_tokens(value, limit, keep)
+        if keep == 'tail' and '\n' in value:
+            # 從完整的一行開始
+            value = value[value.index('\n') + 1:]
+        return value
+
+    def _record(self, entry, tokens, trimmed, over):
+        with self._lock:
+            stats = self.stats.setdefault(entry.tag, {
+                'calls': 0,
+                'input_tokens': 0,
+                'max_input_tokens': 0,
+                'trimmed': 0,
+                'trimmed_tokens': 0,
+                'over_budget': 0,
+                'budget': self._budget(entry),
+                'max_tokens': entry.max_tokens
+            })
+            stats['calls'] += 1
+            stats['input_tokens'] += tokens
+            stats['max_input_tokens'] = max(stats['max_input_tokens'], tokens)
+            if trimmed:
+                stats['trimmed'] += 1
+                stats['trimmed_tokens'] += trimmed
+            if over:
+                stats['over_budget'] += 1
+
+    def metrics(self):
+        with self._lock:
+            prompts = {tag: dict(stats) for tag, stats in self.stats.items()}
+        return {
+            'prompts': prompts,
+            'token_count_cache': dict(count_stats)
+        }
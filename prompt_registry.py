@@ -0,0 +1,259 @@
+import threading
+from langchain.prompts import ChatPromptTemplate
+from token_counter import count_tokens
+from micro_batch import MicroBatcher, batching_enabled
+from model_router import ModelRouter
+
+def compact_template(text):
+    """去掉每行的縮排與行尾空白，連續空行只保留一行"""
+    lines = []
+    for line in text.strip().split('\n'):
+        line = line.strip()
+        if not line and lines and not lines[-1]:
+            continue
+        lines.append(line)
+    return '\n'.join(lines)
+
+class PromptEntry:
+    """已註冊的 prompt：精簡後的文字、token 數與編譯好的模板
+
+    max_tokens 是這個入口預期的輸出長度（送給 OpenAI 的上限，也用於流量預估），
+    trim 是超過輸入預算時依序縮短的欄位：((欄位, 'head'、'tail' 或 'middle'), ...)，
+    'tail' 表示保留結尾（例如最近的對話），'middle' 另外保留第一段（例如過去對話開頭的摘要）。
+    tier 是交給 ModelRouter 時使用的模型等級（'fast' 給短、簡單的工作）。
+    """
+
+    def __init__(self, name, version, template, max_tokens=None, trim=(), input_budget=None, tier='standard'):
+        self.name = name
+        self.version = version
+        self.text = compact_template(template)
+        self._token_count = None
+        self.prompt = ChatPromptTemplate.from_template(self.text)
+        self.max_tokens = max_tokens
+        self.trim = tuple(trim)
+        self.input_budget = input_budget
+        self.tier = tier
+
+    @property
+    def token_count(self):
+        """模板的 token 數，第一次用到時才計算（import 時不載入 tokenizer）"""
+        if self._token_count is None:
+            self._token_count = count_tokens(self.text)
+        return self._token_count
+
+    @property
+    def tag(self):
+        return f"{self.name}@{self.version}"
+
+    def model(self, llm, **kwargs):
+        """綁定這個入口的 max_tokens（與其他呼叫參數，例如 timeout）"""
+        if self.max_tokens:
+            kwargs['max_tokens'] = self.max_tokens
+        return llm.bind(**kwargs) if kwargs else llm
+
+class PromptRegistry:
+    """具名、具版本的 prompt 集中管理，chain 每個行程只建立一次"""
+
+    def __init__(self):
+        self._entries = {}
+        self._chains = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, version, template, max_tokens=None, trim=(), input_budget=None, tier='standard'):
+        entry = PromptEntry(name, version, template, max_tokens, trim, input_budget, tier)
+        self._entries[name] = entry
+        return entry
+
+    def get(self, name):
+        return self._entries[name]
+
+    def names(self):
+        return list(self._entries)
+
+    def chain(self, name, llm):
+        """取得 prompt | llm，同一個 llm 共用同一條 chain
+
+        開啟 LLM_BATCHING 時，chain 外層包上 MicroBatcher，
+        同一條 chain 的並行呼叫會合併成批次送出。
+        llm 為 ModelRouter 時回傳依 tier 與延遲挑選 backend 的 RoutedChain（批次在各 backend 內合併）。
+        """
+        key = (name, id(llm))
+        chain = self._chains.get(key)
+        if chain is None:
+            with self._lock:
+                chain = self._chains.get(key)
+                if chain is None:
+                    entry = self.get(name)
+                    if isinstance(llm, ModelRouter):
+                        chain = llm.chain(entry)
+                    else:
+                        chain = entry.prompt | entry.model(llm)
+                        if batching_enabled():
+                            chain = MicroBatcher(chain)
+                    self._chains[key] = chain
+        return chain
+
+    def build_chains(self, llm, names):
+        """啟動時預先建立需要的 chain"""
+        return {name: self.chain(name, llm) for name in names}
+
+PROMPTS = PromptRegistry()
+
+# 3 個選項 × 30–80 字，加上選項標記
+PROMPTS.register('reply_options', 'v1', """
+你是回覆建議助手。請根據用戶情境，直接提供3個可以複製使用的回覆文字。
+
+情境資訊：
+- 身份：{user_identity}
+- 對象：{target_identity}
+- 情境：{context}
+- 溝通方式：{medium}
+- 公司文化：{culture}
+
+輸出格式要求：
+1. 只提供回覆文字，不要對話過程
+2. 每個選項都是完整、可直接使用的訊息
+3. 不要包含"我："或說話者標籤
+4. 根據溝通方式調整（LINE可用表情、Email要完整）
+
+請提供3個選項：
+
+【選項1-正式委婉】
+[提供30-80字的完整回覆，適合正式場合]
+
+【選項2-平衡適中】
+[提供30-80字的完整回覆，兼顧禮貌與親和]
+
+【選項3-輕鬆直接】
+[提供30-80字的完整回覆，較口語化{emoji_hint}]
+
+注意：
+- 使用繁體中文
+- 符合台灣用語習慣
+- 每個選項都要能直接複製使用
+""", max_tokens=400, trim=(
+    ('context', 'head'), ('culture', 'head'), ('target_identity', 'head'), ('user_identity', 'head')
+))
+
+# 輸出與原文（回覆選項，約 100 字內）差不多長
+PROMPTS.register('adjust_tone', 'v1', """
+請將以下文字調整為{tone}的語氣，保持原意但改變表達方式：
+
+原文：{original}
+
+語氣說明：
+- 更正式：使用敬語、完整句子、避免口語
+- 更輕鬆：加入口語、適度表情符號、親切感
+- 更委婉：間接表達、給對方台階、柔和用詞
+- 更直接：簡潔明瞭、直說重點、減少修飾
+
+調整後（繁體中文）：
+""", max_tokens=300, trim=(('original', 'head'),), tier='fast')
+
+# 3 個版本各約 100 字，加上版本標題
+PROMPTS.register('generate_conversation', 'v1', """
+你是一個台灣對話專家。請根據以下資訊，生成3個可以直接複製使用的回覆訊息。
+
+情境資訊：
+- 我的身份：{user_identity}
+- 對話對象：{target_identity}
+- 對話情境：{context}
+- 過去對話：{past_conversation}
+
+{context_instruction}
+
+重要要求：
+1. 只提供可以直接傳送的訊息內容
+2. 不要包含任何標籤或說明文字
+3. 使用繁體中文與台灣用語
+4. 如果對方有提問，必須具體回答
+5. 符合身份與情境的語氣
+
+請提供3個不同風格的回覆：
+
+✅ 版本1【正式專業】
+（提供一個正式但友善的回覆，適合維持專業形象）
+
+✅ 版本2【平衡友善】
+（提供一個平衡專業與親切的回覆）
+
+✅ 版本3【輕鬆親切】
+（提供一個較輕鬆但仍然得體的回覆）
+
+記住：每個版本都要能直接複製貼上使用！
+""", max_tokens=600, trim=(
+    ('past_conversation', 'middle'), ('context', 'head'), ('target_identity', 'head'), ('user_identity', 'head')
+))
+
+PROMPTS.register('polish_conversation', 'v1', """
+你是一個台灣對話專家。請優化以下草稿，提供3個改進版本。
+
+情境資訊：
+- 我的身份：{user_identity}
+- 對話對象：{target_identity}
+- 對話情境：{context}
+- 過去對話：{past_conversation}
+
+使用者的草稿：
+「{draft}」
+
+請提供3個優化版本，每個都要能直接使用：
+
+✅ 版本1【正式專業】
+（保持專業但加入適當的友善感）
+
+✅ 版本2【平衡友善】
+（平衡專業與親切，最安全的選擇）
+
+✅ 版本3【輕鬆親切】
+（較口語但仍保持禮貌）
+
+優化重點：
+- 保留原意但改善表達
+- 更自然的台灣用語
+- 適當的語氣調整
+""", max_tokens=600, trim=(
+    ('past_conversation', 'middle'), ('context', 'head'), ('target_identity', 'head'),
+    ('user_identity', 'head'), ('draft', 'head')
+))
+
+PROMPTS.register('generate_more', 'v1', """
+請根據相同資訊，再提供3個不同風格的{task_description}版本。
+
+情境資訊：
+- 我的身份：{user_identity}
+- 對話對象：{target_identity}
+- 對話情境：{context}
+- 過去對話：{past_conversation}
+
+這次請嘗試不同的角度：
+
+✅ 版本4【更委婉】
+（用更婉轉的方式表達）
+
+✅ 版本5【更積極】
+（展現更多信心與熱情）
+
+✅ 版本6【更詳細】
+（提供更多具體資訊）
+
+每個版本都要能直接複製使用！
+""", max_tokens=600, trim=(
+    ('past_conversation', 'middle'), ('context', 'head'), ('target_identity', 'head'),
+    ('user_identity', 'head'), ('draft', 'head')
+))
+
+# 摘要限 150 字
+PROMPTS.register('summarize_history', 'v1', """
+請把以下對話整理成摘要，之後會用來撰寫回覆。
+
+先前的摘要：{summary}
+
+新的對話：
+{conversation}
+
+要求：
+- 合併先前的摘要與新的對話，只輸出更新後的摘要
+- 保留雙方身份、對方提出的問題、答應過的事與尚未解決的事項
+- 150 字以內，使用繁體中文
+""", max_tokens=250, trim=(('conversation', 'tail'), ('summary', 'head')), tier='fast')
@@ -0,0 +1,235 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import redis
+import redis.asyncio
+from dotenv import load_dotenv
+from token_counter import count_tokens
+
+load_dotenv()
+
+# 數字越小越先處理
+PRIORITY_INTERACTIVE = 0   # 用戶正在等的語氣調整
+PRIORITY_NORMAL = 1        # 一般回覆生成
+PRIORITY_BULK = 2          # 預測、批次等背景工作
+
+# 每位用戶一個 token bucket，補充與扣除在 Redis 內原子完成
+# KEYS[1]: bucket key
+# ARGV[1]: 每秒補充量, ARGV[2]: 容量, ARGV[3]: 現在時間, ARGV[4]: 本次扣除量, ARGV[5]: key ttl
+_USER_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+local updated = tonumber(redis.call('HGET', KEYS[1], 'updated'))
+if tokens == nil or updated == nil then
+    tokens = capacity
+    updated = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return allowed
+"""
+
+class RateLimitExceeded(Exception):
+    """超過流量限制；scope 為 'user'（單一用戶）或 'global'（整體配額）"""
+
+    def __init__(self, scope):
+        super().__init__(f"rate limit exceeded: {scope}")
+        self.scope = scope
+        # 單一用戶的額度不足只屬於該次呼叫，single-flight 的等待者不應沿用
+        self.per_caller = scope == 'user'
+
+class TokenBucket:
+    """行程內的 token bucket，呼叫端需自行加鎖"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """還要等幾秒才有 amount 個 token"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+class RateLimiter:
+    """OpenAI 呼叫的流量控制
+
+    global：每秒請求數與每分鐘 token 數（行程內，依優先權排隊，最多等 max_wait 秒）
+    user：每位用戶每分鐘可觸發的生成次數（Redis，跨 worker 共用，不排隊直接拒絕）
+    """
+
+    def __init__(self, redis_client=None, rps=None, tpm=None, user_per_minute=None, user_burst=None, max_wait=None):
+        self.redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+        if redis_client is None:
+            redis_client = redis.from_url(self.redis_url, decode_responses=True)
+        self.redis_client = redis_client
+        self._user_bucket = redis_client.register_script(_USER_BUCKET_SCRIPT)
+        self._async_client = None
+        self._async_user_bucket = None
+
+        rps = rps or float(os.getenv('OPENAI_RPS', '10'))
+        tpm = tpm or float(os.getenv('OPENAI_TPM', '90000'))
+        self.requests = TokenBucket(rps, max(rps, 1))
+        self.tokens = TokenBucket(tpm / 60, tpm)
+        self.user_per_minute = user_per_minute or float(os.getenv('USER_RATE_PER_MIN', '6'))
+        self.user_burst = user_burst or float(os.getenv('USER_RATE_BURST', '3'))
+        self.max_wait = max_wait if max_wait is not None else float(os.getenv('RATE_LIMIT_MAX_WAIT', '3'))
+        # prompt 沒有設定 max_tokens 時的預估回覆長度，prompt 長度另外計算
+        self.completion_tokens = int(os.getenv('OPENAI_COMPLETION_TOKENS', '300'))
+
+        self._cond = threading.Condition()
+        self._waiters = []   # [priority, seq, 是否仍在等待]
+        self._seq = itertools.count()
+        self.stats = {
+            'admitted': 0,
+            'queued': 0,
+            'global_limited': 0,
+            'user_limited': 0,
+            'redis_errors': 0
+        }
+
+    @property
+    def async_redis_client(self):
+        if self._async_client is None:
+            self._async_client = redis.asyncio.from_url(self.redis_url, decode_responses=True)
+            self._async_user_bucket = self._async_client.register_script(_USER_BUCKET_SCRIPT)
+        return self._async_client
+
+    def estimate_tokens(self, entry, params):
+        """一次呼叫預估使用的 token：prompt 模板 + 參數 + 預估回覆（該入口的 max_tokens）"""
+        completion = entry.max_tokens or self.completion_tokens
+        return entry.token_count + sum(count_tokens(str(v)) for v in params.values()) + completion
+
+    # ---- 單一用戶 ----
+
+    def _user_args(self, cost):
+        rate = self.user_per_minute / 60
+        # key 在桶子補滿後就可以過期
+        ttl = int(self.user_burst / rate) + 60
+        return [rate, self.user_burst, time.time(), cost, ttl]
+
+    def _user_result(self, allowed):
+        if not allowed:
+            with self._cond:
+                self.stats['user_limited'] += 1
+            raise RateLimitExceeded('user')
+
+    def check_user(self, user_id, cost=1):
+        """扣除用戶的額度，超過時拋出 RateLimitExceeded；Redis 無法使用時放行"""
+        try:
+            allowed = self._user_bucket(keys=[f"ratelimit:user:{user_id}"], args=self._user_args(cost))
+        except redis.RedisError:
+            self.stats['redis_errors'] += 1
+            return
+        self._user_result(allowed)
+
+    async def acheck_user(self, user_id, cost=1):
+        client = self.async_redis_client
+        try:
+            allowed = await self._async_user_bucket(keys=[f"ratelimit:user:{user_id}"], args=self._user_args(cost), client=client)
+        except redis.RedisError:
+            self.stats['redis_errors'] += 1
+            return
+        self._user_result(allowed)
+
+    # ---- 整體配額 ----
+
+    def _enter(self, priority):
+        waiter = [priority, next(self._seq), True]
+        heapq.heappush(self._waiters, waiter)
+        return waiter
+
+    def _leave(self, waiter):
+        waiter[2] = False
+        # 已放棄的等待者留在 heap 中，輪到時再丟掉
+        while self._waiters and not self._waiters[0][2]:
+            heapq.heappop(self._waiters)
+        self._cond.notify_all()
+
+    def _try_admit(self, waiter, tokens):
+        """輪到自己且額度足夠時取得額度並回傳 0，否則回傳建議等待秒數"""
+        now = time.monotonic()
+        wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+        if self._waiters[0] is not waiter:
+            # 前面還有優先權更高或更早的請求
+            return max(wait, 0.01)
+        if wait > 0:
+            return wait
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.stats['admitted'] += 1
+        self._leave(waiter)
+        return 0
+
+    def _give_up(self, waiter):
+        self.stats['global_limited'] += 1
+        self._leave(waiter)
+        raise RateLimitExceeded('global')
+
+    def acquire(self, priority=PRIORITY_NORMAL, tokens=0, timeout=None):
+        """取得一次呼叫的額度，等待超過 timeout 秒時拋出 RateLimitExceeded"""
+        deadline = time.monotonic() + (self.max_wait if timeout is None else timeout)
+        with self._cond:
+            waiter = self._enter(priority)
+            queued = False
+            while True:
+                wait = self._try_admit(waiter, tokens)
+                if not wait:
+                    return
+                if not queued:
+                    self.stats['queued'] += 1
+                    queued = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or wait > remaining and self._waiters[0] is waiter:
+                    # 等到期限也拿不到額度，直接放棄讓用戶盡快收到回覆
+                    self._give_up(waiter)
+                self._cond.wait(min(wait, remaining))
+
+    async def aacquire(self, priority=PRIORITY_NORMAL, tokens=0, timeout=None):
+        """acquire 的非同步版本（ASGI 模式）"""
+        deadline = time.monotonic() + (self.max_wait if timeout is None else timeout)
+        with self._cond:
+            waiter = self._enter(priority)
+        queued = False
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_admit(waiter, tokens)
+                    if not wait:
+                        return
+                    if not queued:
+                        self.stats['queued'] += 1
+                        queued = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or wait > remaining and self._waiters[0] is waiter:
+                        self._give_up(waiter)
+                # 同步等待者由 notify 喚醒，這裡以短間隔輪詢
+                await asyncio.sleep(min(wait, remaining, 0.05))
+        except asyncio.CancelledError:
+            with self._cond:
+                if waiter[2]:
+                    self._leave(waiter)
+            raise
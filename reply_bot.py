@@ -0,0 +1,337 @@
+import asyncio
+from linebot.models import (
+    TextSendMessage, QuickReply, QuickReplyButton, MessageAction
+)
+from rate_limiter import RateLimitExceeded
+from circuit_breaker import CircuitOpen
+from deadline import DeadlineExceeded, deadline_misses
+from reply_generator import examples_to_options
+from model_router import ModelRouter
+
+HELP_TEXT = """💡 ChatThinker 使用說明
+
+我能幫你快速生成合適的回覆文字！
+
+【使用方式】
+1️⃣ 輸入 /start 選擇情境
+2️⃣ 直接描述你的情況
+3️⃣ 獲得3個回覆選項
+
+【範例】
+「幫我回覆老闆，明天要請假」
+「怎麼拒絕同事的飯局邀請」
+「催客戶交文件要怎麼說」
+
+【特色】
+✅ 直接給答案，不囉嗦
+✅ 提供3種語氣選擇
+✅ 一鍵複製使用
+✅ 可調整語氣"""
+
+EXAMPLES_TEXT = """📝 使用範例：
+
+【範例1】
+你：幫我回覆老闆明天請假
+我：[立即顯示3個選項卡片]
+
+【範例2】  
+你：怎麼拒絕加班
+我：[立即顯示3個選項卡片]
+
+【範例3】
+你：催進度要怎麼說比較好
+我：[立即顯示3個選項卡片]
+
+每個卡片都可以：
+- 直接複製使用 📋
+- 調整語氣 ✏️"""
+
+CUSTOM_SCENARIO_TEXT = "請描述你的情況，例如：\n\n「幫我回覆老闆，明天要請假看醫生」\n「怎麼婉拒同事的聚餐邀請」\n「提醒客戶該付款了」"
+
+# 卡片上的選項已過期（OptionStore TTL）或是舊版卡片時的回覆
+EXPIRED_TEXT = "這張卡片已經過期了，請重新描述你的情況 🙏"
+
+# 工作池滿載或排隊逾時時的回覆
+BUSY_TEXT = "目前使用人數較多，請稍後再試一次 🙏"
+
+# 單一用戶短時間內要求太多次生成時的回覆
+USER_LIMIT_TEXT = "你的訊息有點多，休息幾秒再試一次喔 🙏"
+
+# 來不及在回覆期限內完成時的回覆（會改用 push 送出）
+TIMEOUT_TEXT = "這次處理得比較久，請再傳一次訊息試試 🙏"
+
+TONE_LABELS = {
+    'formal': '正式版',
+    'casual': '輕鬆版',
+    'polite': '委婉版',
+    'direct': '直接版'
+}
+
+def collect_metrics(reply_generator, tone_speculator):
+    """兩種模式共用的執行狀態，給 /metrics 使用"""
+    cache = reply_generator.cache
+    semantic_cache = reply_generator.semantic_cache
+    return {
+        'breaker': reply_generator.breaker.metrics(),
+        'rate_limiter': reply_generator.limiter.stats,
+        'cache': cache.stats,
+        'prompts': cache.prompt_stats,
+        'single_flight': cache.single_flight.stats,
+        'tone_speculation': tone_speculator.stats,
+        'deadline_misses': deadline_misses(),
+        'prompt_budget': reply_generator.budget.metrics(),
+        'semantic_cache': semantic_cache.metrics() if semantic_cache is not None else None,
+        'reply_corpus': reply_generator.corpus.metrics(),
+        'llm_usage': reply_generator.usage,
+        'model_router': reply_generator.llm.metrics() if isinstance(reply_generator.llm, ModelRouter) else None
+    }
+
+def parse_postback(data):
+    """postback data 轉成 dict，值中含有 = 也不會出錯"""
+    params = {}
+    for param in (data or '').split('&'):
+        key, sep, value = param.partition('=')
+        if sep:
+            params[key] = value
+    return params
+
+def run_sync(coro):
+    """在同步模式執行 handler coroutine
+
+    SyncBotContext 的方法都不會真的暫停，coroutine 一次 send 就會跑完。
+    """
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    coro.close()
+    raise RuntimeError("handler 在同步模式中等待了非同步操作")
+
+class ReplyBot:
+    """回覆優化版的 handler 邏輯，WSGI 與 ASGI 兩種模式共用
+
+    handler 只透過 ctx 讀寫 session、呼叫 LLM 與回覆訊息：
+    同步模式使用 SyncBotContext，ASGI 模式使用 AsyncBotContext。
+    """
+
+    def __init__(self, flex_builder, context_extractor):
+        self.flex_builder = flex_builder
+        self.context_extractor = context_extractor
+
+    async def handle_message(self, event, ctx):
+        try:
+            await self._handle_message(event, ctx)
+        except (RateLimitExceeded, CircuitOpen) as e:
+            await self._limited(ctx, e)
+        except DeadlineExceeded as e:
+            await self._timed_out(ctx, e)
+
+    async def handle_postback(self, event, ctx):
+        try:
+            await self._handle_postback(event, ctx)
+        except (RateLimitExceeded, CircuitOpen) as e:
+            await self._limited(ctx, e)
+        except DeadlineExceeded as e:
+            await self._timed_out(ctx, e)
+
+    async def _limited(self, ctx, error):
+        """超過流量限制或 LLM 暫停使用時立即回覆，不讓用戶等待"""
+        scope = getattr(error, 'scope', 'breaker')
+        print(f"[rate limit] {scope}: {ctx.user_id[:8]}...")
+        await ctx.reply(TextSendMessage(text=USER_LIMIT_TEXT if scope == 'user' else BUSY_TEXT))
+
+    async def _timed_out(self, ctx, error):
+        """沒有可用的備援結果（例如語氣調整）又超過期限時，請用戶重試"""
+        print(f"[deadline] {error.stage}: {ctx.user_id[:8]}...")
+        await ctx.reply(TextSendMessage(text=TIMEOUT_TEXT))
+
+    async def _handle_message(self, event, ctx):
+        user_message = event.message.text
+        # 在工作池排隊時就已經用完時間的事件
+        ctx.deadline.check('queue')
+
+        # 用戶已經往下走，之前卡片尚未開始的語氣預測就不用做了
+        ctx.cancel_speculation()
+
+        if user_message == '/start' or user_message == '開始':
+            # 顯示快速情境選單
+            flex_message = self.flex_builder.create_quick_scenarios_menu()
+            await ctx.reply(flex_message)
+
+        elif user_message == '/help' or user_message == '說明':
+            quick_reply = QuickReply(items=[
+                QuickReplyButton(action=MessageAction(label="開始使用", text="/start")),
+                QuickReplyButton(action=MessageAction(label="看範例", text="看範例"))
+            ])
+
+            await ctx.reply(TextSendMessage(text=HELP_TEXT, quick_reply=quick_reply))
+
+        elif user_message == '看範例':
+            quick_reply = QuickReply(items=[
+                QuickReplyButton(action=MessageAction(label="馬上試試", text="/start"))
+            ])
+
+            await ctx.reply(TextSendMessage(text=EXAMPLES_TEXT, quick_reply=quick_reply))
+
+        elif user_message == '我要自訂情境':
+            ctx.update(state='custom_scenario')
+
+            quick_reply = QuickReply(items=[
+                QuickReplyButton(action=MessageAction(label="請假", text="幫我寫請假訊息")),
+                QuickReplyButton(action=MessageAction(label="道歉", text="幫我寫道歉訊息")),
+                QuickReplyButton(action=MessageAction(label="拒絕", text="幫我婉拒邀請")),
+                QuickReplyButton(action=MessageAction(label="催促", text="幫我催進度"))
+            ])
+
+            await ctx.reply(TextSendMessage(text=CUSTOM_SCENARIO_TEXT, quick_reply=quick_reply))
+
+        else:
+            # 處理自然語言輸入；回覆庫與快取都未命中、真的呼叫 LLM 時才扣除用戶額度
+            context_data = self.context_extractor.extract(user_message)
+            ctx.deadline.check('extract')
+
+            # 生成回覆選項，超過期限時會是快取或預設範例
+            options = await ctx.generate_reply_options(context_data)
+            await self._send_carousel(ctx, options)
+
+    async def _handle_postback(self, event, ctx):
+        params = parse_postback(event.postback.data)
+        ctx.deadline.check('queue')
+
+        # 快速情境選單的按鈕只帶 scenario=
+        if params.get('action') == 'scenario' or params.get('scenario'):
+            # 快速情境：使用預設範例快速回應，自訂情境才會呼叫 LLM
+            examples = await ctx.generate_quick_scenario_reply(params.get('scenario'))
+            await self._send_carousel(ctx, examples_to_options(examples))
+
+        elif params.get('action') == 'adjust_tone':
+            # 調整語氣：依 opt=<id>:<index> 取得完整文字
+            option_ref = params.get('opt')
+            original_text = await ctx.option_text(option_ref)
+            if original_text is None:
+                await ctx.reply(TextSendMessage(text=EXPIRED_TEXT))
+                return
+            ctx.focus(original_text)
+
+            # 顯示語氣調整選單
+            flex_message = self.flex_builder.create_tone_adjustment_menu(original_text, option_ref)
+            await ctx.reply(flex_message)
+
+        elif params.get('tone'):
+            # 執行語氣調整
+            tone = params.get('tone')
+
+            full_text = await ctx.option_text(params.get('opt'))
+            if full_text is None:
+                await ctx.reply(TextSendMessage(text=EXPIRED_TEXT))
+                return
+
+            # 已預先產生的直接取用，仍在產生中的會等它完成
+            adjusted_text = await ctx.adjust_tone(full_text, tone)
+
+            flex_message = self.flex_builder.create_simple_reply_card(
+                adjusted_text,
+                f"調整後 - {TONE_LABELS.get(tone, '調整版')}"
+            )
+            ctx.deadline.check('flex')
+
+            await ctx.reply(flex_message)
+
+    async def _send_carousel(self, ctx, options):
+        """選項存入 OptionStore 後送出卡片，並在背景預先產生語氣調整"""
+        texts = [option['text'] for option in options]
+        option_id = await ctx.save_options(texts)
+
+        flex_message = self.flex_builder.create_reply_options_carousel(options, option_id)
+        ctx.deadline.check('flex')
+
+        await ctx.reply(flex_message)
+        await ctx.speculate(texts)
+
+class SyncBotContext:
+    """同步模式（Flask + 工作池）的 handler 環境
+
+    deadline 為收到 webhook 時建立的 Deadline，LLM 呼叫與回覆方式都依它決定。
+    """
+
+    def __init__(self, event, session, reply, reply_generator, tone_speculator, option_store, deadline):
+        self.event = event
+        self.session = session
+        self.user_id = session.user_id
+        self._reply = reply
+        self.reply_generator = reply_generator
+        self.tone_speculator = tone_speculator
+        self.option_store = option_store
+        self.deadline = deadline
+
+    async def get(self, field):
+        value = self.session.get(field)
+        self.deadline.check('session')
+        return value
+
+    async def save_options(self, texts):
+        return self.option_store.save(texts)
+
+    async def option_text(self, option_ref):
+        text = self.option_store.get(option_ref)
+        self.deadline.check('session')
+        return text
+
+    def update(self, **fields):
+        self.session.update(**fields)
+
+    async def reply(self, messages):
+        self._reply(self.event, messages, self.deadline)
+
+    async def generate_reply_options(self, context_data):
+        return self.reply_generator.generate_reply_options(context_data, deadline=self.deadline, user_id=self.user_id)
+
+    async def generate_quick_scenario_reply(self, scenario):
+        return self.reply_generator.generate_quick_scenario_reply(scenario, deadline=self.deadline)
+
+    async def adjust_tone(self, text, tone):
+        return self.tone_speculator.adjust_tone(text, tone, deadline=self.deadline, user_id=self.user_id)
+
+    async def speculate(self, texts):
+        self.tone_speculator.schedule(self.user_id, texts)
+
+    def focus(self, text):
+        self.tone_speculator.focus(self.user_id, text)
+
+    def cancel_speculation(self):
+        self.tone_speculator.cancel(self.user_id)
+
+class AsyncBotContext(SyncBotContext):
+    """ASGI 模式的 handler 環境：session、LLM 與 LINE API 都在 event loop 上等待
+
+    session 為 AsyncSessionContext，reply 為 async 函式。
+    """
+
+    async def get(self, field):
+        await self.session.load()
+        self.deadline.check('session')
+        return self.session.get(field)
+
+    async def save_options(self, texts):
+        return await self.option_store.asave(texts)
+
+    async def option_text(self, option_ref):
+        text = await self.option_store.aget(option_ref)
+        self.deadline.check('session')
+        return text
+
+    async def reply(self, messages):
+        await self._reply(self.event, messages, self.deadline)
+
+    async def generate_reply_options(self, context_data):
+        return await self.reply_generator.agenerate_reply_options(context_data, deadline=self.deadline, user_id=self.user_id)
+
+    async def generate_quick_scenario_reply(self, scenario):
+        return await self.reply_generator.agenerate_quick_scenario_reply(scenario, deadline=self.deadline)
+
+    async def adjust_tone(self, text, tone):
+        return await self.tone_speculator.aadjust_tone(text, tone, deadline=self.deadline, user_id=self.user_id)
+
+    async def speculate(self, texts):
+        # 排程時會讀取語氣點選統計（同步 Redis），移到 thread 避免卡住 event loop
+        await asyncio.to_thread(self.tone_speculator.schedule, self.user_id, texts)
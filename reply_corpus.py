@@ -0,0 +1,91 @@
+import os
+import json
+import random
+from dotenv import load_dotenv
+
+load_dotenv()
+
+WILDCARD = '*'
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reply_corpus.json')
+
+class ReplyCorpus:
+    """預先寫好、審過的回覆庫，常見請求不必呼叫 LLM
+
+    reply_corpus.json（有 version）中每一筆 entry 有多組回覆（sets，每組依序為正式、平衡、輕鬆），
+    以 ContextExtractor 萃取出的 (context, target_identity, medium) 為 key 建索引，
+    target_identity 或 medium 可以寫 '*'，查詢時依 完全相符 → 不限對象 → 不限媒介 的順序。
+    entry 也可以帶 scenario，給快速情境選單的按鈕使用。
+    同一個 key 有多組回覆時隨機挑一組，重複詢問不會總是看到同樣的內容。
+
+    檔案只在啟動時讀一次，之後都是 dict 查詢。
+    """
+
+    def __init__(self, data=None, rng=None):
+        data = data or {}
+        self.version = data.get('version')
+        self.rng = rng or random.Random()
+        self._slots = {}
+        self._scenarios = {}
+        for entry in data.get('entries', []):
+            sets = tuple(tuple(replies) for replies in entry['sets'] if replies)
+            if not sets:
+                continue
+            if entry.get('scenario'):
+                self._scenarios[entry['scenario']] = sets
+            if entry.get('context'):
+                key = (entry['context'], entry.get('target_identity', WILDCARD), entry.get('medium', WILDCARD))
+                self._slots[key] = self._slots.get(key, ()) + sets
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'scenario_hits': 0
+        }
+
+    @classmethod
+    def load(cls, path=None):
+        """讀取回覆庫；檔案不存在或格式錯誤時回傳空的回覆庫（全部交給 LLM）"""
+        path = path or os.getenv('REPLY_CORPUS_PATH') or DEFAULT_PATH
+        try:
+            with open(path, encoding='utf-8') as f:
+                corpus = cls(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"[reply corpus] 無法讀取 {path}: {e}")
+            return cls()
+        print(f"[reply corpus] 載入 {path}（版本 {corpus.version}，{len(corpus)} 組情境）")
+        return corpus
+
+    def __len__(self):
+        return len(self._slots) + len(self._scenarios)
+
+    def _candidates(self, context, target, medium):
+        slots = self._slots
+        return (
+            slots.get((context, target, medium))
+            or slots.get((context, WILDCARD, medium))
+            or slots.get((context, target, WILDCARD))
+            or slots.get((context, WILDCARD, WILDCARD))
+        )
+
+    def lookup(self, context_data):
+        """依萃取出的欄位挑一組回覆（3 個文字），沒有對應的回覆時回傳 None"""
+        candidates = self._candidates(
+            context_data.get('context'),
+            context_data.get('target_identity'),
+            context_data.get('medium')
+        )
+        if not candidates:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return list(self.rng.choice(candidates))
+
+    def scenario(self, name):
+        """快速情境選單的回覆，沒有時回傳 None"""
+        candidates = self._scenarios.get(name)
+        if not candidates:
+            return None
+        self.stats['scenario_hits'] += 1
+        return list(self.rng.choice(candidates))
+
+    def metrics(self):
+        return dict(self.stats, version=self.version, size=len(self))
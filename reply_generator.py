@@ -1,62 +1,231 @@
 import os
-from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from dotenv import load_dotenv
+from response_cache import ResponseCache
+from rate_limiter import RateLimiter, RateLimitExceeded, PRIORITY_NORMAL, PRIORITY_INTERACTIVE
+from circuit_breaker import CircuitBreaker, CircuitOpen, NOT_COUNTED
+from deadline import DeadlineExceeded
+from prompt_registry import PROMPTS
+from prompt_budget import PromptBudget
+from semantic_cache import SemanticCache, semantic_cache_enabled
+from reply_corpus import ReplyCorpus
+from token_counter import count_tokens
+from model_router import default_router
 
 load_dotenv()
 
-class ReplyGenerator:
-    """直接生成可用回覆文字的處理器"""
-    
-    def __init__(self):
-        self.llm = ChatOpenAI(
-            temperature=0.7,
-            model="gpt-3.5-turbo",
-            openai_api_key=os.getenv('OPENAI_API_KEY')
-        )
-    
-    def generate_reply_options(self, context_data):
-        """生成3個不同風格的回覆選項"""
-        
-        prompt_template = ChatPromptTemplate.from_template("""
-        你是回覆建議助手。請根據用戶情境，直接提供3個可以複製使用的回覆文字。
-
-        情境資訊：
-        - 身份：{user_identity}
-        - 對象：{target_identity}
-        - 情境：{context}
-        - 溝通方式：{medium}
-        - 公司文化：{culture}
+OPTION_MARKER = '【選項'
 
-        輸出格式要求：
-        1. 只提供回覆文字，不要對話過程
-        2. 每個選項都是完整、可直接使用的訊息
-        3. 不要包含"我："或說話者標籤
-        4. 根據溝通方式調整（LINE可用表情、Email要完整）
+# 預設情境的範例回覆；沒有回覆庫或 LLM 無法使用時從這裡挑最接近的情境
+QUICK_SCENARIOS = {
+    "請假": {
+        "context": "需要請假",
+        "examples": [
+            "老闆早安，明天需要請假一天，家裡有急事要處理",
+            "不好意思，明天想請個假，有些私事需要處理",
+            "老闆，明天有事想請假，會先把工作安排好"
+        ]
+    },
+    "拒絕加班": {
+        "context": "婉拒加班要求",
+        "examples": [
+            "不好意思，今晚已有安排，明天一早我會優先處理",
+            "抱歉，晚上有事走不開，這個我明天第一件處理可以嗎",
+            "今天真的不行，家裡有事😅 明天我早點來趕"
+        ]
+    },
+    "催進度": {
+        "context": "禮貌催促進度",
+        "examples": [
+            "請問之前提到的資料準備好了嗎？需要的話我可以協助",
+            "不好意思提醒一下，那份文件今天需要用到，方便了嗎",
+            "Hi，上次說的東西好了嗎？老闆在問😅"
+        ]
+    },
+    "道歉": {
+        "context": "工作失誤道歉",
+        "examples": [
+            "很抱歉這次的疏失，我會立即修正並避免再次發生",
+            "不好意思，是我的失誤，馬上處理，以後會更注意",
+            "抱歉抱歉，我的錯💦 現在就改"
+        ]
+    }
+}
 
-        請提供3個選項：
+def closest_scenario(text):
+    """挑出與文字共用最多字的預設情境"""
+    chars = set(text or '')
+    return max(
+        QUICK_SCENARIOS,
+        key=lambda name: len(chars & set(name + QUICK_SCENARIOS[name]['context']))
+    )
 
-        【選項1-正式委婉】
-        [提供30-80字的完整回覆，適合正式場合]
+def examples_to_options(examples):
+    """把範例文字轉成回覆選項卡片使用的格式"""
+    options = []
+    styles = ['formal', 'balanced', 'casual']
+    emojis = ['👔', '🤝', '😊']
+    titles = ['正式版', '平衡版', '輕鬆版']
+    
+    for i, example in enumerate(examples[:3]):
+        options.append({
+            'style': styles[i],
+            'emoji': emojis[i],
+            'title': f'選項{i+1}：{titles[i]}',
+            'text': example
+        })
+    return options
 
-        【選項2-平衡適中】
-        [提供30-80字的完整回覆，兼顧禮貌與親和]
+def build_reply_option(section, number):
+    """把「【選項」之後的一段文字轉成選項，格式不符時回傳 None"""
+    if '】' not in section:
+        return None
+    
+    title_end = section.index('】')
+    title = section[:title_end]
+    text = section[title_end+1:].strip()
+    
+    # 清理文字
+    text = text.replace('[', '').replace(']', '')
+    text = text.split('\n')[0].strip()  # 只取第一行
+    
+    # 判斷風格
+    if '正式' in title or '委婉' in title:
+        style = 'formal'
+        emoji = '👔'
+    elif '平衡' in title or '適中' in title:
+        style = 'balanced'
+        emoji = '🤝'
+    else:
+        style = 'casual'
+        emoji = '😊'
+    
+    return {
+        'style': style,
+        'emoji': emoji,
+        'title': f"選項{number}：{title.strip('-')}",
+        'text': text
+    }
 
-        【選項3-輕鬆直接】
-        [提供30-80字的完整回覆，較口語化{emoji_hint}]
+def fallback_reply_option(content):
+    """解析不出任何選項時的預設選項"""
+    return {
+        'style': 'formal',
+        'emoji': '👔',
+        'title': '選項1：正式版',
+        'text': content.strip()[:100]
+    }
 
-        注意：
-        - 使用繁體中文
-        - 符合台灣用語習慣
-        - 每個選項都要能直接複製使用
-        """)
+class ReplyOptionStream:
+    """逐段接收 LLM 輸出，每個【選項N-…】區塊一完成就回傳該選項
+    
+    選項只取第一行文字（與 _parse_reply_options 相同），
+    所以讀到該行的換行或下一個標記時即視為完成。
+    """
+    
+    def __init__(self):
+        self.buffer = ''
+        self.options = []
+        self._start = None  # 目前區塊在 buffer 中的起點（標記之後）
+        self._scan = 0      # 下次搜尋標記的起點
+    
+    def feed(self, chunk):
+        """加入一段輸出，回傳這段輸出中完成的選項"""
+        self.buffer += chunk
+        completed = []
+        
+        while True:
+            if self._start is None:
+                index = self.buffer.find(OPTION_MARKER, self._scan)
+                if index < 0:
+                    # 保留可能被切斷的標記開頭，下次再找
+                    self._scan = max(self._scan, len(self.buffer) - len(OPTION_MARKER) + 1)
+                    break
+                self._start = index + len(OPTION_MARKER)
+            
+            end = self._section_end()
+            if end is None:
+                break
+            
+            self._emit(self.buffer[self._start:end], completed)
+            self._start = None
+            self._scan = end
+        
+        return completed
+    
+    def close(self):
+        """輸出結束，回傳最後一個區塊（若有）；整段都解析不出來時回傳預設選項"""
+        completed = []
+        if self._start is not None:
+            self._emit(self.buffer[self._start:], completed)
+            self._start = None
+        
+        if not self.options:
+            option = fallback_reply_option(self.buffer)
+            self.options.append(option)
+            completed.append(option)
+        
+        return completed
+    
+    def _section_end(self):
+        """目前區塊已完成時回傳結束位置，否則回傳 None"""
+        next_marker = self.buffer.find(OPTION_MARKER, self._start)
+        limit = next_marker if next_marker >= 0 else len(self.buffer)
+        
+        title_end = self.buffer.find('】', self._start, limit)
+        if title_end >= 0:
+            body = self.buffer[title_end+1:limit]
+            text = body.lstrip()
+            if text and '\n' in text:
+                return limit - len(text) + text.index('\n')
         
+        return next_marker if next_marker >= 0 else None
+    
+    def _emit(self, section, completed):
+        option = build_reply_option(section, len(self.options) + 1)
+        if option:
+            self.options.append(option)
+            completed.append(option)
+
+class ReplyGenerator:
+    """直接生成可用回覆文字的處理器"""
+    
+    def __init__(self, cache=None, limiter=None, breaker=None, budget=None, semantic_cache=None, corpus=None, router=None):
+        # 依 prompt 的 tier 與各 backend 的延遲挑選模型
+        self.llm = router or default_router()
+        self.cache = cache or ResponseCache()
+        self.limiter = limiter or RateLimiter(self.cache.redis_client)
+        # OpenAI 變慢或出錯時暫停呼叫，回覆選項改用預設情境的範例
+        self.breaker = breaker or CircuitBreaker('openai')
+        self.budget = budget or PromptBudget()
+        # 精確快取沒命中時，意思相近的舊請求直接沿用結果
+        self.semantic_cache = semantic_cache or (SemanticCache() if semantic_cache_enabled() else None)
+        # 常見的 (情境, 對象, 媒介) 直接使用審過的回覆，不呼叫 LLM
+        self.corpus = corpus if corpus is not None else ReplyCorpus.load()
+        self.chains = PROMPTS.build_chains(self.llm, ['reply_options', 'adjust_tone'])
+        # 有期限的同步呼叫在這裡執行，呼叫端最多等到期限為止
+        # （OpenAI client 會自動重試逾時的請求，只設 timeout 時一次呼叫可能花上數倍的剩餘時間）
+        # 執行中 + 排隊中的數量有上限：逾時被放棄的請求仍會跑完，不能讓它們無限累積
+        deadline_workers = int(os.getenv('LLM_DEADLINE_WORKERS', '16'))
+        self._deadline_pool = ThreadPoolExecutor(max_workers=deadline_workers, thread_name_prefix='llm-deadline')
+        self._deadline_slots = threading.BoundedSemaphore(
+            deadline_workers + int(os.getenv('LLM_DEADLINE_QUEUE_SIZE', '16'))
+        )
+        # 實際送出的 LLM 呼叫用量；API 沒有回傳 usage 時以 token_counter 估算
+        self.usage = {
+            'calls': 0,
+            'prompt_tokens': 0,
+            'completion_tokens': 0
+        }
+    
+    def _reply_option_params(self, context_data):
         # 根據媒介決定是否使用表情
         emoji_hint = "，可適度使用表情符號" if context_data.get('medium') == 'LINE' else ""
         
-        chain = prompt_template | self.llm
-        
-        params = {
+        return {
             'user_identity': context_data.get('user_identity', '一般員工'),
             'target_identity': context_data.get('target_identity', '主管'),
             'context': context_data.get('context', ''),
@@ -64,125 +233,321 @@ class ReplyGenerator:
             'culture': context_data.get('culture', '一般'),
             'emoji_hint': emoji_hint
         }
+    
+    def _corpus_options(self, context_data):
+        replies = self.corpus.lookup(context_data)
+        return examples_to_options(replies) if replies is not None else None
+    
+    def _semantic_key(self, params):
+        # 只有情境描述做模糊比對，身份、溝通方式等其他參數必須相同
+        exact = {k: v for k, v in params.items() if k != 'context'}
+        group = self.semantic_cache.group_of('reply_options', PROMPTS.get('reply_options').version, exact)
+        return group, params['context']
+    
+    def _semantic_get(self, params, use_cache):
+        if not use_cache or self.semantic_cache is None:
+            return None
+        hit = self.semantic_cache.lookup(*self._semantic_key(params))
+        return hit[0] if hit is not None else None
+    
+    def _semantic_put(self, params, options, use_cache):
+        if use_cache and self.semantic_cache is not None:
+            group, text = self._semantic_key(params)
+            self.semantic_cache.add(group, text, options)
+    
+    def _prepare(self, name, params):
+        """送出前縮到輸入預算內，回傳 (參數, 預估 token)"""
+        params = self.budget.fit(name, params)
+        return params, self.limiter.estimate_tokens(PROMPTS.get(name), params)
+    
+    @staticmethod
+    def _check_budget(deadline):
+        # 時間已經不夠就不佔用配額，也不計入斷路器
+        if deadline is not None:
+            deadline.timeout('llm')
+    
+    def _record_usage(self, name, params, content, usage=None):
+        usage = usage or {}
+        self.usage['calls'] += 1
+        self.usage['prompt_tokens'] += usage.get('input_tokens') or self.budget.measure(PROMPTS.get(name), params)
+        self.usage['completion_tokens'] += usage.get('output_tokens') or count_tokens(content)
+    
+    def _invoke(self, name, params, deadline):
+        """呼叫共用的 chain（可參與批次合併）；有期限時最多等到剩餘時間用完"""
+        if deadline is None:
+            result = self.chains[name].invoke(params)
+        else:
+            timeout = deadline.timeout('llm')
+            future = self._submit_with_deadline(self.chains[name].invoke, params)
+            try:
+                result = future.result(timeout=timeout)
+            except FutureTimeout:
+                # 已送出的請求無法中止，結果直接丟棄
+                future.cancel()
+                deadline.missed('llm')
+                raise DeadlineExceeded('llm')
+            except Exception:
+                if deadline.remaining() <= deadline.reserve:
+                    deadline.missed('llm')
+                    raise DeadlineExceeded('llm')
+                raise
+        self._record_usage(name, params, result.content, getattr(result, 'usage_metadata', None))
+        return result
+    
+    def _submit_with_deadline(self, func, params):
+        """排入有期限呼叫的執行緒池；已滿（大多是逾時後仍在跑的請求）時視為等不到結果"""
+        if not self._deadline_slots.acquire(blocking=False):
+            print("[reply] 有期限的 LLM 呼叫已滿，不再送出")
+            raise DeadlineExceeded('llm')
+        try:
+            future = self._deadline_pool.submit(func, params)
+        except RuntimeError:
+            self._deadline_slots.release()
+            raise
+        future.add_done_callback(lambda _: self._deadline_slots.release())
+        return future
+    
+    async def _ainvoke(self, name, params, deadline):
+        """_invoke 的非同步版本，超過剩餘時間就取消請求"""
+        if deadline is None:
+            result = await self.chains[name].ainvoke(params)
+        else:
+            try:
+                result = await asyncio.wait_for(self.chains[name].ainvoke(params), deadline.timeout('llm'))
+            except asyncio.TimeoutError:
+                deadline.missed('llm')
+                raise DeadlineExceeded('llm')
+        self._record_usage(name, params, result.content, getattr(result, 'usage_metadata', None))
+        return result
+    
+    def generate_reply_options(self, context_data, use_cache=True, priority=PRIORITY_NORMAL, deadline=None, fallback=True, user_id=None):
+        """生成3個不同風格的回覆選項
+        
+        回覆庫有對應的情境時直接使用；LLM 失敗、暫停使用或超過 deadline 時改用預設情境的範例
+        （fallback=False 時改為拋出例外，例如離線批次生成不應把範例當成結果）。
+        有 user_id 時，只在回覆庫與快取都未命中、真的要呼叫 LLM 前才扣除該用戶的額度。
+        """
+        options = self._corpus_options(context_data)
+        if options is not None:
+            return options
+        
+        params = self._reply_option_params(context_data)
+        
+        def compute():
+            similar = self._semantic_get(params, use_cache)
+            if similar is not None:
+                return similar
+            self._check_budget(deadline)
+            if user_id:
+                self.limiter.check_user(user_id)
+            fitted, tokens = self._prepare('reply_options', params)
+            self.limiter.acquire(priority, tokens)
+            result = self.breaker.call(self._invoke, 'reply_options', fitted, deadline)
+            options = self._parse_reply_options(result.content)
+            self._semantic_put(params, options, use_cache)
+            return options
         
-        result = chain.invoke(params)
-        return self._parse_reply_options(result.content)
+        try:
+            return self.cache.get_or_compute(
+                'reply_options', PROMPTS.get('reply_options').version,
+                params, compute, use_cache=use_cache, deadline=deadline
+            )
+        except RateLimitExceeded:
+            raise
+        except Exception as e:
+            if not fallback:
+                raise
+            return self.fallback_reply_options(context_data, e)
+    
+    async def agenerate_reply_options(self, context_data, use_cache=True, priority=PRIORITY_NORMAL, deadline=None, fallback=True, user_id=None):
+        """generate_reply_options 的非同步版本（ASGI 模式）"""
+        options = self._corpus_options(context_data)
+        if options is not None:
+            return options
+        
+        params = self._reply_option_params(context_data)
+        
+        async def compute():
+            similar = self._semantic_get(params, use_cache)
+            if similar is not None:
+                return similar
+            self._check_budget(deadline)
+            if user_id:
+                await self.limiter.acheck_user(user_id)
+            fitted, tokens = self._prepare('reply_options', params)
+            await self.limiter.aacquire(priority, tokens)
+            result = await self.breaker.acall(self._ainvoke, 'reply_options', fitted, deadline)
+            options = self._parse_reply_options(result.content)
+            self._semantic_put(params, options, use_cache)
+            return options
+        
+        try:
+            return await self.cache.aget_or_compute(
+                'reply_options', PROMPTS.get('reply_options').version,
+                params, compute, use_cache=use_cache, deadline=deadline
+            )
+        except RateLimitExceeded:
+            raise
+        except Exception as e:
+            if not fallback:
+                raise
+            return self.fallback_reply_options(context_data, e)
+    
+    def fallback_reply_options(self, context_data, error=None):
+        """LLM 無法使用時，改用最接近的預設情境範例（不寫入快取）"""
+        if not isinstance(error, (CircuitOpen, DeadlineExceeded)):
+            print(f"Error generating reply options: {error}")
+        scenario = closest_scenario(context_data.get('context', ''))
+        return examples_to_options(QUICK_SCENARIOS[scenario]['examples'])
+    
+    def stream_reply_options(self, context_data, use_cache=True):
+        """串流版的 generate_reply_options，每個選項完成就 yield 出來"""
+        options = self._corpus_options(context_data)
+        if options is not None:
+            yield from options
+            return
+        
+        params = self._reply_option_params(context_data)
+        version = PROMPTS.get('reply_options').version
+        key = self.cache.make_key('reply_options', version, params)
+        
+        if use_cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                yield from cached
+                return
+        
+        similar = self._semantic_get(params, use_cache)
+        if similar is not None:
+            yield from similar
+            if use_cache:
+                self.cache.set(key, similar)
+            return
+        
+        fitted, tokens = self._prepare('reply_options', params)
+        try:
+            self.breaker.before_call()
+        except CircuitOpen as e:
+            # 斷路器開啟時不佔用配額
+            yield from self.fallback_reply_options(context_data, e)
+            return
+        try:
+            self.limiter.acquire(PRIORITY_NORMAL, tokens)
+        except BaseException:
+            self.breaker.release()
+            raise
+        
+        stream = ReplyOptionStream()
+        start = time.monotonic()
+        try:
+            for chunk in self.chains['reply_options'].stream(fitted):
+                yield from stream.feed(chunk.content)
+        except NOT_COUNTED:
+            # 用戶端中途斷線（GeneratorExit）與 OpenAI 是否正常無關
+            self.breaker.release()
+            raise
+        except BaseException:
+            self.breaker.after_call(time.monotonic() - start, False)
+            raise
+        self.breaker.after_call(time.monotonic() - start, True)
+        self._record_usage('reply_options', fitted, stream.buffer)
+        yield from stream.close()
+        
+        if use_cache:
+            self.cache.set(key, stream.options)
+        self._semantic_put(params, stream.options, use_cache)
     
     def _parse_reply_options(self, content):
         """解析生成的回覆選項"""
         options = []
         
         # 分割選項
-        sections = content.split('【選項')
+        sections = content.split(OPTION_MARKER)
         
         for section in sections[1:]:  # 跳過第一個空白部分
-            if '】' in section:
-                title_end = section.index('】')
-                title = section[:title_end]
-                text = section[title_end+1:].strip()
-                
-                # 清理文字
-                text = text.replace('[', '').replace(']', '')
-                text = text.split('\n')[0].strip()  # 只取第一行
-                
-                # 判斷風格
-                if '正式' in title or '委婉' in title:
-                    style = 'formal'
-                    emoji = '👔'
-                elif '平衡' in title or '適中' in title:
-                    style = 'balanced'
-                    emoji = '🤝'
-                else:
-                    style = 'casual'
-                    emoji = '😊'
-                
-                options.append({
-                    'style': style,
-                    'emoji': emoji,
-                    'title': f"選項{len(options)+1}：{title.strip('-')}",
-                    'text': text
-                })
+            option = build_reply_option(section, len(options) + 1)
+            if option:
+                options.append(option)
         
         # 如果解析失敗，返回預設選項
         if not options:
-            options = [
-                {
-                    'style': 'formal',
-                    'emoji': '👔',
-                    'title': '選項1：正式版',
-                    'text': content.strip()[:100]
-                }
-            ]
+            options = [fallback_reply_option(content)]
         
         return options
     
-    def generate_quick_scenario_reply(self, scenario):
+    def generate_quick_scenario_reply(self, scenario, deadline=None):
         """針對快速情境生成回覆"""
+        examples = self._quick_scenario_examples(scenario)
+        if examples is not None:
+            return examples
         
-        quick_scenarios = {
-            "請假": {
-                "context": "需要請假",
-                "examples": [
-                    "老闆早安，明天需要請假一天，家裡有急事要處理",
-                    "不好意思，明天想請個假，有些私事需要處理",
-                    "老闆，明天有事想請假，會先把工作安排好"
-                ]
-            },
-            "拒絕加班": {
-                "context": "婉拒加班要求",
-                "examples": [
-                    "不好意思，今晚已有安排，明天一早我會優先處理",
-                    "抱歉，晚上有事走不開，這個我明天第一件處理可以嗎",
-                    "今天真的不行，家裡有事😅 明天我早點來趕"
-                ]
-            },
-            "催進度": {
-                "context": "禮貌催促進度",
-                "examples": [
-                    "請問之前提到的資料準備好了嗎？需要的話我可以協助",
-                    "不好意思提醒一下，那份文件今天需要用到，方便了嗎",
-                    "Hi，上次說的東西好了嗎？老闆在問😅"
-                ]
-            },
-            "道歉": {
-                "context": "工作失誤道歉",
-                "examples": [
-                    "很抱歉這次的疏失，我會立即修正並避免再次發生",
-                    "不好意思，是我的失誤，馬上處理，以後會更注意",
-                    "抱歉抱歉，我的錯💦 現在就改"
-                ]
-            }
+        # 使用 AI 生成
+        options = self.generate_reply_options(self._quick_scenario_context(scenario), deadline=deadline)
+        return [opt['text'] for opt in options]
+    
+    async def agenerate_quick_scenario_reply(self, scenario, deadline=None):
+        """generate_quick_scenario_reply 的非同步版本（ASGI 模式）"""
+        examples = self._quick_scenario_examples(scenario)
+        if examples is not None:
+            return examples
+        
+        options = await self.agenerate_reply_options(self._quick_scenario_context(scenario), deadline=deadline)
+        return [opt['text'] for opt in options]
+    
+    @staticmethod
+    def _quick_scenario_context(scenario):
+        return {
+            'context': scenario,
+            'medium': 'LINE',
+            'culture': '一般'
         }
+    
+    def _quick_scenario_examples(self, scenario):
+        """預設情境的範例回覆（優先使用回覆庫），不在預設情境中時回傳 None"""
+        examples = self.corpus.scenario(scenario)
+        if examples is not None:
+            return examples
+        if scenario in QUICK_SCENARIOS:
+            return QUICK_SCENARIOS[scenario]["examples"]
+        return None
+    
+    def adjust_tone(self, original_text, new_tone, use_cache=True, priority=PRIORITY_INTERACTIVE, deadline=None, user_id=None):
+        """調整既有文字的語氣（預先產生的結果命中快取時不扣用戶額度）"""
+        params = self._adjust_tone_params(original_text, new_tone)
         
-        if scenario in quick_scenarios:
-            return quick_scenarios[scenario]["examples"]
-        else:
-            # 使用 AI 生成
-            context_data = {
-                'context': scenario,
-                'medium': 'LINE',
-                'culture': '一般'
-            }
-            options = self.generate_reply_options(context_data)
-            return [opt['text'] for opt in options]
-    
-    def adjust_tone(self, original_text, new_tone):
-        """調整既有文字的語氣"""
-        
-        prompt_template = ChatPromptTemplate.from_template("""
-        請將以下文字調整為{tone}的語氣，保持原意但改變表達方式：
-
-        原文：{original}
-
-        語氣說明：
-        - 更正式：使用敬語、完整句子、避免口語
-        - 更輕鬆：加入口語、適度表情符號、親切感
-        - 更委婉：間接表達、給對方台階、柔和用詞
-        - 更直接：簡潔明瞭、直說重點、減少修飾
-
-        調整後（繁體中文）：
-        """)
+        def compute():
+            self._check_budget(deadline)
+            if user_id:
+                self.limiter.check_user(user_id)
+            fitted, tokens = self._prepare('adjust_tone', params)
+            self.limiter.acquire(priority, tokens)
+            result = self.breaker.call(self._invoke, 'adjust_tone', fitted, deadline)
+            return result.content.strip()
+        
+        return self.cache.get_or_compute(
+            'adjust_tone', PROMPTS.get('adjust_tone').version,
+            params, compute, use_cache=use_cache, deadline=deadline
+        )
+    
+    async def aadjust_tone(self, original_text, new_tone, use_cache=True, priority=PRIORITY_INTERACTIVE, deadline=None, user_id=None):
+        """adjust_tone 的非同步版本（ASGI 模式）"""
+        params = self._adjust_tone_params(original_text, new_tone)
+        
+        async def compute():
+            self._check_budget(deadline)
+            if user_id:
+                await self.limiter.acheck_user(user_id)
+            fitted, tokens = self._prepare('adjust_tone', params)
+            await self.limiter.aacquire(priority, tokens)
+            result = await self.breaker.acall(self._ainvoke, 'adjust_tone', fitted, deadline)
+            return result.content.strip()
         
+        return await self.cache.aget_or_compute(
+            'adjust_tone', PROMPTS.get('adjust_tone').version,
+            params, compute, use_cache=use_cache, deadline=deadline
+        )
+    
+    def _adjust_tone_params(self, original_text, new_tone):
         tone_map = {
             'formal': '更正式',
             'casual': '更輕鬆',
@@ -190,10 +555,7 @@ class ReplyGenerator:
             'direct': '更直接'
         }
         
-        chain = prompt_template | self.llm
-        result = chain.invoke({
+        return {
             'original': original_text,
             'tone': tone_map.get(new_tone, '更平衡')
-        })
-        
-        return result.content.strip()
\ No newline at end of file
+        }
\ No newline at end of file
@@ -0,0 +1,186 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+import redis
+import redis.asyncio
+from dotenv import load_dotenv
+from single_flight import SingleFlight
+
+load_dotenv()
+
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_text(text):
+    """全形轉半形、合併空白，讓幾乎相同的輸入對應到同一個 key"""
+    text = unicodedata.normalize('NFKC', str(text))
+    return _WHITESPACE.sub(' ', text).strip()
+
+class ResponseCache:
+    """LLM 回應快取：行程內 LRU 在前，Redis 在後"""
+
+    def __init__(self, redis_client=None, max_entries=None, local_ttl=None, redis_ttl=None, prefix='llmcache', single_flight=None):
+        self.redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+        if redis_client is None:
+            redis_client = redis.from_url(self.redis_url, decode_responses=True)
+        self.redis_client = redis_client
+        # ASGI 模式使用的 redis.asyncio client，第一次用到時才建立
+        self._async_client = None
+        self.max_entries = max_entries or int(os.getenv('RESPONSE_CACHE_SIZE', '1000'))
+        self.local_ttl = local_ttl or int(os.getenv('RESPONSE_CACHE_LOCAL_TTL', '300'))
+        self.redis_ttl = redis_ttl or int(os.getenv('RESPONSE_CACHE_TTL', str(3600 * 24)))
+        self.prefix = prefix
+        # 同一個 key 同時未命中時只呼叫一次 LLM
+        self.single_flight = single_flight or SingleFlight(redis_client)
+
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            'local_hits': 0,
+            'redis_hits': 0,
+            'misses': 0,
+            'redis_errors': 0
+        }
+        # 依 prompt 名稱與版本（name@version）分開統計
+        self.prompt_stats = {}
+
+    def make_key(self, name, version, params):
+        """由 prompt 名稱、版本與正規化後的參數組成 key"""
+        normalized = {k: normalize_text(v) for k, v in sorted(params.items())}
+        raw = json.dumps([name, version, normalized], ensure_ascii=False, sort_keys=True)
+        digest = hashlib.sha256(raw.encode('utf-8')).hexdigest()
+        return f"{self.prefix}:{name}:{version}:{digest}"
+
+    def _incr(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    @property
+    def async_redis_client(self):
+        if self._async_client is None:
+            self._async_client = redis.asyncio.from_url(self.redis_url, decode_responses=True)
+        return self._async_client
+
+    def _get_local(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._local.move_to_end(key)
+                    self.stats['local_hits'] += 1
+                    return value
+                del self._local[key]
+        return None
+
+    def _from_redis(self, key, data):
+        if data:
+            value = json.loads(data)
+            self._set_local(key, value)
+            self._incr('redis_hits')
+            return value
+
+        self._incr('misses')
+        return None
+
+    def get(self, key):
+        value = self._get_local(key)
+        if value is not None:
+            return value
+
+        try:
+            data = self.redis_client.get(key)
+        except redis.RedisError:
+            self._incr('redis_errors')
+            data = None
+
+        return self._from_redis(key, data)
+
+    async def aget(self, key):
+        value = self._get_local(key)
+        if value is not None:
+            return value
+
+        try:
+            data = await self.async_redis_client.get(key)
+        except redis.RedisError:
+            self._incr('redis_errors')
+            data = None
+
+        return self._from_redis(key, data)
+
+    def set(self, key, value):
+        self._set_local(key, value)
+        try:
+            self.redis_client.setex(key, self.redis_ttl, json.dumps(value, ensure_ascii=False))
+        except redis.RedisError:
+            self._incr('redis_errors')
+
+    async def aset(self, key, value):
+        self._set_local(key, value)
+        try:
+            await self.async_redis_client.setex(key, self.redis_ttl, json.dumps(value, ensure_ascii=False))
+        except redis.RedisError:
+            self._incr('redis_errors')
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.local_ttl, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def get_or_compute(self, name, version, params, compute, use_cache=True, deadline=None):
+        """有快取就直接回傳，否則呼叫 compute() 並寫入快取；等待相同請求時不超過 deadline"""
+        if not use_cache:
+            return compute()
+
+        key = self.make_key(name, version, params)
+        value = self.get(key)
+        self._record_prompt(f"{name}@{version}", 'hits' if value is not None else 'misses')
+        if value is not None:
+            return value
+
+        def load():
+            # 前一個相同請求可能剛算完
+            value = self._get_local(key)
+            if value is None:
+                value = compute()
+                self.set(key, value)
+            return value
+
+        return self.single_flight.do(key, load, deadline)
+
+    async def aget_or_compute(self, name, version, params, compute, use_cache=True, deadline=None):
+        """get_or_compute 的非同步版本，compute 為 async 函式"""
+        if not use_cache:
+            return await compute()
+
+        key = self.make_key(name, version, params)
+        value = await self.aget(key)
+        self._record_prompt(f"{name}@{version}", 'hits' if value is not None else 'misses')
+        if value is not None:
+            return value
+
+        async def load():
+            value = self._get_local(key)
+            if value is None:
+                value = await compute()
+                await self.aset(key, value)
+            return value
+
+        return await self.single_flight.ado(key, load, deadline)
+
+    def _record_prompt(self, tag, field):
+        with self._lock:
+            stats = self.prompt_stats.setdefault(tag, {'hits': 0, 'misses': 0})
+            stats[field] += 1
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+import uvicorn
+
+# ASGI 模式：回覆優化版跑在 event loop 上，單一行程可同時處理數百個生成
+if __name__ == "__main__":
+    uvicorn.run("asgi_app:app", host='0.0.0.0', port=8000)
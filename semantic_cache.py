@@ -0,0 +1,237 @@
+import os
+import re
+import json
+import time
+import zlib
+import threading
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def semantic_cache_enabled():
+    return os.getenv('SEMANTIC_CACHE', 'false').lower() in ('1', 'true', 'yes')
+
+# 同義的稱呼與說法換成同一個詞
+SYNONYMS = {
+    '上司': '主管',
+    '老闆': '主管',
+    'boss': '主管',
+    '今晚': '今天晚上',
+    '拒絕': '婉拒',
+    '提醒': '催'
+}
+# 一次掃過全文替換，替換後的詞不會再被其他規則替換（長的優先）
+_SYNONYM_PATTERN = re.compile('|'.join(map(re.escape, sorted(SYNONYMS, key=len, reverse=True))))
+
+# 不影響情境的口語字詞（長的放前面，避免先被短的拆開）
+FILLER_WORDS = ['幫我', '我想', '想要', '請問', '怎麼', '如何', '一下', '要', '想', '跟', '的', '說', '我', '你', '了', '嗎', '呢']
+
+# 改變意思的細節：n-gram 相似度幾乎不受影響，必須完全相同才算命中
+# 數字與金額（5萬元 / 50萬元）、星期（週六 / 週日）、相對日期（今天 / 明天）、
+# 時態（會寄出 / 已經寄出）、否定（搬走 / 不搬走）、方向相反的詞（調漲 / 調降）
+GUARD_PATTERN = re.compile(
+    r'[0-9０-９.零一二兩三四五六七八九十百千萬億]+'
+    r'|(?:週|周|星期|禮拜)[一二三四五六日天末]'
+    r'|今天|明天|後天|昨天|前天|已經|已|還沒|會'
+    r'|[不沒別未勿無非]'
+    r'|漲|降|增加|減少|提前|延後|早|晚|上週|下週|上個月|下個月|上午|下午|答應|婉拒|接受|取消'
+)
+# 含否定字或「會」但不改變意思的常用詞
+GUARD_IGNORED = ['不好意思', '不錯', '會議', '開會', '機會', '聚會']
+
+# 正規化、n-gram 或 guard 規則改變時遞增，舊的存檔就不會被讀入
+FEATURE_VERSION = 4
+
+def normalize_request(text):
+    text = ''.join((text or '').split()).lower()
+    text = _SYNONYM_PATTERN.sub(lambda match: SYNONYMS[match.group(0)], text)
+    for word in FILLER_WORDS:
+        text = text.replace(word, '')
+    return text
+
+def guard_tokens(text):
+    """正規化後的文字中改變意思的細節，排序後回傳（不同時一律不命中）"""
+    text = normalize_request(text)
+    for word in GUARD_IGNORED:
+        text = text.replace(word, '')
+    return tuple(sorted(GUARD_PATTERN.findall(text)))
+
+def guarded_group(group, text):
+    """group 再加上 guard_tokens，細節不同的請求不會互相比對"""
+    tokens = guard_tokens(text)
+    if not tokens:
+        return group
+    return zlib.crc32(json.dumps(tokens, ensure_ascii=False).encode('utf-8'), group)
+
+def featurize(text, dim, ngrams=(1, 2)):
+    """字元 n-gram 雜湊成固定維度的向量（L2 正規化），不需要網路或模型
+
+    使用 crc32 而不是 hash()，同一段文字在不同行程得到相同的向量，存檔後才能繼續使用。
+    """
+    text = normalize_request(text)
+    indices = []
+    for n in ngrams:
+        for i in range(len(text) - n + 1):
+            indices.append(zlib.crc32(text[i:i + n].encode('utf-8')) % dim)
+    vector = np.bincount(np.asarray(indices, dtype=np.int64), minlength=dim).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+class SemanticIndex:
+    """以 NumPy 矩陣存放向量的近鄰索引
+
+    每一列是一筆向量，group 相同的列才會互相比對；查詢是一次矩陣乘法算出 cosine，
+    再以 argpartition 取前 k 名。滿了之後淘汰最久沒被命中的一列（LRU）。
+    """
+
+    def __init__(self, dim, capacity):
+        self.dim = dim
+        self.capacity = capacity
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.groups = np.zeros(capacity, dtype=np.int64)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.values = [None] * capacity
+        self.size = 0
+
+    def search(self, vector, group, k=1):
+        """回傳 [(相似度, 列號), ...]，由高到低"""
+        if self.size == 0:
+            return []
+        scores = self.vectors[:self.size] @ vector
+        scores[self.groups[:self.size] != group] = -1.0
+        k = min(k, self.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(i)) for i in top if scores[i] > -1.0]
+
+    def add(self, vector, group, value, now):
+        """加入一筆，回傳是否淘汰了舊資料"""
+        evicted = self.size >= self.capacity
+        if evicted:
+            row = int(np.argmin(self.last_used))
+        else:
+            row = self.size
+            self.size += 1
+        self.vectors[row] = vector
+        self.groups[row] = group
+        self.last_used[row] = now
+        self.values[row] = value
+        return evicted
+
+    def touch(self, row, now):
+        self.last_used[row] = now
+
+class SemanticCache:
+    """回覆選項的語意快取：精確 key 沒命中時，找意思相近的舊請求
+
+    「明天想請假跟老闆說」與「幫我跟主管請假明天」用字順序不同，精確快取不會命中；
+    這裡把請求文字轉成字元 n-gram 向量，cosine 相似度達到 SEMANTIC_CACHE_THRESHOLD 才直接使用舊結果，
+    否則照常呼叫 LLM。溝通方式、公司文化等不適合模糊比對的參數必須完全相同（group），
+    數字、星期、否定與方向相反的詞也必須相同（guard_tokens）：「下個月要搬走」與「下個月不搬走」相似度很高，
+    但不能共用回覆。預設關閉（SEMANTIC_CACHE=true 開啟）。
+
+    索引存在行程內，可用 save()/load() 存成 .npz（向量、group、最後使用時間與 JSON 格式的結果）。
+    """
+
+    def __init__(self, dim=None, capacity=None, threshold=None, path=None):
+        self.dim = dim or int(os.getenv('SEMANTIC_CACHE_DIM', '256'))
+        self.capacity = capacity or int(os.getenv('SEMANTIC_CACHE_SIZE', '20000'))
+        self.threshold = threshold if threshold is not None else float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.8'))
+        self.path = path if path is not None else os.getenv('SEMANTIC_CACHE_PATH', '')
+        self.index = SemanticIndex(self.dim, self.capacity)
+        self._lock = threading.Lock()
+        self.stats = {
+            'lookups': 0,
+            'hits': 0,
+            'misses': 0,
+            'added': 0,
+            'evicted': 0
+        }
+        if self.path and os.path.exists(self.path):
+            self.load(self.path)
+
+    @staticmethod
+    def group_of(name, version, exact):
+        """不做模糊比對的部分（prompt、版本與其他參數）組成 group"""
+        raw = json.dumps([name, version, exact], ensure_ascii=False, sort_keys=True)
+        return zlib.crc32(raw.encode('utf-8'))
+
+    def lookup(self, group, text):
+        """相似度達到門檻時回傳 (結果, 相似度)，否則回傳 None"""
+        vector = featurize(text, self.dim)
+        group = guarded_group(group, text)
+        with self._lock:
+            self.stats['lookups'] += 1
+            matches = self.index.search(vector, group)
+            if matches and matches[0][0] >= self.threshold:
+                score, row = matches[0]
+                self.index.touch(row, time.time())
+                self.stats['hits'] += 1
+                return self.index.values[row], score
+            self.stats['misses'] += 1
+            return None
+
+    def add(self, group, text, value):
+        vector = featurize(text, self.dim)
+        group = guarded_group(group, text)
+        with self._lock:
+            if self.index.add(vector, group, value, time.time()):
+                self.stats['evicted'] += 1
+            self.stats['added'] += 1
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.stats, size=self.index.size, capacity=self.capacity, threshold=self.threshold)
+
+    def save(self, path=None):
+        """存成 .npz；先寫暫存檔再改名，避免寫到一半的檔案"""
+        path = path or self.path
+        if not path:
+            return False
+        with self._lock:
+            size = self.index.size
+            data = {
+                'dim': np.array(self.dim),
+                'feature_version': np.array(FEATURE_VERSION),
+                'vectors': self.index.vectors[:size].copy(),
+                'groups': self.index.groups[:size].copy(),
+                'last_used': self.index.last_used[:size].copy(),
+                'values': np.array([json.dumps(v, ensure_ascii=False) for v in self.index.values[:size]], dtype=np.str_)
+            }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **data)
+        os.replace(tmp_path, path)
+        return True
+
+    def load(self, path=None):
+        """讀回 save() 的檔案；維度或特徵版本不同時忽略，超過容量時保留最近使用的部分"""
+        path = path or self.path
+        try:
+            with np.load(path) as data:
+                if int(data['dim']) != self.dim or int(data['feature_version']) != FEATURE_VERSION:
+                    print(f"[semantic cache] 維度或特徵版本不同，忽略 {path}")
+                    return False
+                # NpzFile 每次取 key 都會重新讀檔，先各取一次
+                last_used = data['last_used']
+                stored = data['values']
+                keep = np.argsort(-last_used)[:self.capacity]
+                vectors = data['vectors'][keep]
+                groups = data['groups'][keep]
+                last_used = last_used[keep]
+                values = [json.loads(stored[i]) for i in keep]
+        except (OSError, KeyError, ValueError) as e:
+            print(f"[semantic cache] 無法讀取 {path}: {e}")
+            return False
+
+        with self._lock:
+            size = len(values)
+            self.index.vectors[:size] = vectors
+            self.index.groups[:size] = groups
+            self.index.last_used[:size] = last_used
+            self.index.values[:size] = values
+            self.index.size = size
+        return True
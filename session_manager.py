@@ -1,16 +1,46 @@
 import os
 import json
+import time
+import threading
 import redis
+import redis.asyncio
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# 狀態符合預期才寫入，整個比對與更新在 Redis 內原子完成
+# KEYS[1]: session key
+# ARGV[1]: ttl, ARGV[2]: 預期的狀態（空字串表示尚無狀態）, ARGV[3..]: field, value, ...
+_TRANSITION_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'state')
+if ARGV[2] == '' then
+    if current and current ~= 'null' then
+        return 0
+    end
+elseif current ~= ARGV[2] then
+    return 0
+end
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
 class SessionManager:
     def __init__(self):
-        redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
-        self.redis_client = redis.from_url(redis_url, decode_responses=True)
+        self.redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+        self.redis_client = redis.from_url(self.redis_url, decode_responses=True)
         self.session_ttl = 3600 * 24  # 24 hours
+        self._transition = self.redis_client.register_script(_TRANSITION_SCRIPT)
+        # ASGI 模式使用的 redis.asyncio client，第一次用到時才建立
+        self._async_client = None
+        self._async_transition = None
+        # 批次預讀的 session，只給該用戶下一個 SessionContext 使用一次
+        self._prefetched = {}
+        self._prefetch_lock = threading.Lock()
+        self.prefetch_ttl = 5
     
     def _get_session_key(self, user_id):
         return f"session:{user_id}"
@@ -18,51 +48,153 @@ class SessionManager:
     def _get_prompt_key(self, user_id):
         return f"prompt:{user_id}"
     
-    def get_session_data(self, user_id):
+    @staticmethod
+    def _encode(value):
+        return json.dumps(value, ensure_ascii=False)
+    
+    @staticmethod
+    def _decode(value):
+        if value is None:
+            return None
+        return json.loads(value)
+    
+    def _migrate_legacy(self, user_id):
+        """舊版以 JSON 字串存整個 session，讀到時轉成 hash"""
         key = self._get_session_key(user_id)
         data = self.redis_client.get(key)
+        data = json.loads(data) if data else {}
+        self.redis_client.delete(key)
         if data:
-            return json.loads(data)
-        return {}
+            self.set_session_data(user_id, data)
+        return data
+    
+    def get_session_data(self, user_id):
+        key = self._get_session_key(user_id)
+        try:
+            fields = self.redis_client.hgetall(key)
+        except redis.ResponseError:
+            return self._migrate_legacy(user_id)
+        return {field: self._decode(value) for field, value in fields.items()}
     
     def set_session_data(self, user_id, data):
         key = self._get_session_key(user_id)
-        self.redis_client.setex(key, self.session_ttl, json.dumps(data))
+        pipe = self.redis_client.pipeline()
+        pipe.delete(key)
+        if data:
+            pipe.hset(key, mapping={field: self._encode(value) for field, value in data.items()})
+            pipe.expire(key, self.session_ttl)
+        pipe.execute()
+    
+    def get_field(self, user_id, field):
+        key = self._get_session_key(user_id)
+        try:
+            return self._decode(self.redis_client.hget(key, field))
+        except redis.ResponseError:
+            return self._migrate_legacy(user_id).get(field)
+    
+    def set_fields(self, user_id, **fields):
+        """HSET 與 TTL 更新在同一個 pipeline 中送出"""
+        key = self._get_session_key(user_id)
+        pipe = self.redis_client.pipeline()
+        pipe.hset(key, mapping={field: self._encode(value) for field, value in fields.items()})
+        pipe.expire(key, self.session_ttl)
+        try:
+            pipe.execute()
+        except redis.ResponseError:
+            self._migrate_legacy(user_id)
+            self.set_fields(user_id, **fields)
+    
+    def transition_state(self, user_id, expected_state, new_state, **fields):
+        """只有目前狀態等於 expected_state 時才切換，回傳是否成功"""
+        key = self._get_session_key(user_id)
+        args = [self.session_ttl, '' if expected_state is None else self._encode(expected_state)]
+        for field, value in dict(fields, state=new_state).items():
+            args.extend([field, self._encode(value)])
+        try:
+            return bool(self._transition(keys=[key], args=args))
+        except redis.ResponseError:
+            self._migrate_legacy(user_id)
+            return bool(self._transition(keys=[key], args=args))
+    
+    @property
+    def async_redis_client(self):
+        if self._async_client is None:
+            self._async_client = redis.asyncio.from_url(self.redis_url, decode_responses=True)
+            self._async_transition = self._async_client.register_script(_TRANSITION_SCRIPT)
+        return self._async_client
+    
+    def async_session(self, user_id):
+        """ASGI 模式使用的 session 工作單元，見 AsyncSessionContext"""
+        return self._with_prefetched(AsyncSessionContext(self, user_id))
+    
+    def session(self, user_id):
+        """建立單一事件用的 session 工作單元，見 SessionContext"""
+        return self._with_prefetched(SessionContext(self, user_id))
+    
+    def _with_prefetched(self, session):
+        with self._prefetch_lock:
+            entry = self._prefetched.pop(session.user_id, None)
+        
+        if entry and time.monotonic() - entry[0] < self.prefetch_ttl:
+            session._apply_loaded(entry[1], entry[2])
+        return session
+    
+    def prefetch(self, user_ids):
+        """用一個 pipeline 讀取多位用戶的 session 與上次的 prompt"""
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return
+        
+        pipe = self.redis_client.pipeline(transaction=False)
+        self._queue_prefetch(pipe, user_ids)
+        self._store_prefetched(user_ids, pipe.execute(raise_on_error=False))
+    
+    async def aprefetch(self, user_ids):
+        """prefetch 的非同步版本（ASGI 模式）"""
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return
+        
+        pipe = self.async_redis_client.pipeline(transaction=False)
+        self._queue_prefetch(pipe, user_ids)
+        self._store_prefetched(user_ids, await pipe.execute(raise_on_error=False))
+    
+    def _queue_prefetch(self, pipe, user_ids):
+        for user_id in user_ids:
+            pipe.hgetall(self._get_session_key(user_id))
+            pipe.get(self._get_prompt_key(user_id))
+    
+    def _store_prefetched(self, user_ids, results):
+        now = time.monotonic()
+        with self._prefetch_lock:
+            # 順便清掉沒被用到的舊資料
+            for user_id in [u for u, entry in self._prefetched.items() if now - entry[0] >= self.prefetch_ttl]:
+                del self._prefetched[user_id]
+            for i, user_id in enumerate(user_ids):
+                self._prefetched[user_id] = (now, results[2 * i], results[2 * i + 1])
     
     def get_state(self, user_id):
-        data = self.get_session_data(user_id)
-        return data.get('state')
+        return self.get_field(user_id, 'state')
     
     def set_state(self, user_id, state):
-        data = self.get_session_data(user_id)
-        data['state'] = state
-        self.set_session_data(user_id, data)
+        self.set_fields(user_id, state=state)
     
     def set_user_identity(self, user_id, identity):
-        data = self.get_session_data(user_id)
-        data['user_identity'] = identity
-        self.set_session_data(user_id, data)
+        self.set_fields(user_id, user_identity=identity)
     
     def set_target_identity(self, user_id, target):
-        data = self.get_session_data(user_id)
-        data['target_identity'] = target
-        self.set_session_data(user_id, data)
+        self.set_fields(user_id, target_identity=target)
     
     def set_context(self, user_id, context):
-        data = self.get_session_data(user_id)
-        data['context'] = context
-        self.set_session_data(user_id, data)
+        self.set_fields(user_id, context=context)
     
     def set_past_conversation(self, user_id, conversation):
-        data = self.get_session_data(user_id)
-        data['past_conversation'] = conversation
-        self.set_session_data(user_id, data)
+        self.set_fields(user_id, past_conversation=conversation)
     
     def clear_session(self, user_id):
         session_key = self._get_session_key(user_id)
         prompt_key = self._get_prompt_key(user_id)
-        self.redis_client.delete(session_key)
-        self.redis_client.delete(prompt_key)
+        self.redis_client.delete(session_key, prompt_key)
     
     def save_last_prompt(self, user_id, prompt):
         key = self._get_prompt_key(user_id)
@@ -73,4 +205,214 @@ class SessionManager:
         data = self.redis_client.get(key)
         if data:
             return json.loads(data)
-        return None
\ No newline at end of file
+        return None
+
+class SessionContext:
+    """單一事件的 session 工作單元：讀取一次、記錄變更、結束時一次寫回
+    
+    用法：
+        with session_manager.session(user_id) as session:
+            if session.state == 'awaiting_context':
+                session.update(context=text, state='awaiting_past_conversation')
+    
+    handler 拋出例外時放棄所有變更。
+    """
+    
+    def __init__(self, manager, user_id):
+        self.manager = manager
+        self.user_id = user_id
+        self._data = None
+        self._loaded_state = None
+        self._last_prompt = None
+        self._dirty = {}
+        self._prompt_dirty = False
+        self._cleared = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+    
+    def _load(self):
+        if self._data is not None:
+            return
+        
+        manager = self.manager
+        pipe = manager.redis_client.pipeline(transaction=False)
+        pipe.hgetall(manager._get_session_key(self.user_id))
+        pipe.get(manager._get_prompt_key(self.user_id))
+        fields, prompt = pipe.execute(raise_on_error=False)
+        self._apply_loaded(fields, prompt)
+    
+    def _apply_loaded(self, fields, prompt):
+        """套用 HGETALL 與 GET 的結果"""
+        manager = self.manager
+        if isinstance(fields, redis.ResponseError):
+            self._data = manager._migrate_legacy(self.user_id)
+        else:
+            self._data = {field: manager._decode(value) for field, value in fields.items()}
+        self._loaded_state = self._data.get('state')
+        # 載入前已先寫入的欄位蓋過讀到的值
+        self._data.update(self._dirty)
+        if not self._prompt_dirty:
+            self._last_prompt = json.loads(prompt) if prompt and not isinstance(prompt, Exception) else None
+    
+    @property
+    def data(self):
+        """目前的 session 內容（含尚未寫回的變更）"""
+        self._load()
+        return dict(self._data)
+    
+    @property
+    def state(self):
+        return self.get('state')
+    
+    def get(self, field, default=None):
+        self._load()
+        return self._data.get(field, default)
+    
+    def update(self, **fields):
+        """記錄變更；尚未讀取時不會為了寫入而先讀一次"""
+        if self._data is not None:
+            self._data.update(fields)
+        self._dirty.update(fields)
+    
+    def set_state(self, state):
+        self.update(state=state)
+    
+    def clear(self):
+        """清除 session 與上次的 prompt"""
+        self._data = {}
+        self._loaded_state = None
+        self._dirty = {}
+        self._last_prompt = None
+        self._prompt_dirty = False
+        self._cleared = True
+    
+    def get_last_prompt(self, user_id=None):
+        self._load()
+        return self._last_prompt
+    
+    def save_last_prompt(self, user_id, prompt):
+        """與 SessionManager.save_last_prompt 相同介面，可直接傳給 ChatProcessor"""
+        self._last_prompt = prompt
+        self._prompt_dirty = True
+    
+    def commit(self):
+        """把所有變更以一個 pipeline 寫回，狀態被其他事件改過時回傳 False"""
+        if not self.dirty:
+            return True
+        
+        pipe = self.manager.redis_client.pipeline()
+        check_state = self._queue_commit(pipe, self.manager._transition)
+        return self._finish_commit(pipe.execute(), check_state)
+    
+    @property
+    def dirty(self):
+        return bool(self._dirty or self._prompt_dirty or self._cleared)
+    
+    def _queue_commit(self, pipe, transition):
+        """把寫回的指令放進 pipeline，回傳是否有做狀態 compare-and-set"""
+        manager = self.manager
+        session_key = manager._get_session_key(self.user_id)
+        prompt_key = manager._get_prompt_key(self.user_id)
+        # 有讀過 session 才知道原本的狀態，才能做 compare-and-set
+        check_state = 'state' in self._dirty and self._data is not None and not self._cleared
+        
+        if self._cleared:
+            pipe.delete(session_key, prompt_key)
+        
+        if self._prompt_dirty:
+            pipe.setex(prompt_key, manager.session_ttl, json.dumps(self._last_prompt))
+        
+        if check_state:
+            # 狀態轉換走 compare-and-set，避免同一用戶的兩個事件互相覆蓋；放在最後，結果為 results[-1]
+            expected = self._loaded_state
+            args = [manager.session_ttl, '' if expected is None else manager._encode(expected)]
+            for field, value in self._dirty.items():
+                args.extend([field, manager._encode(value)])
+            transition(keys=[session_key], args=args, client=pipe)
+        elif self._dirty:
+            pipe.hset(session_key, mapping={
+                field: manager._encode(value) for field, value in self._dirty.items()
+            })
+            pipe.expire(session_key, manager.session_ttl)
+        
+        return check_state
+    
+    def _finish_commit(self, results, check_state):
+        # 寫回前預讀、還沒被用掉的資料已過時
+        manager = self.manager
+        with manager._prefetch_lock:
+            manager._prefetched.pop(self.user_id, None)
+        self._dirty = {}
+        self._prompt_dirty = False
+        self._cleared = False
+        if self._data is not None:
+            self._loaded_state = self._data.get('state')
+        
+        if check_state and not results[-1]:
+            print(f"[session] 狀態已被其他事件更新，放棄本次狀態寫入: {self.user_id[:8]}...")
+            return False
+        return True
+    
+    def rollback(self):
+        """放棄尚未寫回的變更"""
+        self._data = None
+        self._dirty = {}
+        self._prompt_dirty = False
+        self._cleared = False
+
+class AsyncSessionContext(SessionContext):
+    """SessionContext 的 redis.asyncio 版本
+    
+    用法：
+        async with session_manager.async_session(user_id) as session:
+            await session.load()
+            ...
+    
+    load() 之後 get/state/data 等讀取方法與同步版相同。
+    """
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.commit()
+        else:
+            self.rollback()
+        return False
+    
+    def _load(self):
+        if self._data is None:
+            raise RuntimeError("AsyncSessionContext 需要先 await load()")
+    
+    async def load(self):
+        if self._data is not None:
+            return
+        
+        manager = self.manager
+        pipe = manager.async_redis_client.pipeline(transaction=False)
+        pipe.hgetall(manager._get_session_key(self.user_id))
+        pipe.get(manager._get_prompt_key(self.user_id))
+        fields, prompt = await pipe.execute(raise_on_error=False)
+        self._apply_loaded(fields, prompt)
+    
+    async def commit(self):
+        if not self.dirty:
+            return True
+        
+        manager = self.manager
+        pipe = manager.async_redis_client.pipeline()
+        # redis.asyncio 的 Script 要 await 才會排進 pipeline；它是最後一個指令，排完再 await 順序不變
+        scripts = []
+        check_state = self._queue_commit(pipe, lambda **kwargs: scripts.append(manager._async_transition(**kwargs)))
+        for script in scripts:
+            await script
+        return self._finish_commit(await pipe.execute(), check_state)
\ No newline at end of file
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import threading
+import redis
+import redis.asyncio
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 只刪除自己持有的鎖，避免鎖過期後誤刪別的行程的鎖
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class _LeaderCancelled(Exception):
+    """ASGI 模式下負責計算的 task 被取消，等待者改由自己計算"""
+
+class SingleFlight:
+    """相同 key 同時進行中的計算只做一次，其他呼叫者等待同一個結果
+
+    行程內以 threading.Event（同步）或 asyncio.Future（ASGI）共享結果；
+    啟用 SINGLE_FLIGHT_REDIS 時，再以 Redis 短期鎖與結果 key 跨行程合併。
+    """
+
+    def __init__(self, redis_client=None, use_redis=None, lock_ttl=None, wait_timeout=None, prefix='singleflight'):
+        self.redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+        if use_redis is None:
+            use_redis = os.getenv('SINGLE_FLIGHT_REDIS', 'false').lower() in ('1', 'true', 'yes')
+        self.use_redis = use_redis
+        if use_redis and redis_client is None:
+            redis_client = redis.from_url(self.redis_url, decode_responses=True)
+        self.redis_client = redis_client
+        self._async_client = None
+        self._release = redis_client.register_script(_RELEASE_SCRIPT) if use_redis else None
+        self._async_release = None
+        # 鎖的存活時間需涵蓋一次 LLM 呼叫；結果 key 只需留給正在等待的行程讀取
+        self.lock_ttl = lock_ttl or float(os.getenv('SINGLE_FLIGHT_LOCK_TTL', '30'))
+        self.wait_timeout = wait_timeout or float(os.getenv('SINGLE_FLIGHT_WAIT', '30'))
+        self.result_ttl = 10
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        self._calls = {}     # key -> _Call
+        self._futures = {}   # key -> asyncio.Future
+        self.stats = {
+            'leaders': 0,
+            'coalesced': 0,
+            'remote_hits': 0,
+            'remote_fallbacks': 0,
+            'wait_timeouts': 0,
+            'redis_errors': 0
+        }
+
+    def _incr(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    @property
+    def async_redis_client(self):
+        if self._async_client is None:
+            self._async_client = redis.asyncio.from_url(self.redis_url, decode_responses=True)
+            self._async_release = self._async_client.register_script(_RELEASE_SCRIPT)
+        return self._async_client
+
+    def _keys(self, key):
+        return f"{self.prefix}:lock:{key}", f"{self.prefix}:result:{key}"
+
+    def _wait_timeout(self, deadline):
+        """等待別人計算的上限：SINGLE_FLIGHT_WAIT 與 deadline 剩餘時間取小，期限已到時拋出 DeadlineExceeded"""
+        if deadline is None:
+            return self.wait_timeout
+        return min(self.wait_timeout, deadline.timeout('llm'))
+
+    def do(self, key, compute, deadline=None):
+        """回傳 compute() 的結果；同 key 已在計算中時等待它完成
+
+        負責計算者的錯誤只屬於它自己時（例如該用戶的額度不足，per_caller），等待者改由自己計算。
+        等待超過 deadline 時拋出 DeadlineExceeded，只超過 SINGLE_FLIGHT_WAIT 時改由自己計算。
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                    self.stats['leaders'] += 1
+                else:
+                    self.stats['coalesced'] += 1
+
+            if leader:
+                break
+            if not call.event.wait(self._wait_timeout(deadline)):
+                self._incr('wait_timeouts')
+                if deadline is not None:
+                    deadline.timeout('llm')
+                return self._compute(key, compute, deadline)
+            if call.error is None:
+                return call.result
+            if not getattr(call.error, 'per_caller', False):
+                raise call.error
+
+        try:
+            call.result = self._compute(key, compute, deadline)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def _compute(self, key, compute, deadline=None):
+        if not self.use_redis:
+            return compute()
+
+        lock_key, result_key = self._keys(key)
+        token = uuid.uuid4().hex
+        try:
+            acquired = self.redis_client.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000))
+        except redis.RedisError:
+            self._incr('redis_errors')
+            return compute()
+
+        if acquired:
+            try:
+                value = compute()
+                # 先寫入結果再釋放鎖，等待中的行程才不會撲空
+                try:
+                    self.redis_client.setex(result_key, self.result_ttl, json.dumps(value, ensure_ascii=False))
+                except redis.RedisError:
+                    self._incr('redis_errors')
+            finally:
+                try:
+                    self._release(keys=[lock_key], args=[token])
+                except redis.RedisError:
+                    self._incr('redis_errors')
+            return value
+
+        # 其他行程正在計算，等它寫入結果
+        wait_until = time.monotonic() + self._wait_timeout(deadline)
+        delay = 0.05
+        try:
+            while time.monotonic() < wait_until:
+                data = self.redis_client.get(result_key)
+                if data is None and not self.redis_client.exists(lock_key):
+                    # 鎖已釋放：結果可能剛寫入，也可能對方失敗了
+                    data = self.redis_client.get(result_key)
+                    if data is None:
+                        break
+                if data is not None:
+                    self._incr('remote_hits')
+                    return json.loads(data)
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
+        except redis.RedisError:
+            self._incr('redis_errors')
+
+        self._incr('remote_fallbacks')
+        return compute()
+
+    async def ado(self, key, compute, deadline=None):
+        """do 的非同步版本（ASGI 模式），compute 為 async 函式"""
+        while True:
+            future = self._futures.get(key)
+            if future is None:
+                break
+            self._incr('coalesced')
+            # asyncio.wait 逾時不會取消負責計算的 future
+            done, _ = await asyncio.wait({future}, timeout=self._wait_timeout(deadline))
+            if not done:
+                self._incr('wait_timeouts')
+                if deadline is not None:
+                    deadline.timeout('llm')
+                return await self._acompute(key, compute, deadline)
+            try:
+                return future.result()
+            except _LeaderCancelled:
+                continue
+            except Exception as e:
+                if getattr(e, 'per_caller', False):
+                    continue
+                raise
+
+        future = self._futures[key] = asyncio.get_running_loop().create_future()
+        # 沒有人等待時也不要留下 "exception was never retrieved" 的警告
+        future.add_done_callback(lambda f: f.exception())
+        self._incr('leaders')
+        try:
+            value = await self._acompute(key, compute, deadline)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.set_exception(_LeaderCancelled())
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._futures[key]
+
+    async def _acompute(self, key, compute, deadline=None):
+        if not self.use_redis:
+            return await compute()
+
+        client = self.async_redis_client
+        lock_key, result_key = self._keys(key)
+        token = uuid.uuid4().hex
+        try:
+            acquired = await client.set(lock_key, token, nx=True, px=int(self.lock_ttl * 1000))
+        except redis.RedisError:
+            self._incr('redis_errors')
+            return await compute()
+
+        if acquired:
+            try:
+                value = await compute()
+                try:
+                    await client.setex(result_key, self.result_ttl, json.dumps(value, ensure_ascii=False))
+                except redis.RedisError:
+                    self._incr('redis_errors')
+            finally:
+                try:
+                    await self._async_release(keys=[lock_key], args=[token])
+                except redis.RedisError:
+                    self._incr('redis_errors')
+            return value
+
+        wait_until = time.monotonic() + self._wait_timeout(deadline)
+        delay = 0.05
+        try:
+            while time.monotonic() < wait_until:
+                data = await client.get(result_key)
+                if data is None and not await client.exists(lock_key):
+                    data = await client.get(result_key)
+                    if data is None:
+                        break
+                if data is not None:
+                    self._incr('remote_hits')
+                    return json.loads(data)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
+        except redis.RedisError:
+            self._incr('redis_errors')
+
+        self._incr('remote_fallbacks')
+        return await compute()
@@ -85,6 +85,41 @@ def test_redis_connection():
         print(f"❌ Redis test error: {e}")
         return False
 
+def test_reply_option_stream():
+    """測試串流解析：標記被切在任何位置時，結果都要與一次解析相同"""
+    try:
+        print("\nTesting reply option stream parser...")
+        from reply_generator import ReplyGenerator, ReplyOptionStream
+        
+        content = "【選項1-正式委婉】\n[老闆您好，明天需請假一天]\n\n【選項2-平衡適中】\n老闆，明天想請假\n\n【選項3-輕鬆直接】明天請假喔😊"
+        expected = ReplyGenerator._parse_reply_options(None, content)
+        
+        # 在每個位置切成兩段（涵蓋切在「【選項」與「】」中間的情況）
+        for cut in range(len(content) + 1):
+            stream = ReplyOptionStream()
+            options = stream.feed(content[:cut]) + stream.feed(content[cut:]) + stream.close()
+            if options != expected:
+                print(f"❌ Stream parser mismatch when split at {cut}: {content[:cut]!r}")
+                return False
+        
+        # 逐字輸入時，第一個選項要在第二個標記出現前就完成
+        stream = ReplyOptionStream()
+        first_done = None
+        for i, ch in enumerate(content):
+            if stream.feed(ch) and first_done is None:
+                first_done = i
+        if first_done is None or first_done >= content.index('【選項2'):
+            print("❌ First option was not emitted early")
+            return False
+        
+        print("✅ Reply option stream parser OK")
+        
+    except Exception as e:
+        print(f"❌ Stream parser test error: {e}")
+        return False
+    
+    return True
+
 def main():
     """主測試函數"""
     print("🔍 Testing chatbot setup...\n")
@@ -93,6 +128,7 @@ def main():
     success &= test_imports()
     success &= test_app_structure()
     success &= test_redis_connection()
+    success &= test_reply_option_stream()
     
     if success:
         print("\n🎯 All tests passed! Your chatbot is ready to run.")
@@ -0,0 +1,85 @@
+import os
+import threading
+from collections import OrderedDict
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+def _get_encoding(model="gpt-3.5-turbo"):
+    """載入 tiktoken 編碼，失敗（未安裝或無法下載）時回傳 None"""
+    global _encoding, _encoding_loaded
+    if _encoding_loaded:
+        return _encoding
+
+    with _encoding_lock:
+        if not _encoding_loaded:
+            try:
+                import tiktoken
+                _encoding = tiktoken.encoding_for_model(model)
+            except Exception as e:
+                print(f"tiktoken 無法使用，改用估算: {e}")
+                _encoding = None
+            _encoding_loaded = True
+
+    return _encoding
+
+def estimate_tokens(text):
+    """粗估 token 數：中日韓文字約 1 字 1 token，英數約 4 字元 1 token"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+# 相同字串（prompt 模板、session 欄位、重複的情境）只計算一次
+_COUNT_CACHE_SIZE = int(os.getenv('TOKEN_COUNT_CACHE_SIZE', '10000'))
+_counts = OrderedDict()
+_counts_lock = threading.Lock()
+count_stats = {'hits': 0, 'misses': 0}
+
+def _count(text):
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text))
+
+def count_tokens(text):
+    """計算 token 數，結果以字串本身為 key 快取（tokenizer 在第一次計算時才載入）"""
+    if not text:
+        return 0
+    key = text
+    with _counts_lock:
+        count = _counts.get(key)
+        if count is not None:
+            _counts.move_to_end(key)
+            count_stats['hits'] += 1
+            return count
+    count = _count(text)
+    with _counts_lock:
+        count_stats['misses'] += 1
+        _counts[key] = count
+        if len(_counts) > _COUNT_CACHE_SIZE:
+            _counts.popitem(last=False)
+    return count
+
+def truncate_tokens(text, max_tokens, keep='head'):
+    """把文字截到 max_tokens 以內；keep='tail' 時保留結尾（例如最近的對話）"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ''
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text)
+        part = tokens[-max_tokens:] if keep == 'tail' else tokens[:max_tokens]
+        # 切在多位元組字元中間時會解出替代字元，去掉
+        return encoding.decode(part).strip('\ufffd')
+
+    # 沒有 tokenizer 時依估算值二分搜尋可保留的字數
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        part = text[-mid:] if keep == 'tail' else text[:mid]
+        if estimate_tokens(part) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[-low:] if keep == 'tail' and low else text[:low]
@@ -0,0 +1,196 @@
+import os
+import asyncio
+import threading
+import redis
+from dotenv import load_dotenv
+from webhook_queue import WorkerPool
+from rate_limiter import RateLimitExceeded, PRIORITY_BULK
+from circuit_breaker import CircuitOpen
+
+load_dotenv()
+
+TONES = ['formal', 'casual', 'polite', 'direct']
+
+class ToneSpeculator:
+    """送出回覆卡片後，在背景預先產生語氣調整結果
+
+    結果透過 ReplyGenerator.adjust_tone 寫入回應快取，
+    用戶選擇語氣時直接命中快取；仍在生成中的會等它完成而不重複呼叫 LLM。
+    每位用戶排隊中加上執行中的預測最多 budget 個，連續開好幾張卡片也不會超過。
+    """
+
+    def __init__(self, reply_generator, redis_client=None, mode=None, top_k=None, budget=None, worker_pool=None):
+        if redis_client is None:
+            redis_url = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+            redis_client = redis.from_url(redis_url, decode_responses=True)
+        self.reply_generator = reply_generator
+        self.redis_client = redis_client
+        # all：四種語氣都預先產生；top_k：只產生最常被點選的 k 種；off：停用
+        self.mode = mode or os.getenv('TONE_SPECULATION', 'top_k')
+        self.top_k = top_k or int(os.getenv('TONE_SPECULATION_TOP_K', '2'))
+        # 每位用戶同時排隊或執行中的預測上限（跨卡片計算）
+        self.budget = budget or int(os.getenv('TONE_SPECULATION_BUDGET', '2'))
+        self.worker_pool = worker_pool or WorkerPool(
+            max_workers=int(os.getenv('TONE_SPECULATION_WORKERS', '4')),
+            max_queue=int(os.getenv('TONE_SPECULATION_QUEUE', '200'))
+        )
+        self.stats_key = 'tone_clicks'
+
+        self._lock = threading.Lock()
+        self._generations = {}  # user_id -> 目前有效的卡片編號
+        self._focus = {}        # user_id -> 用戶選定要調整的文字
+        self._inflight = {}     # (text, tone) -> threading.Event
+        self._user_jobs = {}    # user_id -> 排隊中加上執行中的預測數
+        self.stats = {
+            'scheduled': 0,
+            'completed': 0,
+            'cancelled': 0,
+            'limited': 0,
+            'over_budget': 0,
+            'waited': 0
+        }
+
+    def ranked_tones(self):
+        """依點選次數排序語氣"""
+        try:
+            clicks = self.redis_client.hgetall(self.stats_key)
+        except redis.RedisError:
+            clicks = {}
+        return sorted(TONES, key=lambda tone: -int(clicks.get(tone, 0)))
+
+    def record_click(self, tone):
+        try:
+            self.redis_client.hincrby(self.stats_key, tone, 1)
+        except redis.RedisError:
+            pass
+
+    def schedule(self, user_id, texts):
+        """卡片送出後呼叫，之前尚未執行的預測會被取消"""
+        if self.mode == 'off':
+            return 0
+
+        tones = self.ranked_tones()
+        if self.mode == 'top_k':
+            tones = tones[:self.top_k]
+
+        with self._lock:
+            generation = self._generations.get(user_id, 0) + 1
+            self._generations[user_id] = generation
+            self._focus.pop(user_id, None)
+
+        # 先讓每個選項都有最熱門的語氣，再往下一個語氣
+        jobs = [(text, tone) for tone in tones for text in texts if text]
+
+        scheduled = 0
+        for text, tone in jobs:
+            with self._lock:
+                if (text, tone) in self._inflight:
+                    continue
+                if self._user_jobs.get(user_id, 0) >= self.budget:
+                    # 前幾張卡片的預測還在排隊或執行中，這張剩下的就不預測了
+                    self.stats['over_budget'] += 1
+                    break
+                self._user_jobs[user_id] = self._user_jobs.get(user_id, 0) + 1
+                event = self._inflight[(text, tone)] = threading.Event()
+            if not self.worker_pool.submit(self._run, user_id, generation, text, tone, event):
+                # 工作池已滿，剩下的就不預測了
+                self._release(user_id)
+                self._finish(text, tone, event)
+                break
+            scheduled += 1
+
+        with self._lock:
+            self.stats['scheduled'] += scheduled
+        return scheduled
+
+    def focus(self, user_id, text):
+        """用戶已選定要調整的文字，其他選項的預測不再執行"""
+        with self._lock:
+            self._focus[user_id] = text
+
+    def cancel(self, user_id):
+        """用戶離開這張卡片時呼叫，尚未開始的預測不再執行
+
+        已送出的 LLM 呼叫無法中止，完成前仍計入該用戶的 budget。
+        """
+        with self._lock:
+            self._generations.pop(user_id, None)
+            self._focus.pop(user_id, None)
+
+    def _wanted(self, user_id, generation, text):
+        with self._lock:
+            if self._generations.get(user_id) != generation:
+                return False
+            focus = self._focus.get(user_id)
+            return focus is None or focus == text
+
+    def _run(self, user_id, generation, text, tone, event):
+        try:
+            if not self._wanted(user_id, generation, text):
+                with self._lock:
+                    self.stats['cancelled'] += 1
+                return
+            try:
+                # 預測排在用戶正在等的請求之後，額度不足或 LLM 暫停使用就放棄
+                self.reply_generator.adjust_tone(text, tone, priority=PRIORITY_BULK)
+            except (RateLimitExceeded, CircuitOpen):
+                with self._lock:
+                    self.stats['limited'] += 1
+                return
+            with self._lock:
+                self.stats['completed'] += 1
+        finally:
+            self._release(user_id)
+            self._finish(text, tone, event)
+
+    def _release(self, user_id):
+        with self._lock:
+            count = self._user_jobs.get(user_id, 0) - 1
+            if count > 0:
+                self._user_jobs[user_id] = count
+            else:
+                self._user_jobs.pop(user_id, None)
+
+    def _finish(self, text, tone, event):
+        with self._lock:
+            if self._inflight.get((text, tone)) is event:
+                del self._inflight[(text, tone)]
+        if event:
+            event.set()
+
+    def _pending(self, text, tone):
+        with self._lock:
+            return self._inflight.get((text, tone))
+
+    def _waited(self):
+        with self._lock:
+            self.stats['waited'] += 1
+
+    def _wait_timeout(self, wait_timeout, deadline):
+        timeout = wait_timeout or float(os.getenv('TONE_SPECULATION_WAIT', '20'))
+        if deadline is not None:
+            # 不等到超過回覆期限，剩下的時間留給自己呼叫 LLM 或送出回覆
+            timeout = max(0, min(timeout, deadline.remaining() - deadline.reserve))
+        return timeout
+
+    def adjust_tone(self, text, tone, wait_timeout=None, deadline=None, user_id=None):
+        """取得調整後的文字：預測中就等它完成，之後從快取讀取"""
+        self.record_click(tone)
+
+        event = self._pending(text, tone)
+        if event is not None:
+            event.wait(self._wait_timeout(wait_timeout, deadline))
+            self._waited()
+
+        return self.reply_generator.adjust_tone(text, tone, deadline=deadline, user_id=user_id)
+
+    async def aadjust_tone(self, text, tone, wait_timeout=None, deadline=None, user_id=None):
+        """adjust_tone 的非同步版本（ASGI 模式），等待預測時不佔住 event loop"""
+        await asyncio.to_thread(self.record_click, tone)
+
+        event = self._pending(text, tone)
+        if event is not None:
+            await asyncio.to_thread(event.wait, self._wait_timeout(wait_timeout, deadline))
+            self._waited()
+
+        return await self.reply_generator.aadjust_tone(text, tone, deadline=deadline, user_id=user_id)
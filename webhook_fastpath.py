@@ -0,0 +1,177 @@
+import hmac
+import json
+import base64
+import hashlib
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import (
+    MessageEvent, PostbackEvent, FollowEvent, UnfollowEvent, JoinEvent, LeaveEvent,
+    BeaconEvent, AccountLinkEvent, MemberJoinedEvent, MemberLeftEvent, ThingsEvent,
+    UnsendEvent, VideoPlayCompleteEvent, UnknownEvent
+)
+
+try:
+    # 有安裝 orjson 時使用，沒有就用標準函式庫
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# webhook 的事件 type -> SDK 類別（也用來取得 WebhookHandler 註冊時的名稱）
+EVENT_CLASSES = {
+    'message': MessageEvent,
+    'postback': PostbackEvent,
+    'follow': FollowEvent,
+    'unfollow': UnfollowEvent,
+    'join': JoinEvent,
+    'leave': LeaveEvent,
+    'beacon': BeaconEvent,
+    'accountLink': AccountLinkEvent,
+    'memberJoined': MemberJoinedEvent,
+    'memberLeft': MemberLeftEvent,
+    'things': ThingsEvent,
+    'unsend': UnsendEvent,
+    'videoPlayComplete': VideoPlayCompleteEvent
+}
+
+MESSAGE_NAMES = {
+    'text': 'TextMessage',
+    'image': 'ImageMessage',
+    'video': 'VideoMessage',
+    'audio': 'AudioMessage',
+    'location': 'LocationMessage',
+    'sticker': 'StickerMessage',
+    'file': 'FileMessage'
+}
+
+class SourceRecord:
+    __slots__ = ('type', 'user_id', 'group_id', 'room_id')
+
+    def __init__(self, data):
+        self.type = data.get('type')
+        self.user_id = data.get('userId')
+        self.group_id = data.get('groupId')
+        self.room_id = data.get('roomId')
+
+class TextMessageRecord:
+    __slots__ = ('id', 'text', 'quote_token')
+
+    type = 'text'
+    message_name = 'TextMessage'
+
+    def __init__(self, data):
+        self.id = data.get('id')
+        self.text = data.get('text')
+        self.quote_token = data.get('quoteToken')
+
+class PostbackRecord:
+    __slots__ = ('data', 'params')
+
+    def __init__(self, data):
+        self.data = data.get('data')
+        self.params = data.get('params')
+
+class EventRecord:
+    """handler 需要的事件欄位，屬性名稱與 SDK 的事件物件相同"""
+
+    __slots__ = ('mode', 'timestamp', 'source', 'reply_token', 'webhook_event_id')
+
+    def __init__(self, data):
+        self.mode = data.get('mode')
+        self.timestamp = data.get('timestamp')
+        self.source = SourceRecord(data.get('source') or {})
+        self.reply_token = data.get('replyToken')
+        self.webhook_event_id = data.get('webhookEventId')
+
+class TextMessageEventRecord(EventRecord):
+    __slots__ = ('message',)
+
+    type = 'message'
+    event_name = 'MessageEvent'
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.message = TextMessageRecord(data['message'])
+
+class PostbackEventRecord(EventRecord):
+    __slots__ = ('postback',)
+
+    type = 'postback'
+    event_name = 'PostbackEvent'
+    message_name = None
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.postback = PostbackRecord(data.get('postback') or {})
+
+# 有精簡紀錄的事件，其他有 handler 的事件仍建立 SDK 物件
+_RECORDS = {
+    ('message', 'text'): TextMessageEventRecord,
+    ('postback', None): PostbackEventRecord
+}
+
+def handler_names(event):
+    """回傳 (事件名稱, 訊息名稱)，與 WebhookHandler.add 註冊時的名稱相同"""
+    if isinstance(event, EventRecord):
+        name = event.event_name
+        return name, event.message.message_name if name == 'MessageEvent' else None
+    message = event.message if isinstance(event, MessageEvent) else None
+    return event.__class__.__name__, message.__class__.__name__ if message is not None else None
+
+def _names(data):
+    event_type = data.get('type')
+    cls = EVENT_CLASSES.get(event_type, UnknownEvent)
+    message_type = None
+    message_name = None
+    if event_type == 'message':
+        message_type = (data.get('message') or {}).get('type')
+        message_name = MESSAGE_NAMES.get(message_type)
+    return cls, message_type, message_name
+
+class FastWebhookParser:
+    """webhook 的快速解析
+
+    直接對原始 bytes 驗證簽章，JSON 只解析一次；
+    沒有 handler 的事件（follow、已讀、圖片訊息等）在建立任何物件前就丟棄，
+    文字訊息與 postback 以 __slots__ 精簡紀錄交給 handler。
+
+    accepts(事件名稱, 訊息名稱) 回傳該事件是否有 handler。
+    """
+
+    def __init__(self, channel_secret, accepts):
+        self.channel_secret = channel_secret.encode('utf-8')
+        self.accepts = accepts
+        self.stats = {
+            'requests': 0,
+            'events': 0,
+            'dropped': 0,
+            'sdk_events': 0
+        }
+
+    def verify(self, body, signature):
+        digest = hmac.new(self.channel_secret, body, hashlib.sha256).digest()
+        return hmac.compare_digest(signature.encode('utf-8'), base64.b64encode(digest))
+
+    def parse(self, body, signature):
+        """body 為原始 bytes，回傳有 handler 的事件"""
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if not self.verify(body, signature):
+            raise InvalidSignatureError('Invalid signature. signature=' + signature)
+
+        events = []
+        raw_events = _loads(body).get('events') or []
+        for data in raw_events:
+            cls, message_type, message_name = _names(data)
+            if not self.accepts(cls.__name__, message_name):
+                continue
+            record = _RECORDS.get((data.get('type'), message_type))
+            if record is not None:
+                events.append(record(data))
+            else:
+                events.append(cls.new_from_json_dict(data))
+                self.stats['sdk_events'] += 1
+
+        self.stats['requests'] += 1
+        self.stats['events'] += len(events)
+        self.stats['dropped'] += len(raw_events) - len(events)
+        return events
@@ -0,0 +1,210 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from linebot import WebhookHandler
+from dotenv import load_dotenv
+from deadline import Deadline
+from webhook_fastpath import FastWebhookParser, handler_names
+
+load_dotenv()
+
+class WorkerPool:
+    """有界的背景工作池，讓 webhook 立即回應、LLM 生成在背景執行"""
+
+    def __init__(self, max_workers=None, max_queue=None, job_timeout=None):
+        self.max_workers = max_workers or int(os.getenv('WORKER_CONCURRENCY', '8'))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv('WORKER_QUEUE_SIZE', '100'))
+        self.job_timeout = job_timeout or float(os.getenv('WORKER_JOB_TIMEOUT', '50'))
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='webhook-worker'
+        )
+        # 執行中 + 排隊中的工作總數上限
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+        self._lock = threading.Lock()
+        self.stats = {
+            'submitted': 0,
+            'rejected': 0,
+            'expired': 0,
+            'overrun': 0,
+            'failed': 0
+        }
+
+    def _incr(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def submit(self, func, *args, on_expired=None):
+        """排入工作，佇列已滿時回傳 False"""
+        if not self._slots.acquire(blocking=False):
+            self._incr('rejected')
+            return False
+
+        deadline = time.monotonic() + self.job_timeout
+
+        try:
+            self._executor.submit(self._run, deadline, func, args, on_expired)
+        except RuntimeError:
+            # executor 已關閉
+            self._slots.release()
+            self._incr('rejected')
+            return False
+
+        self._incr('submitted')
+        return True
+
+    def _run(self, deadline, func, args, on_expired):
+        try:
+            # 排隊太久的工作已沒有意義，直接放棄
+            if time.monotonic() > deadline:
+                self._incr('expired')
+                if on_expired:
+                    on_expired(*args)
+                return
+
+            func(*args)
+
+            if time.monotonic() > deadline:
+                self._incr('overrun')
+                print(f"[worker] 工作超過期限 {self.job_timeout}s: {getattr(func, '__name__', func)}")
+        except Exception as e:
+            self._incr('failed')
+            print(f"[worker] 背景工作失敗: {e}")
+        finally:
+            self._slots.release()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+class QueuedWebhookHandler(WebhookHandler):
+    """驗證簽章後把事件排入工作池，不在 request 中等待 handler 完成
+
+    事件依 source.user_id 分流：不同用戶在工作池中並行處理，
+    同一用戶的事件（包含跨 webhook 的事件）依序執行。
+    事件以 FastWebhookParser 解析，沒有 handler 的事件不會建立物件。
+    設定 deadline_ttl 時，收到事件當下建立 Deadline，handler 以 func(event, deadline) 呼叫。
+    """
+
+    def __init__(self, channel_secret, worker_pool=None, prefetch=None, deadline_ttl=None, rejected_pool=None):
+        super().__init__(channel_secret)
+        self.worker_pool = worker_pool or WorkerPool()
+        # 忙碌提示由獨立的小工作池送出，滿載時 request 不必等待 LINE API
+        self.rejected_pool = rejected_pool or WorkerPool(
+            max_workers=int(os.getenv('REJECTED_WORKERS', '1')),
+            max_queue=int(os.getenv('REJECTED_QUEUE_SIZE', '200'))
+        )
+        # prefetch(user_ids)：排入前一次預讀這批用戶的資料，例如 SessionManager.prefetch
+        self.prefetch = prefetch
+        self.deadline_ttl = deadline_ttl
+        self.fast_parser = FastWebhookParser(channel_secret, self._accepts)
+        self._rejected = None
+        self._lanes = {}
+        self._lanes_lock = threading.Lock()
+
+    def rejected(self):
+        """設定工作池滿載時的處理函式（在 rejected_pool 中執行，它也滿載時不再通知）"""
+        def decorator(func):
+            self._rejected = func
+            return func
+        return decorator
+
+    def handle(self, body, signature):
+        """驗證簽章並排入事件，回傳成功排入的事件數；body 可直接傳入原始 bytes"""
+        batches = {}
+        for event in self.fast_parser.parse(body, signature):
+            func = self.find_handler(event)
+            if func is None:
+                continue
+            deadline = Deadline.for_event(event, self.deadline_ttl) if self.deadline_ttl else None
+            batches.setdefault(self._lane_key(event), []).append((func, event, deadline))
+
+        # 登記用戶佇列與判斷是否閒置在同一個鎖內，預讀完成前這些用戶的事件都不會開始執行
+        queued = 0
+        idle = []
+        with self._lanes_lock:
+            for key, jobs in batches.items():
+                lane = self._lanes.get(key)
+                if lane is not None:
+                    # 該用戶已有工作在執行，接在後面依序處理
+                    lane.extend(jobs)
+                    queued += len(jobs)
+                else:
+                    self._lanes[key] = deque(jobs)
+                    idle.append(key)
+
+        if self.prefetch and idle:
+            # 正在處理中的用戶稍後才會輪到新事件，預讀的資料會過時，不預讀
+            try:
+                self.prefetch([key for key in idle if isinstance(key, str)])
+            except Exception as e:
+                print(f"[webhook] 預讀失敗: {e}")
+
+        for key in idle:
+            if self._submit(key):
+                queued += len(batches[key])
+
+        return queued
+
+    @staticmethod
+    def _lane_key(event):
+        user_id = getattr(event.source, 'user_id', None)
+        # 沒有 user_id 的事件各自獨立處理
+        return user_id or ('event', id(event))
+
+    def _submit(self, key):
+        """把已登記的用戶佇列排入工作池"""
+        if self.worker_pool.submit(self._drain, key, on_expired=self._expire):
+            return True
+
+        self._expire(key)
+        return False
+
+    def _drain(self, key):
+        """依序執行同一用戶的事件，直到佇列清空"""
+        while True:
+            with self._lanes_lock:
+                lane = self._lanes[key]
+                if not lane:
+                    del self._lanes[key]
+                    return
+                func, event, deadline = lane.popleft()
+
+            try:
+                if deadline is None:
+                    func(event)
+                else:
+                    func(event, deadline)
+            except Exception as e:
+                print(f"[webhook] handler 執行失敗: {e}")
+
+    def _expire(self, key):
+        """工作池滿載或排隊逾時：整個用戶佇列放棄處理"""
+        with self._lanes_lock:
+            lane = self._lanes.pop(key, deque())
+
+        if self._rejected:
+            for _, event, _ in lane:
+                if not self.rejected_pool.submit(self._rejected, event):
+                    print("[webhook] 忙碌提示佇列已滿，不通知")
+                    break
+
+    def find_handler(self, event):
+        """依照 WebhookHandler 的規則找出事件對應的 handler"""
+        return self._lookup(*handler_names(event))
+
+    def _accepts(self, event_name, message_name):
+        return self._lookup(event_name, message_name) is not None
+
+    def _lookup(self, event_name, message_name):
+        func = None
+
+        if message_name:
+            func = self._handlers.get(event_name + '_' + message_name)
+
+        if func is None:
+            func = self._handlers.get(event_name)
+
+        return func or self._default